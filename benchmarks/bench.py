@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Micro-benchmarks for the snapshot, retention and config hot paths
+
+Each benchmark is timed (best of several runs) and its peak Python
+memory allocation measured with tracemalloc, at each dataset size.
+Results can be saved as a baseline and later runs compared against it:
+
+    python3 benchmarks/bench.py --save-baseline
+    python3 benchmarks/bench.py --compare
+
+Baselines are only meaningful on the machine they were recorded on, so
+none is shipped; record one locally before making changes.  Against a
+baseline from another machine or Python, the comparison is only
+advisory, and regressions do not fail the run.
+"""
+
+import datetime
+import gc
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from turku_storage import utils  # noqa: E402
+from turku_storage.catalog import SnapshotCatalog  # noqa: E402
+
+SIZES = (10, 1000, 10000, 100000)
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+RETENTION = "last 5 snapshots, last 7 days, earliest of 4 weeks, earliest of month"
+# Reference time for synthetic snapshots, so results do not depend on today
+NOW = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def snapshot_names(count, sidecar):
+    """Return (directory name, sync_finish) pairs in mixed naming formats
+
+    Without sidecar JSON, only the legacy timestamp formats can be
+    parsed, so the turku-storage-ping format is only used with it.
+    """
+    rng = random.Random(count)
+    names = []
+    for i in range(count):
+        sync_finish = NOW - datetime.timedelta(minutes=i * 15, seconds=rng.randint(0, 59))
+        style = i % (4 if sidecar else 3)
+        if style == 0:
+            name = sync_finish.astimezone().replace(tzinfo=None).isoformat(timespec="seconds")
+        elif style == 1:
+            name = sync_finish.astimezone().replace(tzinfo=None).isoformat(timespec="microseconds")
+        elif style == 2:
+            name = "{:.2f}".format(sync_finish.timestamp())
+        else:
+            name = "source_{}_{:04x}".format(sync_finish.strftime("%Y%m%d-%H%M%S"), i % 65536)
+        names.append((name, sync_finish))
+    return names
+
+
+def make_snapshots_dir(path, count, sidecar):
+    os.makedirs(path)
+    for name, sync_finish in snapshot_names(count, sidecar):
+        os.mkdir(os.path.join(path, name))
+        if sidecar:
+            with open(os.path.join(path, "{}.json".format(name)), "w") as f:
+                json.dump(
+                    {
+                        "name": name,
+                        "base": None,
+                        "sync_begin": (sync_finish - datetime.timedelta(minutes=5)).isoformat(),
+                        "sync_finish": sync_finish.isoformat(),
+                        "retention": RETENTION,
+                    },
+                    f,
+                )
+    return pathlib.Path(path)
+
+
+def make_config_dir(path, count):
+    """Create a config.d with a spread of files and count volumes"""
+    config_d = os.path.join(path, "config.d")
+    os.makedirs(config_d)
+    with open(os.path.join(config_d, "00-base.json"), "w") as f:
+        json.dump(
+            {
+                "name": "bench",
+                "secret": "secret",
+                "api_url": "https://turku.example.com/v1",
+                "var_dir": path,
+                "lock_dir": path,
+                "log_file": os.path.join(path, "log"),
+                "ssh_ping_host": "storage.example.com",
+                "ssh_ping_host_keys": [],
+                "timezone": None,
+            },
+            f,
+        )
+    files = 10
+    for i in range(files):
+        volumes = {
+            "volume{}".format(j): {"path": "/srv/volume{}".format(j), "accept_new_high_water_pct": 80}
+            for j in range(i, count, files)
+        }
+        with open(os.path.join(config_d, "10-volumes-{}.json".format(i)), "w") as f:
+            json.dump({"volumes": volumes}, f)
+    return path
+
+
+def measure(func, repeat, min_time=0.05):
+    """Return (best time per call in seconds, peak allocated bytes) for func()
+
+    Fast functions are called in a loop until each timed run takes at
+    least min_time, so timer resolution does not dominate.
+    """
+    gc.collect()
+    number = 1
+    while True:
+        time_begin = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - time_begin
+        if elapsed >= min_time:
+            break
+        number *= 10
+    times = [elapsed / number]
+    for i in range(repeat - 1):
+        time_begin = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - time_begin) / number)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(size, workdir):
+    """Yield (benchmark name, func) for a dataset size"""
+    for sidecar in (False, True):
+        variant = "json" if sidecar else "nojson"
+        snapshots_dir = make_snapshots_dir(os.path.join(workdir, "snapshots-{}-{}".format(size, variant)), size, sidecar)
+        names = [name for name, sync_finish in snapshot_names(size, False)]
+        snapshots = utils.get_snapshots_from_dir(snapshots_dir)
+        catalog = SnapshotCatalog(snapshots_dir)
+        catalog.load()
+
+        yield "get_snapshots_from_dir/{}".format(variant), lambda: utils.get_snapshots_from_dir(snapshots_dir)
+        yield "catalog_snapshots/{}".format(variant), lambda: SnapshotCatalog(snapshots_dir).snapshots()
+        if not sidecar:
+            yield "parse_snapshot_name", lambda: [utils.parse_snapshot_name(name) for name in names]
+        # get_snapshots_to_delete() with a fixed "now"
+        yield "get_snapshots_to_delete/{}".format(variant), lambda: utils.compile_retention(RETENTION).get_snapshots_to_delete(
+            snapshots, NOW
+        )
+
+    config_dir = make_config_dir(os.path.join(workdir, "config-{}".format(size)), size)
+    config = utils.load_config(config_dir)
+    yield "load_config", lambda: utils.load_config(config_dir)
+    yield "dict_merge", lambda: utils.dict_merge(config, {"volumes": {"volume0": {"accept_new": False}}})
+
+    weights = {"volume{}".format(i): random.random() for i in range(size)}
+    yield "random_weighted", lambda: utils.random_weighted(weights)
+
+
+def run(sizes, repeat):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="turku-storage-bench-")
+    try:
+        for size in sizes:
+            for name, func in benchmarks(size, workdir):
+                seconds, peak = measure(func, repeat)
+                key = "{}/{}".format(name, size)
+                results[key] = {"seconds": seconds, "peak_bytes": peak}
+                print("{:45} {:>12.6f}s {:>12} bytes".format(key, seconds, peak), flush=True)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def get_platform():
+    return "{} {} {} on {}".format(
+        platform.python_implementation(), platform.python_version(), platform.machine(), platform.node()
+    )
+
+
+def compare(results, baseline, threshold):
+    """Print changes against the baseline, returning the number of regressions"""
+    regressions = 0
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        time_ratio = results[key]["seconds"] / baseline[key]["seconds"] if baseline[key]["seconds"] else 1.0
+        memory_ratio = results[key]["peak_bytes"] / baseline[key]["peak_bytes"] if baseline[key]["peak_bytes"] else 1.0
+        regressed = time_ratio > threshold or memory_ratio > threshold
+        if regressed:
+            regressions += 1
+        print("{:45} time {:>6.2f}x  memory {:>6.2f}x{}".format(key, time_ratio, memory_ratio, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="Dataset sizes to run")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark; the best is kept")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare the results against the baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=1.5, help="Time or memory ratio against the baseline counted as a regression"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run(args.sizes, args.repeat)
+
+    if args.compare and not os.path.exists(args.baseline):
+        print("No baseline at {}; record one with --save-baseline".format(args.baseline))
+    elif args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("Compared to baseline from {} ({}):".format(baseline["date"], baseline["platform"]))
+        regressions = compare(results, baseline["results"], args.threshold)
+        if baseline["platform"] != get_platform():
+            print("Baseline was recorded on another platform ({}); comparison is advisory only".format(get_platform()))
+        elif regressions:
+            print("{} regressions".format(regressions))
+            return 1
+
+    if args.save_baseline:
+        with utils.safe_write(args.baseline) as f:
+            json.dump(
+                {
+                    "date": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+                    "platform": get_platform(),
+                    "results": results,
+                },
+                f,
+                sort_keys=True,
+                indent=4,
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
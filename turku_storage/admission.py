@@ -0,0 +1,159 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import fcntl
+import os
+import time
+
+
+class VolumeSemaphore:
+    """Cross-process counting semaphore for one kind of job on a volume
+
+    Each slot is a file held with flock(), so a slot is freed when its
+    holder exits, even if it crashes.  flock() rather than lockf() is
+    used as its locks belong to the open file, so threads in the same
+    process compete for slots as well.  Waiters take a ticket and only
+    the oldest waiter still alive tries for a free slot, so slots are
+    handed out in FIFO order.  A job may take several slots at once (a
+    sharded sync runs several rsyncs); it only takes them once all are
+    free, so two such jobs cannot each hold part of what they need.
+    """
+
+    poll_interval = 0.25
+
+    def __init__(self, volume_name, kind, slots, lock_dir, timeout=None):
+        self.volume_name = volume_name
+        self.kind = kind
+        self.slots = max(int(slots), 1)
+        self.timeout = timeout
+        self.dir = os.path.join(lock_dir, "turku-storage-{}-{}".format(volume_name.replace("/", "_"), kind))
+        self.slot_fhs = []
+        self.wait_time = 0.0
+
+    @contextlib.contextmanager
+    def queue_lock(self):
+        with open(os.path.join(self.dir, "queue"), "a+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            yield fh
+
+    def wait_file(self, ticket):
+        return os.path.join(self.dir, "wait.{}".format(ticket))
+
+    def enqueue(self):
+        """Take the next ticket, returning it and the held wait file"""
+        with self.queue_lock() as fh:
+            fh.seek(0)
+            try:
+                ticket = int(fh.read().strip() or 0)
+            except ValueError:
+                ticket = 0
+            fh.seek(0)
+            fh.truncate()
+            fh.write("{}\n".format(ticket + 1))
+            fh.flush()
+            wait_fh = open(self.wait_file(ticket), "w")
+            fcntl.flock(wait_fh, fcntl.LOCK_EX)
+        return ticket, wait_fh
+
+    def dequeue(self, ticket, wait_fh):
+        with self.queue_lock():
+            try:
+                os.unlink(self.wait_file(ticket))
+            except FileNotFoundError:
+                pass
+            wait_fh.close()
+
+    def is_first(self, ticket):
+        """Return whether no live waiter holds an older ticket, removing stale ones"""
+        with self.queue_lock():
+            for fn in os.listdir(self.dir):
+                if not fn.startswith("wait."):
+                    continue
+                try:
+                    other = int(fn[len("wait.") :])
+                except ValueError:
+                    continue
+                if other >= ticket:
+                    continue
+                try:
+                    fh = open(self.wait_file(other))
+                except FileNotFoundError:
+                    continue
+                with fh:
+                    try:
+                        fcntl.flock(fh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        return False
+                    # Acquired, so the waiter is gone
+                    os.unlink(self.wait_file(other))
+        return True
+
+    def try_slots(self, count):
+        """Take count free slots, or none of them"""
+        fhs = []
+        for i in range(self.slots):
+            fh = open(os.path.join(self.dir, "slot.{}".format(i)), "w")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                continue
+            fhs.append(fh)
+            if len(fhs) == count:
+                return fhs
+        for fh in fhs:
+            fh.close()
+        return []
+
+    def acquire(self, count=1):
+        """Wait for count slots (at most the number of slots), returning the seconds waited
+
+        Raises TimeoutError if they were not free within timeout seconds.
+        """
+        count = min(max(count, 1), self.slots)
+        os.makedirs(self.dir, exist_ok=True)
+        time_begin = time.monotonic()
+        ticket, wait_fh = self.enqueue()
+        try:
+            while True:
+                if self.is_first(ticket):
+                    self.slot_fhs = self.try_slots(count)
+                    if self.slot_fhs:
+                        break
+                if self.timeout is not None and time.monotonic() - time_begin >= self.timeout:
+                    raise TimeoutError(
+                        "No {} slot free on volume {} after {:.0f}s".format(self.kind, self.volume_name, self.timeout)
+                    )
+                time.sleep(self.poll_interval)
+        finally:
+            self.dequeue(ticket, wait_fh)
+            self.wait_time = time.monotonic() - time_begin
+        return self.wait_time
+
+    def release(self):
+        for fh in self.slot_fhs:
+            fh.close()
+        self.slot_fhs = []
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.release()
+
+
+def get_volume_semaphore(config, volume_name, kind):
+    """Return the semaphore for "rsync" or "deletion" jobs on a volume, or None if they are not limited"""
+    if volume_name is None:
+        return None
+    v = config["volumes"][volume_name]
+    slots = v["max_concurrent_{}s".format(kind)]
+    if not slots:
+        return None
+    return VolumeSemaphore(volume_name, kind, slots, config["lock_dir"], timeout=v["admission_timeout"])
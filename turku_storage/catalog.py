@@ -0,0 +1,234 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import json
+import logging
+import os
+import pathlib
+import time
+
+from .utils import get_latest_snapshot, get_snapshot_from_dir, safe_write
+
+CATALOG_VERSION = 2
+# A directory changed this soon before it was listed may have changed
+# again within the same timestamp tick, without its mtime changing (the
+# git index "racy timestamp" problem).  Coarser than any filesystem's
+# timestamp granularity in use; FAT's is 2 seconds.
+RACY_NS = 2000000000
+
+
+class SnapshotCatalog:
+    """Persistent listing of a snapshots directory
+
+    The catalog is stored next to (not inside) the snapshots directory,
+    so writing it does not change the directory's mtime.  If the mtime
+    recorded in the catalog matches the directory, and the directory
+    was not changed just before it was listed, the catalog is used
+    as-is.  Otherwise it is reconciled against a directory listing, only
+    examining names which were not seen before, and snapshots whose
+    .json metadata was replaced.  A missing or unreadable catalog is
+    rebuilt from scratch.
+
+    add(), remove(), rename() and update() record changes made by this
+    process without listing the directory again.  They are saved against
+    the last listing, so the next load() reconciles them with any
+    changes made by other processes in the meantime.
+    """
+
+    def __init__(self, snapshots_dir, catalog_file=None):
+        self.snapshots_dir = pathlib.Path(snapshots_dir)
+        if catalog_file is None:
+            catalog_file = self.snapshots_dir.parent.joinpath("{}.catalog.json".format(self.snapshots_dir.name))
+        self.catalog_file = pathlib.Path(catalog_file)
+        self.entries = None
+        self.ignored = None
+        self.info_stats = None
+        self.mtime_ns = None
+        self.listed_ns = None
+
+    def _serialize(self, snapshot_info):
+        entry = dict(snapshot_info)
+        entry["directory"] = snapshot_info["directory"].name
+        entry["info_file"] = snapshot_info["info_file"].name if snapshot_info["info_file"] else None
+        for k in ("sync_begin", "sync_finish"):
+            if entry.get(k):
+                entry[k] = entry[k].isoformat()
+        return entry
+
+    def _deserialize(self, entry):
+        snapshot_info = dict(entry)
+        snapshot_info["directory"] = self.snapshots_dir.joinpath(entry["directory"])
+        snapshot_info["info_file"] = self.snapshots_dir.joinpath(entry["info_file"]) if entry["info_file"] else None
+        for k in ("sync_begin", "sync_finish"):
+            if snapshot_info.get(k):
+                snapshot_info[k] = datetime.datetime.fromisoformat(snapshot_info[k])
+        return snapshot_info
+
+    def _dir_mtime(self):
+        return os.stat(self.snapshots_dir).st_mtime_ns
+
+    def _info_stat(self, name):
+        """Return what identifies the current version of a snapshot's .json metadata"""
+        try:
+            st = os.stat(self.snapshots_dir.joinpath("{}.json".format(name)))
+        except FileNotFoundError:
+            return None
+        return [st.st_mtime_ns, st.st_ino]
+
+    def _read_entry(self, name):
+        """(Re)read a snapshot directory into the catalog"""
+        self.entries.pop(name, None)
+        self.ignored.discard(name)
+        self.info_stats.pop(name, None)
+        info_stat = self._info_stat(name)
+        snapshot_info = get_snapshot_from_dir(self.snapshots_dir.joinpath(name))
+        if snapshot_info is None:
+            self.ignored.add(name)
+        else:
+            self.entries[name] = self._serialize(snapshot_info)
+            self.info_stats[name] = info_stat
+
+    def _is_racy(self, mtime_ns, listed_ns):
+        return listed_ns is None or mtime_ns >= listed_ns - RACY_NS
+
+    def load(self, save=True):
+        """Load the catalog, reconciling or rebuilding it if needed"""
+        mtime_ns = self._dir_mtime()
+        try:
+            with self.catalog_file.open() as f:
+                catalog = json.load(f)
+            if catalog.get("version") != CATALOG_VERSION:
+                raise ValueError("Unknown catalog version")
+            self.entries = catalog["entries"]
+            self.ignored = set(catalog["ignored"])
+            self.info_stats = catalog["info_stats"]
+            catalog_mtime_ns = catalog["mtime_ns"]
+            catalog_listed_ns = catalog["listed_ns"]
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.debug("Rebuilding snapshot catalog {}".format(self.catalog_file))
+            self.entries = {}
+            self.ignored = set()
+            self.info_stats = {}
+            catalog_mtime_ns = None
+            catalog_listed_ns = None
+        if catalog_mtime_ns != mtime_ns or self._is_racy(catalog_mtime_ns, catalog_listed_ns):
+            self.reconcile(mtime_ns, save=save)
+        else:
+            self.mtime_ns = catalog_mtime_ns
+            self.listed_ns = catalog_listed_ns
+
+    def refresh(self):
+        """Reload the catalog if the directory may have changed since it was last listed
+
+        For catalogs kept in memory between backups, such as by
+        turku-storage-daemon.
+        """
+        if (
+            self.entries is None
+            or self._dir_mtime() != self.mtime_ns
+            or self._is_racy(self.mtime_ns, self.listed_ns)
+        ):
+            self.load()
+
+    def reconcile(self, mtime_ns, save=True):
+        """Bring the catalog up to date with the directory contents
+
+        mtime_ns must be taken before the directory is listed, so a
+        change made while listing leaves the catalog stale rather than
+        silently incomplete.
+        """
+        listed_ns = time.time_ns()
+        names = set(os.listdir(self.snapshots_dir))
+        for name in [name for name in self.entries if name not in names]:
+            del self.entries[name]
+        self.ignored &= names
+        for name in [name for name in self.info_stats if name not in self.entries]:
+            del self.info_stats[name]
+        for name in sorted(names):
+            if name in self.ignored:
+                continue
+            if name in self.entries:
+                if self.info_stats.get(name) != self._info_stat(name):
+                    self._read_entry(name)
+                continue
+            if name.endswith(".json") and name[:-5] in names:
+                # Sidecar of a snapshot directory
+                continue
+            self._read_entry(name)
+        self.mtime_ns = mtime_ns
+        self.listed_ns = listed_ns
+        if save:
+            self.save()
+
+    def save(self):
+        """Write the catalog, recording the directory listing it was last reconciled with"""
+        catalog = {
+            "version": CATALOG_VERSION,
+            "mtime_ns": self.mtime_ns,
+            "listed_ns": self.listed_ns,
+            "entries": self.entries,
+            "ignored": sorted(self.ignored),
+            "info_stats": self.info_stats,
+        }
+        try:
+            with safe_write(str(self.catalog_file)) as f:
+                json.dump(catalog, f, sort_keys=True)
+        except OSError as e:
+            # The catalog is only a cache; the directory remains authoritative
+            logging.debug("Cannot write snapshot catalog {}: {}".format(self.catalog_file, e))
+
+    def snapshots(self):
+        """Return all snapshots, in get_snapshots_from_dir() format and order"""
+        if self.entries is None:
+            self.load()
+        return [self._deserialize(self.entries[name]) for name in sorted(self.entries)]
+
+    def latest(self):
+        return get_latest_snapshot(self.snapshots())
+
+    def add(self, name):
+        """Record a snapshot directory which was just created"""
+        if self.entries is None:
+            self.load(save=False)
+        self._read_entry(name)
+        self.save()
+
+    def remove(self, *names):
+        """Forget snapshot directories which were just deleted or renamed away"""
+        if self.entries is None:
+            self.load(save=False)
+        for name in names:
+            self.entries.pop(name, None)
+            self.ignored.discard(name)
+            self.info_stats.pop(name, None)
+        self.save()
+
+    def update(self, fields):
+        """Merge fields, keyed by snapshot name, into existing entries and save once
+
+        For metadata written alongside several snapshots in one pass,
+        such as usage.  The fields must already be written to their
+        .json metadata.
+        """
+        if self.entries is None:
+            self.load(save=False)
+        for name, entry_fields in fields.items():
+            if name in self.entries:
+                self.entries[name].update(entry_fields)
+                self.info_stats[name] = self._info_stat(name)
+        self.save()
+
+    def rename(self, old_name, new_name):
+        """Record a snapshot directory which was just renamed"""
+        if self.entries is None:
+            self.load(save=False)
+        self.entries.pop(old_name, None)
+        self.ignored.discard(old_name)
+        self.info_stats.pop(old_name, None)
+        self._read_entry(new_name)
+        self.save()
@@ -0,0 +1,162 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+from .ping import get_local_log_handler, StoragePing
+from .utils import get_api_client, load_config_cached, RuntimeLock
+
+
+class ConnectionLogHandler(logging.Handler):
+    """Send formatted log records back to a turku-storage-ping client"""
+
+    def __init__(self, conn, timeout=30):
+        super().__init__()
+        self.conn = conn
+        # A client which stops reading must not block the job once the
+        # socket buffer fills
+        self.conn.settimeout(timeout)
+        self.connected = True
+
+    def send(self, message):
+        if not self.connected:
+            return
+        try:
+            self.conn.sendall(json.dumps(message).encode("UTF-8") + b"\n")
+        except OSError:
+            # The agent went away or stalled; the job carries on without
+            # its log stream, as a ping would
+            self.connected = False
+
+    def emit(self, record):
+        try:
+            message = {"log": self.format(record)}
+        except Exception:
+            self.handleError(record)
+            return
+        self.send(message)
+
+
+class StorageDaemon:
+    """Run turku-storage-ping jobs in one long-lived process
+
+    The config, idle API clients (with their kept-alive connections),
+    the local log handler and the snapshot catalogs are kept between
+    jobs.  The config is checked for changes before each job; if it
+    changed, the API clients and log handler are recreated.  Each
+    connection is handled in its own thread, so jobs for different
+    machines run concurrently, subject to the same per-machine locks
+    and per-volume admission limits as separate pings.
+    """
+
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self.config = None
+        self.lh_local = None
+        self.api_clients = []
+        self.catalogs = {}
+        self.lock = threading.Lock()
+
+    def load_config(self):
+        config = load_config_cached(self.config_dir)
+        with self.lock:
+            if config == self.config:
+                return
+            if self.config is not None:
+                logging.info("Config changed, reloading")
+            self.config = config
+            # Running jobs keep the previous handler and clients
+            self.lh_local = get_local_log_handler(config)
+            self.api_clients = []
+
+    def get_api(self):
+        """Return an idle API client, or a new one, with its stats cleared"""
+        with self.lock:
+            api = self.api_clients.pop() if self.api_clients else get_api_client(self.config)
+        api.reset_stats()
+        return api
+
+    def put_api(self, api, config):
+        """Return an API client for reuse, unless the config changed while it was out"""
+        with self.lock:
+            if config is self.config:
+                self.api_clients.append(api)
+
+    def handle(self, conn):
+        with conn:
+            try:
+                with conn.makefile("rb") as f:
+                    request = json.loads(f.readline())
+                uuid = request["uuid"]
+                jsonin = request["jsonin"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning("Invalid request: {}".format(e))
+                return
+            lh_console = ConnectionLogHandler(conn)
+            try:
+                self.load_config()
+                ping = StoragePing(uuid, config_dir=self.config_dir, daemon=self, lh_console=lh_console)
+                returncode = ping.main(jsonin)
+                self.put_api(ping.api, ping.config)
+            except Exception as e:
+                logging.exception(e)
+                lh_console.send({"log": str(e)})
+                returncode = 1
+            lh_console.send({"returncode": returncode or 0})
+
+    def serve(self, socket_file):
+        if os.path.exists(socket_file):
+            os.unlink(socket_file)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The agents' source passwords are sent over it
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(socket_file)
+        finally:
+            os.umask(old_umask)
+        sock.listen(64)
+        logging.info("Listening on {}".format(socket_file))
+        while True:
+            conn, addr = sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Run turku-storage-ping jobs in a long-lived process",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--debug", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    daemon = StorageDaemon(args.config_dir)
+    daemon.load_config()
+    if not daemon.config["daemon_socket"]:
+        print("daemon_socket is not set", file=sys.stderr)
+        sys.exit(1)
+
+    lock = RuntimeLock(name="turku-storage-daemon", lock_dir=daemon.config["lock_dir"])
+    try:
+        daemon.serve(daemon.config["daemon_socket"])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lock.close()
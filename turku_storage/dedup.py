@@ -0,0 +1,310 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import stat
+import time
+import uuid
+
+from .catalog import SnapshotCatalog
+from .deletion import RateLimiter
+from .usage import clear_usage, find_sources, format_bytes
+from .utils import load_config, RuntimeLock
+
+CHUNK_SIZE = 1048576
+# Index changes are committed once per this many files
+COMMIT_BATCH = 1000
+
+
+def metadata(st):
+    """Return what must match for two files to be linked"""
+    return (st.st_dev, st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid)
+
+
+class DedupIndex:
+    """Persistent index of file inodes by size and content hash
+
+    Inodes are keyed by (st_dev, st_ino), so an inode seen in a previous
+    run, with the same size and mtime, is not hashed again.  Inodes not
+    seen in a run are pruned at its end.
+    """
+
+    def __init__(self, file):
+        self.db = sqlite3.connect(file)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS inodes ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, mode INTEGER, uid INTEGER, gid INTEGER, "
+            "hash TEXT, path TEXT, seen INTEGER, PRIMARY KEY (dev, ino))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS inodes_hash ON inodes (dev, size, hash)")
+        self.db.commit()
+
+    def get_hash(self, st):
+        """Return the known hash of an inode, or None if it is new or has changed"""
+        row = self.db.execute(
+            "SELECT hash FROM inodes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        return row[0] if row else None
+
+    def update(self, st, hash, path, seen):
+        self.db.execute(
+            "INSERT OR REPLACE INTO inodes (dev, ino, size, mtime_ns, mode, uid, gid, hash, path, seen) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid, hash, path, seen),
+        )
+
+    def find(self, st, hash):
+        """Return (inode, path) of other indexed inodes identical to st on the same filesystem"""
+        return self.db.execute(
+            "SELECT ino, path FROM inodes WHERE dev = ? AND size = ? AND hash = ? "
+            "AND mtime_ns = ? AND mode = ? AND uid = ? AND gid = ? AND ino != ? ORDER BY ino",
+            (st.st_dev, st.st_size, hash, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid, st.st_ino),
+        ).fetchall()
+
+    def forget(self, dev, ino):
+        self.db.execute("DELETE FROM inodes WHERE dev = ? AND ino = ?", (dev, ino))
+
+    def prune(self, seen):
+        """Forget inodes not seen since the given run, returning how many"""
+        return self.db.execute("DELETE FROM inodes WHERE seen < ?", (seen,)).rowcount
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class Deduplicator:
+    """Hard-link identical files across snapshots on the same filesystem
+
+    Files are only linked when their content and metadata (mode,
+    ownership, mtime) are identical, as rsync --link-dest requires, so
+    the snapshots read back exactly as before.  Contents are compared
+    byte for byte before linking, so neither a hash collision nor a
+    reused inode number can link different files.  Directory mtimes
+    are restored after files in them are replaced.
+
+    The snapshot directories on both sides of each link are collected in
+    linked_snapshots, so the usage recorded with them can be cleared;
+    the other side is only found below one of snapshots_dirs.
+    """
+
+    def __init__(self, index, min_size=1, bytes_per_sec=None, files_per_sec=None, dry_run=False, snapshots_dirs=()):
+        self.index = index
+        self.snapshots_dirs = set(str(x) for x in snapshots_dirs)
+        self.linked_snapshots = set()
+        self.min_size = min_size
+        self.byte_limiter = RateLimiter(bytes_per_sec / CHUNK_SIZE) if bytes_per_sec else None
+        self.file_limiter = RateLimiter(files_per_sec) if files_per_sec else None
+        self.dry_run = dry_run
+        self.seen = int(time.time())
+        self.pending = 0
+        self.files = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.linked_files = 0
+        self.linked_bytes = 0
+        self.freed_bytes = 0
+        self.errors = 0
+
+    def read_chunks(self, path):
+        with open(path, "rb") as f:
+            while True:
+                if self.byte_limiter:
+                    self.byte_limiter.wait()
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def hash_file(self, path):
+        h = hashlib.sha256()
+        for chunk in self.read_chunks(path):
+            h.update(chunk)
+            self.hashed_bytes += len(chunk)
+        self.hashed_files += 1
+        return h.hexdigest()
+
+    def files_equal(self, path_a, path_b):
+        chunks_a = self.read_chunks(path_a)
+        chunks_b = self.read_chunks(path_b)
+        try:
+            for chunk_a in chunks_a:
+                if chunk_a != next(chunks_b, b""):
+                    return False
+            return next(chunks_b, b"") == b""
+        finally:
+            chunks_a.close()
+            chunks_b.close()
+
+    def link(self, target, path):
+        """Atomically replace path with a hard link to target"""
+        temp_path = os.path.join(os.path.dirname(path), ".turku-dedup-{}~".format(uuid.uuid4()))
+        os.link(target, temp_path)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+    def get_snapshot_dir(self, path):
+        """Return the snapshot directory holding path, or None"""
+        for parent in pathlib.PurePath(path).parents:
+            if str(parent.parent) in self.snapshots_dirs:
+                return pathlib.Path(parent)
+        return None
+
+    def process_file(self, path, st):
+        """Index a regular file and link it to an identical one, returning whether it was linked"""
+        hash = self.index.get_hash(st)
+        if hash is None:
+            hash = self.hash_file(path)
+        self.index.update(st, hash, path, self.seen)
+        for ino, other_path in self.index.find(st, hash):
+            try:
+                other_st = os.lstat(other_path)
+            except OSError:
+                other_st = None
+            if other_st is None or other_st.st_ino != ino or metadata(other_st) != metadata(st):
+                # Expired or replaced since it was indexed
+                self.index.forget(st.st_dev, ino)
+                continue
+            if other_st.st_nlink >= os.pathconf(other_path, "PC_LINK_MAX"):
+                continue
+            if not self.files_equal(other_path, path):
+                continue
+            logging.debug("Linking {} to {}".format(path, other_path))
+            if not self.dry_run:
+                self.link(other_path, path)
+                self.index.forget(st.st_dev, st.st_ino)
+                other_snapshot_dir = self.get_snapshot_dir(other_path)
+                if other_snapshot_dir is not None:
+                    self.linked_snapshots.add(other_snapshot_dir)
+            self.linked_files += 1
+            self.linked_bytes += st.st_size
+            if st.st_nlink == 1:
+                self.freed_bytes += st.st_blocks * 512
+            return True
+        return False
+
+    def scan(self, snapshot_dir):
+        """Deduplicate all regular files in a snapshot against the index"""
+        dirs = [snapshot_dir]
+        while dirs:
+            dir = dirs.pop()
+            try:
+                dir_st = os.lstat(dir)
+                entries = list(os.scandir(dir))
+            except OSError as e:
+                logging.warning("Cannot scan {}: {}".format(dir, e))
+                self.errors += 1
+                continue
+            linked = False
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        dirs.append(entry.path)
+                        continue
+                    if not stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+                        continue
+                    if self.file_limiter:
+                        self.file_limiter.wait()
+                    self.files += 1
+                    if self.process_file(entry.path, st):
+                        linked = True
+                        if not self.dry_run:
+                            self.linked_snapshots.add(pathlib.Path(snapshot_dir))
+                except OSError as e:
+                    logging.warning("Cannot deduplicate {}: {}".format(entry.path, e))
+                    self.errors += 1
+                self.pending += 1
+                if self.pending >= COMMIT_BATCH:
+                    self.index.commit()
+                    self.pending = 0
+            if linked and not self.dry_run:
+                os.utime(dir, ns=(dir_st.st_atime_ns, dir_st.st_mtime_ns), follow_symlinks=False)
+        self.index.commit()
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Hard-link identical files across the latest snapshots of all machines",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--index", type=str, help="Index database (default: var_dir/dedup.sqlite)")
+    parser.add_argument("--min-size", type=int, default=4096, help="Ignore files smaller than this many bytes")
+    parser.add_argument("--bwlimit", type=int, help="Read at most this many bytes per second")
+    parser.add_argument("--files-per-sec", type=int, help="Process at most this many files per second")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="Report what would be linked without linking")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("machine", nargs="?", help="Machine UUID or unit name (default: all machines)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    lock = RuntimeLock(lock_dir=config["lock_dir"])
+
+    index = DedupIndex(args.index or os.path.join(config["var_dir"], "dedup.sqlite"))
+    deduplicator = Deduplicator(
+        index,
+        min_size=args.min_size,
+        bytes_per_sec=args.bwlimit,
+        files_per_sec=args.files_per_sec,
+        dry_run=args.dry_run,
+        snapshots_dirs=[source[3] for source in find_sources(config)],
+    )
+    time_begin = time.monotonic()
+    for machine_name, machine_uuid, source_name, snapshots_dir in find_sources(config, args.machine):
+        snapshot = SnapshotCatalog(snapshots_dir).latest()
+        if not snapshot:
+            continue
+        logging.info("Scanning {} {} {}".format(machine_name, source_name, snapshot["name"]))
+        deduplicator.scan(str(snapshot["directory"]))
+    # A partial run has not seen everything, so keeps the rest of the index
+    if args.machine is None and not args.dry_run:
+        logging.debug("Pruned {} inodes from the index".format(index.prune(deduplicator.seen)))
+    index.close()
+
+    # Files which were unique to these snapshots are now shared
+    snapshots_by_dir = {}
+    for snapshot_dir in deduplicator.linked_snapshots:
+        snapshots_by_dir.setdefault(snapshot_dir.parent, set()).add(snapshot_dir.name)
+    for snapshots_dir, names in sorted(snapshots_by_dir.items()):
+        clear_usage(SnapshotCatalog(snapshots_dir), names)
+
+    logging.info(
+        "{} files, {} hashed ({}), {} {}linked ({}), {} freed, {} errors in {:.1f}s".format(
+            deduplicator.files,
+            deduplicator.hashed_files,
+            format_bytes(deduplicator.hashed_bytes),
+            deduplicator.linked_files,
+            "would be " if args.dry_run else "",
+            format_bytes(deduplicator.linked_bytes),
+            format_bytes(deduplicator.freed_bytes),
+            deduplicator.errors,
+            time.monotonic() - time_begin,
+        )
+    )
+
+    lock.close()
@@ -0,0 +1,188 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import concurrent.futures
+import errno
+import logging
+import os
+import threading
+import time
+
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+# Counters are published to other threads once per this many operations
+COUNT_BATCH = 1024
+# Errors beyond this many per tree are only counted
+MAX_LOGGED_ERRORS = 10
+
+
+class RateLimiter:
+    """Limit the rate of operations shared between threads"""
+
+    def __init__(self, ops_per_sec):
+        self.interval = 1.0 / ops_per_sec
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.next_time < now:
+                self.next_time = now
+            delay = self.next_time - now
+            self.next_time += self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TreeDeleter:
+    """Remove directory trees in parallel
+
+    The top levels of a tree are split into subtrees, which are removed
+    depth-first by a pool of threads.  Everything is done relative to
+    directory file descriptors, so symlinks are never followed and only
+    one file descriptor per directory level is held by each thread.
+    Nothing is remembered about removed entries, so memory use does not
+    grow with the size of the tree, however many hard links it holds.
+    """
+
+    def __init__(self, threads=4, ops_per_sec=None, split_depth=3, progress_interval=60.0, initializer=None):
+        self.threads = max(int(threads), 1)
+        self.limiter = RateLimiter(ops_per_sec) if ops_per_sec else None
+        self.split_depth = split_depth
+        self.progress_interval = progress_interval
+        self.initializer = initializer
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.entries = 0
+        self.errors = 0
+
+    def add_counts(self, entries, errors):
+        with self.lock:
+            self.entries += entries
+            self.errors += errors
+
+    def error(self, op, name, e):
+        """Record a failed operation, returning the error count to add"""
+        if e.errno == errno.ENOENT:
+            return 0
+        with self.lock:
+            logged = self.errors
+        if logged < MAX_LOGGED_ERRORS:
+            logging.warning("Cannot {} {}: {}".format(op, name, e))
+        return 1
+
+    def op(self, func, name, dir_fd):
+        """Run a single unlink/rmdir, returning (entries, errors) to add"""
+        if self.limiter:
+            self.limiter.wait()
+        try:
+            func(name, dir_fd=dir_fd)
+        except OSError as e:
+            return 0, self.error(func.__name__, name, e)
+        return 1, 0
+
+    def remove_dir(self, parent_fd, name):
+        """Remove the directory name within parent_fd, depth-first"""
+        entries = errors = 0
+        try:
+            fd = os.open(name, DIR_FLAGS, dir_fd=parent_fd)
+        except OSError as e:
+            self.add_counts(0, self.error("open", name, e))
+            return
+        stack = [(fd, os.scandir(fd), name)]
+        try:
+            while stack:
+                fd, it, dir_name = stack[-1]
+                entry = next(it, None)
+                if entry is None:
+                    stack.pop()
+                    it.close()
+                    os.close(fd)
+                    e_entries, e_errors = self.op(os.rmdir, dir_name, stack[-1][0] if stack else parent_fd)
+                elif entry.is_dir(follow_symlinks=False):
+                    try:
+                        child_fd = os.open(entry.name, DIR_FLAGS, dir_fd=fd)
+                    except OSError as e:
+                        errors += self.error("open", entry.name, e)
+                        continue
+                    stack.append((child_fd, os.scandir(child_fd), entry.name))
+                    continue
+                else:
+                    e_entries, e_errors = self.op(os.unlink, entry.name, fd)
+                entries += e_entries
+                errors += e_errors
+                if entries + errors >= COUNT_BATCH:
+                    self.add_counts(entries, errors)
+                    entries = errors = 0
+        finally:
+            for fd, it, dir_name in stack:
+                it.close()
+                os.close(fd)
+            self.add_counts(entries, errors)
+
+    def split(self, parent_fd, name):
+        """Split the top of a tree into subtrees for the worker threads
+
+        Files found along the way are removed.  Returns the subtrees as
+        (parent_fd, name), and the expanded directories as
+        (parent_fd, name, fd), to be removed once the subtrees are gone.
+        """
+        units = [(parent_fd, name)]
+        expanded = []
+        for depth in range(self.split_depth):
+            if len(units) >= self.threads * 4:
+                break
+            next_units = []
+            for unit_parent_fd, unit_name in units:
+                try:
+                    fd = os.open(unit_name, DIR_FLAGS, dir_fd=unit_parent_fd)
+                except OSError as e:
+                    self.add_counts(0, self.error("open", unit_name, e))
+                    continue
+                expanded.append((unit_parent_fd, unit_name, fd))
+                with os.scandir(fd) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            next_units.append((fd, entry.name))
+                        else:
+                            self.add_counts(*self.op(os.unlink, entry.name, fd))
+            units = next_units
+        return units, expanded
+
+    def delete(self, path, progress=None):
+        """Remove path and everything below it
+
+        progress, if given, is called with (entries, errors, elapsed)
+        every progress_interval seconds.  Returns the same figures once
+        the tree is gone.
+        """
+        self.reset()
+        time_begin = time.monotonic()
+        path = os.path.abspath(path)
+        root_fd = os.open(os.path.dirname(path), DIR_FLAGS)
+        expanded = []
+        try:
+            units, expanded = self.split(root_fd, os.path.basename(path))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads, initializer=self.initializer) as executor:
+                pending = [executor.submit(self.remove_dir, unit_parent_fd, unit_name) for unit_parent_fd, unit_name in units]
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=self.progress_interval)
+                    for future in done:
+                        future.result()
+                    if pending and progress:
+                        progress(self.entries, self.errors, time.monotonic() - time_begin)
+            while expanded:
+                unit_parent_fd, unit_name, fd = expanded.pop()
+                os.close(fd)
+                self.add_counts(*self.op(os.rmdir, unit_name, unit_parent_fd))
+        finally:
+            for unit_parent_fd, unit_name, fd in expanded:
+                os.close(fd)
+            os.close(root_fd)
+        return self.entries, self.errors, time.monotonic() - time_begin
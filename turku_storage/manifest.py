@@ -0,0 +1,196 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import fnmatch
+import gzip
+import logging
+import os
+import re
+import stat
+import sys
+
+from .catalog import SnapshotCatalog
+from .usage import find_sources
+from .utils import load_config, safe_write
+
+MANIFEST_SUFFIX = ".manifest.gz"
+MANIFEST_HEADER = b"# turku-storage manifest 1\n"
+ESCAPES = {b"\\": b"\\\\", b"\t": b"\\t", b"\n": b"\\n"}
+UNESCAPE_RE = re.compile(rb"\\(.)")
+UNESCAPES = {b"\\": b"\\", b"t": b"\t", b"n": b"\n"}
+
+
+def get_manifest_file(snapshots_dir, snapshot_name):
+    """Return the manifest file of a snapshot, next to its .json metadata"""
+    return os.path.join(snapshots_dir, "{}{}".format(snapshot_name, MANIFEST_SUFFIX))
+
+
+def escape_path(path):
+    for k, v in ESCAPES.items():
+        path = path.replace(k, v)
+    return path
+
+
+def unescape_path(path):
+    return UNESCAPE_RE.sub(lambda m: UNESCAPES.get(m.group(1), m.group(1)), path)
+
+
+def walk(root):
+    """Yield (relative path, stat) for everything below root, as bytes paths
+
+    Directories are listed one at a time, in name order, so entries can
+    be streamed out without holding the whole tree in memory.
+    """
+    dirs = [b""]
+    root = os.fsencode(root)
+    while dirs:
+        dir = dirs.pop()
+        with os.scandir(os.path.join(root, dir) if dir else root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            path = os.path.join(dir, entry.name) if dir else entry.name
+            st = entry.stat(follow_symlinks=False)
+            yield path, st
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(path)
+        dirs += reversed(subdirs)
+
+
+def write_manifest(snapshot_dir, manifest_file):
+    """Write the manifest of a snapshot tree, returning the number of entries
+
+    Each line is a tab-separated path, size, mtime, mode (octal) and
+    inode number.  Paths are bytes, with backslash, tab and newline
+    escaped.  The manifest is written under a temporary name and only
+    renamed into place once complete.
+    """
+    entries = 0
+    fh = safe_write(manifest_file, mode="wb")
+    try:
+        with gzip.GzipFile(fileobj=fh, mode="wb", compresslevel=6, mtime=0) as gz:
+            gz.write(MANIFEST_HEADER)
+            for path, st in walk(snapshot_dir):
+                gz.write(b"%s\t%d\t%d\t%o\t%d\n" % (escape_path(path), st.st_size, int(st.st_mtime), st.st_mode, st.st_ino))
+                entries += 1
+    except BaseException:
+        fh._fh_close()
+        os.unlink(fh.name)
+        raise
+    fh.close()
+    return entries
+
+
+def read_manifest(manifest_file):
+    """Yield (path, size, mtime, mode, inode) entries of a manifest"""
+    with gzip.open(manifest_file, "rb") as f:
+        if f.readline() != MANIFEST_HEADER:
+            raise ValueError("{} is not a known manifest format".format(manifest_file))
+        for line in f:
+            path, size, mtime, mode, inode = line.rstrip(b"\n").split(b"\t")
+            yield os.fsdecode(unescape_path(path)), int(size), int(mtime), int(mode, 8), int(inode)
+
+
+def count_top_level(manifest_file):
+    """Return the number of entries at or below each top-level name of a manifest"""
+    counts = {}
+    with gzip.open(manifest_file, "rb") as f:
+        if f.readline() != MANIFEST_HEADER:
+            raise ValueError("{} is not a known manifest format".format(manifest_file))
+        for line in f:
+            name = line.split(b"\t", 1)[0].split(b"/", 1)[0]
+            counts[name] = counts.get(name, 0) + 1
+    return {os.fsdecode(unescape_path(name)): count for name, count in counts.items()}
+
+
+def match_entries(entries, pattern=None, since=None, until=None):
+    """Filter manifest entries by glob pattern and mtime range
+
+    A pattern containing a slash is matched against the whole path,
+    otherwise against the file name, as with find -name.
+    """
+    for entry in entries:
+        path, size, mtime, mode, inode = entry
+        if since is not None and mtime < since:
+            continue
+        if until is not None and mtime >= until:
+            continue
+        if pattern is not None:
+            if not fnmatch.fnmatchcase(path if "/" in pattern else os.path.basename(path), pattern.lstrip("/")):
+                continue
+        yield entry
+
+
+def parse_time(value):
+    import argparse
+
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: {}".format(value))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Find files in snapshots from their manifests, without reading the snapshot trees",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--machine", "-m", type=str, help="Machine UUID or unit name (default: all machines)")
+    parser.add_argument("--source", "-s", type=str, help="Source name (default: all sources)")
+    parser.add_argument("--latest", action="store_true", help="Only search the latest snapshot of each source")
+    parser.add_argument("--since", type=parse_time, help="Only files modified at or after this ISO 8601 date")
+    parser.add_argument("--until", type=parse_time, help="Only files modified before this ISO 8601 date")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("pattern", nargs="?", help="Glob matched against file names, or paths if it contains a /")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    found = 0
+    for machine_name, machine_uuid, source_name, snapshots_dir in find_sources(config, args.machine):
+        if args.source is not None and source_name != args.source:
+            continue
+        catalog = SnapshotCatalog(snapshots_dir)
+        if args.latest:
+            snapshots = [x for x in [catalog.latest()] if x]
+        else:
+            snapshots = sorted(catalog.snapshots(), key=lambda x: x["sync_finish"])
+        for snapshot in snapshots:
+            manifest_file = get_manifest_file(snapshots_dir, snapshot["name"])
+            if not os.path.exists(manifest_file):
+                logging.debug("No manifest for {} {} {}".format(machine_name, source_name, snapshot["name"]))
+                continue
+            try:
+                for path, size, mtime, mode, inode in match_entries(
+                    read_manifest(manifest_file), args.pattern, args.since, args.until
+                ):
+                    print(
+                        "{} {} {} {} {:>12} {} {}".format(
+                            machine_name,
+                            source_name,
+                            snapshot["name"],
+                            stat.filemode(mode),
+                            size,
+                            datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"),
+                            path,
+                        )
+                    )
+                    found += 1
+            except (OSError, EOFError, ValueError) as e:
+                logging.warning("Cannot read manifest {}: {}".format(manifest_file, e))
+    if not found:
+        sys.exit(1)
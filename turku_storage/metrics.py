@@ -0,0 +1,185 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import re
+import time
+
+from .utils import safe_write
+
+# name: (help, key); values come from backup_source() results
+SOURCE_METRICS = {
+    "turku_storage_source_last_run_timestamp_seconds": ("End time of the last backup run", "time_end"),
+    "turku_storage_source_success": ("Whether the last backup run succeeded", "success"),
+    "turku_storage_source_duration_seconds": ("Duration of the last backup run", "duration"),
+    "turku_storage_source_sync_duration_seconds": ("Duration of rsync in the last backup run", "sync_duration"),
+    "turku_storage_source_queue_wait_seconds": ("Time spent waiting for a volume rsync slot in the last backup run", "queue_wait"),
+    "turku_storage_source_rsync_return_code": ("rsync return code of the last backup run", "returncode"),
+    "turku_storage_source_received_bytes": ("Bytes received by rsync in the last backup run", "received_bytes"),
+    "turku_storage_source_literal_bytes": ("Changed file data transferred in the last backup run", "literal_bytes"),
+    "turku_storage_source_total_bytes": ("Total size of the files in the last backup run", "total_bytes"),
+    "turku_storage_source_transferred_files": ("Files transferred in the last backup run", "transferred_files"),
+    "turku_storage_source_linked_files": ("Files hard-linked from earlier snapshots in the last backup run", "linked_files"),
+    "turku_storage_source_linked_bytes": ("Size of the files hard-linked in the last backup run", "linked_bytes"),
+    "turku_storage_source_retention_duration_seconds": (
+        "Time spent applying retention in the last backup run",
+        "retention_duration",
+    ),
+    "turku_storage_source_retention_deleted_snapshots": (
+        "Snapshots expired by retention in the last backup run",
+        "retention_deleted",
+    ),
+    "turku_storage_source_snapshots": ("Snapshots kept for the source", "snapshots"),
+    "turku_storage_source_attempts": ("Attempts the last backup run took, including resumed failures", "attempts"),
+}
+# Suffixes of turku_storage_api_* (per machine, from pings) and
+# turku_storage_update_config_api_*; the textfile collector rejects a
+# metric family whose label names differ between files, so the two
+# are kept apart
+API_METRICS = {
+    "calls": ("API calls made in the last run", "calls"),
+    "errors": ("Failed API calls in the last run", "errors"),
+    "retries": ("API call retries in the last run", "retries"),
+    "call_seconds_mean": ("Mean API call latency in the last run", "time_mean"),
+    "call_seconds_max": ("Maximum API call latency in the last run", "time_max"),
+}
+PING_METRICS_RE = re.compile(r"^(turku_storage_ping_.+)\.(?:prom|json)$")
+VOLUME_METRICS = {
+    "turku_storage_volume_size_bytes": ("Volume filesystem size", "size_bytes"),
+    "turku_storage_volume_avail_bytes": ("Volume filesystem space available", "avail_bytes"),
+    "turku_storage_volume_inodes": ("Volume filesystem inodes", "inodes_total"),
+    "turku_storage_volume_inodes_free": ("Volume filesystem inodes available", "inodes_available"),
+    "turku_storage_volume_active_jobs": ("Backups running on the volume", "active_jobs"),
+}
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsText:
+    """Gauges in the Prometheus text format read by the node_exporter textfile collector"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, help, value, labels=None):
+        if value is None:
+            return
+        if name not in self.metrics:
+            self.metrics[name] = (help, [])
+        self.metrics[name][1].append((labels or {}, value))
+
+    def render(self):
+        out = []
+        for name in sorted(self.metrics):
+            help, samples = self.metrics[name]
+            out.append("# HELP {} {}\n".format(name, help))
+            out.append("# TYPE {} gauge\n".format(name))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in sorted(labels.items()))
+                out.append("{}{} {}\n".format(name, "{" + label_text + "}" if label_text else "", float(value)))
+        return "".join(out)
+
+    def write(self, file):
+        with safe_write(file) as f:
+            f.write(self.render())
+
+
+def get_metrics_dir(config):
+    """Return the textfile collector directory, or None if metrics are disabled"""
+    if not config["metrics_dir"]:
+        return None
+    if not os.path.isdir(config["metrics_dir"]):
+        os.makedirs(config["metrics_dir"])
+    return config["metrics_dir"]
+
+
+def add_api_metrics(metrics, prefix, api_stats, labels=None):
+    for cmd, stats in sorted(api_stats.items()):
+        stats = dict(stats, time_mean=stats["time_total"] / stats["calls"] if stats["calls"] else 0.0)
+        for suffix, (help, key) in API_METRICS.items():
+            metrics.add("{}_{}".format(prefix, suffix), help, stats[key], dict(labels or {}, cmd=cmd))
+
+
+def get_ping_metrics_name(machine_uuid):
+    return "turku_storage_ping_{}".format(re.sub(r"[^A-Za-z0-9_-]", "_", machine_uuid))
+
+
+def write_ping_metrics(config, machine, results, api_stats):
+    """Write the per-source metrics of a machine
+
+    Only some sources are backed up on each ping, so the last results
+    of each source are kept in a state file and merged with new ones.
+    """
+    try:
+        metrics_dir = get_metrics_dir(config)
+        if metrics_dir is None:
+            return
+        name = get_ping_metrics_name(machine["uuid"])
+        state_file = os.path.join(metrics_dir, "{}.json".format(name))
+        try:
+            with open(state_file) as f:
+                sources = json.load(f)["sources"]
+        except (OSError, ValueError, KeyError, TypeError):
+            sources = {}
+        sources.update(results)
+        with safe_write(state_file) as f:
+            json.dump({"sources": sources}, f, sort_keys=True)
+
+        metrics = MetricsText()
+        machine_labels = {"machine_uuid": machine["uuid"], "machine": machine["unit_name"]}
+        for source_name, result in sorted(sources.items()):
+            for metric_name, (help, key) in SOURCE_METRICS.items():
+                metrics.add(metric_name, help, result.get(key), dict(machine_labels, source=source_name))
+        add_api_metrics(metrics, "turku_storage_api", api_stats, machine_labels)
+        metrics.write(os.path.join(metrics_dir, "{}.prom".format(name)))
+    except OSError as e:
+        # Metrics must never fail a backup
+        logging.warning("Cannot write metrics: {}".format(e))
+
+
+def write_update_config_metrics(config, volumes, machines, api_stats):
+    """Write the storage unit and per-volume metrics"""
+    try:
+        metrics_dir = get_metrics_dir(config)
+        if metrics_dir is None:
+            return
+        metrics = MetricsText()
+        metrics.add("turku_storage_update_config_last_run_timestamp_seconds", "End time of the last update-config run", time.time())
+        metrics.add("turku_storage_machines", "Machines assigned to the storage unit", machines)
+        for volume_name, status in sorted(volumes.items()):
+            status = dict(
+                status,
+                size_bytes=status["space_total"] * 1048576,
+                avail_bytes=status["space_available"] * 1048576,
+            )
+            labels = {"volume": volume_name, "path": config["volumes"][volume_name]["path"]}
+            for name, (help, key) in VOLUME_METRICS.items():
+                metrics.add(name, help, status[key], labels)
+        add_api_metrics(metrics, "turku_storage_update_config_api", api_stats)
+        metrics.write(os.path.join(metrics_dir, "turku_storage_update_config.prom"))
+    except OSError as e:
+        logging.warning("Cannot write metrics: {}".format(e))
+
+
+def prune_ping_metrics(config, machine_uuids):
+    """Remove the metrics and state files of machines no longer assigned to the storage unit"""
+    try:
+        metrics_dir = get_metrics_dir(config)
+        if metrics_dir is None:
+            return
+        keep = {get_ping_metrics_name(machine_uuid) for machine_uuid in machine_uuids}
+        for fn in os.listdir(metrics_dir):
+            m = PING_METRICS_RE.match(fn)
+            if m and m.group(1) not in keep:
+                logging.debug("Removing stale metrics file {}".format(fn))
+                os.unlink(os.path.join(metrics_dir, fn))
+    except OSError as e:
+        logging.warning("Cannot prune metrics: {}".format(e))
@@ -5,97 +5,160 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import concurrent.futures
 import datetime
 import json
 import logging
 import logging.handlers
 import os
-import pathlib
 import platform
+import socket
 import subprocess
 import sys
 import tempfile
 import time
-import uuid
-
-try:
-    import systemd.journal as systemd_journal
-except ImportError as e:
-    systemd_journal = e
 
+from .admission import get_volume_semaphore
+from .metrics import write_ping_metrics
+from .placement import choose_volume
+from .rsync import RsyncOutput, RSYNC_OUTPUT_ARGS
+from .manifest import count_top_level, get_manifest_file
+from .restore import get_restore_file, split_streams
+from .snapshot import get_snapshot_backend
+from .timing import span, Timeline, write_trace
+from .usage import update_usage
 from .utils import (
-    load_config,
+    load_config_cached,
     RuntimeLock,
-    api_call,
-    random_weighted,
-    get_latest_snapshot,
-    get_snapshots_to_delete,
-    get_snapshots_from_dir,
+    get_api_client,
+    lazy_import,
+    safe_write,
 )
 
+# Spans of a source's timeline reported as its phases
+PHASES = ("prepare", "queue_wait", "rsync", "snapshot", "retention")
+
+
+def get_local_log_handler(config):
+    """Return the handler for config["log_file"], or None
+
+    Records must carry the machine UUID as a uuid attribute, as added
+    by StoragePing.
+    """
+    systemd_journal = lazy_import("systemd.journal") if config["log_file"] == "systemd" else None
+    if config["log_file"] == "systemd" and (not isinstance(systemd_journal, ImportError)):
+        lh_local = systemd_journal.JournalHandler(SYSLOG_IDENTIFIER="turku-storage-ping")
+        lh_local_formatter = logging.Formatter("%(name)s %(uuid)s: %(message)s")
+    elif config["log_file"] == "syslog":
+        lh_local = logging.handlers.SysLogHandler()
+        lh_local_formatter = logging.Formatter(
+            "{} turku-storage-ping[%(process)s] %(name)s %(uuid)s: %(message)s".format(platform.node())
+        )
+    elif config["log_file"]:
+        lh_local = logging.FileHandler(config["log_file"])
+        lh_local_formatter = logging.Formatter(
+            "%(asctime)s " + platform.node() + " turku-storage-ping[%(process)s] (%(name)s) %(uuid)s: %(message)s"
+        )
+    else:
+        return None
+    lh_local.setFormatter(lh_local_formatter)
+    lh_local.setLevel(logging.DEBUG)
+    return lh_local
+
+
+def read_request(stdin):
+    """Read the agent's request, which ends at EOF or a line with a single "." """
+    jsonin = ""
+    while True:
+        line = stdin.readline()
+        if (not line) or (line.rstrip() == "."):
+            break
+        jsonin = jsonin + line
+    return jsonin
+
 
 class StoragePing:
-    def __init__(self, uuid, config_dir="/etc/turku-storage"):
-        self.arg_uuid = uuid
+    """Handle one agent connection
 
-        self.config = load_config(config_dir)
+    When run by turku-storage-daemon, daemon supplies the config, an API
+    client, the local log handler and the snapshot catalogs, and
+    lh_console sends console output back to the connection.  Otherwise,
+    an already loaded config may be passed to avoid loading it again.
+    """
+
+    def __init__(self, uuid, config_dir="/etc/turku-storage", daemon=None, lh_console=None, config=None):
+        self.arg_uuid = uuid
+        self.daemon = daemon
+        self.timeline = Timeline("ping")
+        self.source_timelines = {}
+
+        with self.timeline.span("config_load"):
+            if daemon:
+                self.config = daemon.config
+            elif config is not None:
+                self.config = config
+            else:
+                self.config = load_config_cached(config_dir)
         for k in ("name", "secret"):
             if k not in self.config:
                 raise Exception("Incomplete config")
 
-        self.logger = logging.getLogger(self.config["name"])
+        if daemon:
+            self.api = daemon.get_api()
+            self.catalogs = daemon.catalogs
+            # A logger of its own, so concurrent jobs do not see each other's output
+            self.logger = logging.Logger(self.config["name"])
+        else:
+            self.api = get_api_client(self.config)
+            self.catalogs = None
+            self.logger = logging.getLogger(self.config["name"])
         self.logger.setLevel(logging.DEBUG)
+        self.logger.addFilter(self.add_uuid)
 
-        self.lh_console = logging.StreamHandler()
+        self.lh_console = lh_console or logging.StreamHandler()
         self.lh_console_formatter = logging.Formatter("[%(asctime)s %(name)s] %(levelname)s: %(message)s")
         self.lh_console.setFormatter(self.lh_console_formatter)
         self.lh_console.setLevel(logging.ERROR)
         self.logger.addHandler(self.lh_console)
 
-        if self.config["log_file"] == "systemd" and (not isinstance(systemd_journal, ImportError)):
-            self.lh_local = systemd_journal.JournalHandler(SYSLOG_IDENTIFIER="turku-storage-ping")
-            self.lh_local_formatter = logging.Formatter("%(name)s {}: %(message)s".format(self.arg_uuid))
-        elif self.config["log_file"] == "syslog":
-            self.lh_local = logging.handlers.SysLogHandler()
-            self.lh_local_formatter = logging.Formatter(
-                "{} turku-storage-ping[%(process)s] %(name)s {}: %(message)s".format(platform.node(), self.arg_uuid)
-            )
-        elif self.config["log_file"]:
-            self.lh_local = logging.FileHandler(self.config["log_file"])
-            self.lh_local_formatter = logging.Formatter(
-                "%(asctime)s " + platform.node() + " turku-storage-ping[%(process)s] (%(name)s) " + self.arg_uuid + ": %(message)s"
-            )
-        else:
-            self.lh_local = None
-            self.lh_local_formatter = None
+        self.lh_local = daemon.lh_local if daemon else get_local_log_handler(self.config)
         if self.lh_local:
-            self.lh_local.setFormatter(self.lh_local_formatter)
-            self.lh_local.setLevel(logging.DEBUG)
             self.logger.addHandler(self.lh_local)
 
-    def run_logging(self, args, loglevel=logging.DEBUG, cwd=None, env=None):
+    def add_uuid(self, record):
+        record.uuid = self.arg_uuid
+        return True
+
+    def run_logging(self, args, loglevel=logging.DEBUG, cwd=None, env=None, output=None):
+        """Run a command, logging its output
+
+        If an output processor (e.g. RsyncOutput) is given, each line is
+        passed through it and only the lines it returns are logged.
+        """
         self.logger.log(loglevel, "Running: %s" % repr(args))
         with subprocess.Popen(
             args,
             cwd=cwd,
             env=env,
             encoding="UTF-8",
+            errors="replace",
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         ) as proc:
             with proc.stdout as stdout:
                 for line in iter(stdout.readline, ""):
+                    if output is not None:
+                        line = output.feed(line)
+                        if line is None:
+                            continue
                     self.logger.log(loglevel, line.rstrip())
         self.logger.log(loglevel, "Return code: %d" % proc.returncode)
         return proc.returncode
 
-    def process_ping(self):
-        jsonin = ""
-        while True:
-            line = sys.stdin.readline()
-            if (not line) or (line.rstrip() == "."):
-                break
-            jsonin = jsonin + line
+    def process_ping(self, jsonin=None):
+        if jsonin is None:
+            with self.timeline.span("stdin_read"):
+                jsonin = read_request(sys.stdin)
         try:
             j = json.loads(jsonin)
         except ValueError:
@@ -117,10 +180,22 @@ class StoragePing:
             self.lh_console.setLevel(logging.INFO)
 
         if "action" in j and j["action"] == "restore":
+            if self.daemon:
+                # The tunnel is held open by the connection's own stdin
+                raise Exception("Restore mode must not be sent to turku-storage-daemon")
             self.logger.info("Restore mode active on port %d.  Good luck." % forwarded_port)
 
-            while sys.stdin.read():
-                pass
+            # Let turku-storage-restore find the tunnel
+            restore_file = get_restore_file(self.config, self.arg_uuid)
+            if not os.path.isdir(os.path.dirname(restore_file)):
+                os.makedirs(os.path.dirname(restore_file))
+            with safe_write(restore_file) as f:
+                json.dump({"port": forwarded_port, "pid": os.getpid(), "time_begin": time.time()}, f)
+            try:
+                while sys.stdin.read():
+                    pass
+            finally:
+                os.unlink(restore_file)
             self.logger.info("Restore mode finished")
             return
 
@@ -128,7 +203,8 @@ class StoragePing:
             "storage": {"name": self.config["name"], "secret": self.config["secret"]},
             "machine": {"uuid": self.arg_uuid},
         }
-        api_reply = api_call(self.config["api_url"], "storage_ping_checkin", api_out)
+        with self.timeline.span("api_checkin"):
+            api_reply = self.api.call("storage_ping_checkin", api_out, idempotent=True)
 
         machine = api_reply["machine"]
         scheduled_sources = machine["scheduled_sources"]
@@ -136,8 +212,8 @@ class StoragePing:
             self.logger.info("Sources to back up: %s" % ", ".join([s for s in scheduled_sources]))
         else:
             self.logger.info("No sources to back up now")
+        sources = []
         for source_name in scheduled_sources:
-            time_begin = time.time()
             s = scheduled_sources[source_name]
             source_username = None
             source_password = None
@@ -154,58 +230,201 @@ class StoragePing:
             if not (source_username and source_password):
                 self.logger.error('Cannot find authentication for source "%s"' % source_name)
                 continue
-            snapshot_mode = self.config["snapshot_mode"]
-            if snapshot_mode == "link-dest":
-                if "large_rotating_files" in s and s["large_rotating_files"]:
-                    snapshot_mode = "none"
-                if "large_modifying_files" in s and s["large_modifying_files"]:
-                    snapshot_mode = "none"
-            if "snapshot_mode" in s and s["snapshot_mode"]:
-                snapshot_mode = s["snapshot_mode"]
-
-            var_machines = os.path.join(self.config["var_dir"], "machines")
-            if not os.path.exists(var_machines):
-                os.makedirs(var_machines)
-
-            if os.path.islink(os.path.join(var_machines, machine["uuid"])):
-                machine_dir = os.readlink(os.path.join(var_machines, machine["uuid"]))
-            else:
-                weights = {}
-                for volume_name in self.config["volumes"]:
-                    v = self.config["volumes"][volume_name]
+            sources.append((source_name, s, source_username, source_password))
+
+        failed = False
+        results = {}
+        if sources:
+            with self.timeline.span("placement"):
+                machine_dir = self.get_machine_dir(machine)
+                max_workers = self.get_max_concurrent_sources(machine_dir)
+            self.logger.debug("Backing up at most %d sources at once" % max_workers)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(
+                        self.backup_source,
+                        machine,
+                        machine_dir,
+                        forwarded_port,
+                        source_name,
+                        s,
+                        source_username,
+                        source_password,
+                    ): source_name
+                    for source_name, s, source_username, source_password in sources
+                }
+                for future in concurrent.futures.as_completed(futures):
                     try:
-                        sv = os.statvfs(v["path"])
-                    except OSError:
-                        continue
-                    s_t = sv.f_bsize * sv.f_blocks / 1048576
-                    s_a = sv.f_bsize * sv.f_bavail / 1048576
-                    pct_used = (1.0 - float(s_a) / float(s_t)) * 100.0
-                    if (not v["accept_new"]) or (pct_used > v["accept_new_high_water_pct"]):
-                        continue
-                    weights[volume_name] = s_a
-                if len(weights) == 0:
-                    raise Exception("Cannot find a suitable storage directory")
-                chosen_volume = random_weighted(weights)
-                if not chosen_volume:
-                    raise Exception("Cannot find a suitable storage directory")
-                machine_dir = os.path.join(self.config["volumes"][chosen_volume]["path"], machine["uuid"])
-                os.symlink(machine_dir, os.path.join(var_machines, machine["uuid"]))
-            if not os.path.exists(machine_dir):
-                os.makedirs(machine_dir)
-
-            machine_symlink = machine["unit_name"]
-            if "service_name" in machine and machine["service_name"]:
-                machine_symlink = machine["service_name"] + "-" + machine_symlink
-            if "environment_name" in machine and machine["environment_name"]:
-                machine_symlink = machine["environment_name"] + "-" + machine_symlink
-            machine_symlink = machine_symlink.replace("/", "_")
-            if os.path.islink(os.path.join(var_machines, machine_symlink)):
-                os.unlink(os.path.join(var_machines, machine_symlink))
-            if not os.path.exists(os.path.join(var_machines, machine_symlink)):
-                os.symlink(machine["uuid"], os.path.join(var_machines, machine_symlink))
-
-            self.logger.info("Begin: %s %s" % (machine["unit_name"], source_name))
+                        results[futures[future]] = future.result()
+                    except Exception as e:
+                        self.logger.error('Source "%s" failed' % futures[future])
+                        self.logger.exception(e)
+                        failed = True
+
+        for line in self.api.stats_summary():
+            self.logger.debug("API %s" % line)
+        write_ping_metrics(self.config, machine, results, self.api.stats)
+        if self.config["trace_dir"]:
+            self.write_trace(sorted(self.source_timelines))
+        self.logger.info("Done")
+        lock.close()
+        if failed:
+            return 1
 
+    def write_trace(self, source_names):
+        trace_file = os.path.join(
+            self.config["trace_dir"],
+            "turku-storage-ping-{}-{}.json".format(self.arg_uuid, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")),
+        )
+        try:
+            if not os.path.isdir(self.config["trace_dir"]):
+                os.makedirs(self.config["trace_dir"])
+            write_trace(trace_file, [self.timeline] + [self.source_timelines[source_name] for source_name in source_names])
+        except OSError as e:
+            self.logger.warning("Cannot write trace file %s: %s" % (trace_file, e))
+
+    def get_machine_dir(self, machine):
+        """Return the machine's storage directory, placing new machines on a volume"""
+        var_machines = os.path.join(self.config["var_dir"], "machines")
+        if not os.path.exists(var_machines):
+            os.makedirs(var_machines)
+
+        if os.path.islink(os.path.join(var_machines, machine["uuid"])):
+            machine_dir = os.readlink(os.path.join(var_machines, machine["uuid"]))
+        else:
+            chosen_volume = choose_volume(self.config)
+            if not chosen_volume:
+                raise Exception("Cannot find a suitable storage directory")
+            machine_dir = os.path.join(self.config["volumes"][chosen_volume]["path"], machine["uuid"])
+            os.symlink(machine_dir, os.path.join(var_machines, machine["uuid"]))
+        if not os.path.exists(machine_dir):
+            os.makedirs(machine_dir)
+
+        machine_symlink = machine["unit_name"]
+        if "service_name" in machine and machine["service_name"]:
+            machine_symlink = machine["service_name"] + "-" + machine_symlink
+        if "environment_name" in machine and machine["environment_name"]:
+            machine_symlink = machine["environment_name"] + "-" + machine_symlink
+        machine_symlink = machine_symlink.replace("/", "_")
+        if os.path.islink(os.path.join(var_machines, machine_symlink)):
+            os.unlink(os.path.join(var_machines, machine_symlink))
+        if not os.path.exists(os.path.join(var_machines, machine_symlink)):
+            os.symlink(machine["uuid"], os.path.join(var_machines, machine_symlink))
+
+        return machine_dir
+
+    def get_volume_name(self, machine_dir):
+        """Return the name of the configured volume holding a machine directory"""
+        machine_parent = os.path.realpath(os.path.dirname(machine_dir))
+        for volume_name in self.config["volumes"]:
+            if os.path.realpath(self.config["volumes"][volume_name]["path"]) == machine_parent:
+                return volume_name
+        return None
+
+    def get_max_concurrent_sources(self, machine_dir):
+        volume_name = self.get_volume_name(machine_dir)
+        if volume_name is None:
+            return max(int(self.config["max_concurrent_sources"]), 1)
+        return max(int(self.config["volumes"][volume_name]["max_concurrent_sources"]), 1)
+
+    def run_sharded(self, rsync_args, rsync_source, dest_dir, shards, env, base_snapshot=None, max_workers=None):
+        """Sync a source as parallel rsyncs of its top-level directories
+
+        The directories are split into shards with similar numbers of
+        entries in the previous snapshot, as counted from its manifest.
+        Walking the snapshot instead would cost as much as the sync
+        saves, so without a manifest the directories are dealt out
+        round-robin.  At most max_workers shards run at once.  Once all
+        shards are done, a last
+        non-recursive pass syncs the top-level files, deletes top-level
+        entries which are gone from the source, and sets the metadata of
+        the top directory.  Returns the first failing return code (or 24
+        or 0) and the merged RsyncOutput, in which the top-level
+        directories are only counted once.
+        """
+        filter_args = [arg for arg in rsync_args if arg.startswith("--filter=")]
+        listing = subprocess.run(
+            ["rsync", "--list-only"] + filter_args + [rsync_source],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="UTF-8",
+            errors="replace",
+        )
+        if listing.returncode != 0:
+            self.logger.error("Cannot list %s: %s" % (rsync_source, listing.stdout.strip()))
+            return listing.returncode, RsyncOutput()
+        names = []
+        for line in listing.stdout.splitlines():
+            fields = line.split(None, 4)
+            if len(fields) == 5 and fields[0].startswith("d") and fields[4] != ".":
+                names.append(fields[4])
+        counts = None
+        if base_snapshot:
+            manifest_file = get_manifest_file(str(base_snapshot["directory"].parent), base_snapshot["name"])
+            try:
+                counts = count_top_level(manifest_file)
+            except (OSError, EOFError, ValueError) as e:
+                self.logger.debug("Cannot count entries from %s: %s" % (manifest_file, e))
+        if counts:
+            shard_names = split_streams([(name, counts.get(name, 1)) for name in names], shards)
+        else:
+            shard_names = [sorted(names)[i::shards] for i in range(min(shards, len(names)))]
+        self.logger.debug(
+            "Syncing %d top-level directories in %d shards, split by %s"
+            % (len(names), len(shard_names), "manifest entries" if counts else "name")
+        )
+
+        shard_files = []
+        outputs = []
+        futures = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(min(len(shard_names), max_workers or shards), 1)
+            ) as executor:
+                for names in shard_names:
+                    shard_file = tempfile.NamedTemporaryFile(mode="w+", encoding="UTF-8")
+                    shard_file.write("".join("%s\n" % name for name in names))
+                    shard_file.flush()
+                    shard_files.append(shard_file)
+                    outputs.append(RsyncOutput())
+                    # --files-from does not recurse unless asked to
+                    args = rsync_args + ["--recursive", "--files-from=%s" % shard_file.name, rsync_source, "%s/" % dest_dir]
+                    futures.append(executor.submit(self.run_logging, args, env=env, output=outputs[-1]))
+            returncodes = [future.result() for future in futures]
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+
+        outputs.append(RsyncOutput())
+        args = rsync_args + ["--no-recursive", "--dirs", rsync_source, "%s/" % dest_dir]
+        returncodes.append(self.run_logging(args, env=env, output=outputs[-1]))
+        if shard_names:
+            # The shards already counted the top-level directories; only the top directory is left
+            outputs[-1].discount_dirs(keep=1)
+
+        failed = [returncode for returncode in returncodes if returncode not in (0, 24)]
+        if failed:
+            returncode = failed[0]
+        else:
+            returncode = max(returncodes)
+        return returncode, RsyncOutput.merge(outputs)
+
+    def backup_source(self, machine, machine_dir, forwarded_port, source_name, s, source_username, source_password):
+        time_begin = time.time()
+        snapshot_mode = self.config["snapshot_mode"]
+        if snapshot_mode == "link-dest":
+            if "large_rotating_files" in s and s["large_rotating_files"]:
+                snapshot_mode = self.config["large_files_snapshot_mode"]
+            if "large_modifying_files" in s and s["large_modifying_files"]:
+                snapshot_mode = self.config["large_files_snapshot_mode"]
+        if "snapshot_mode" in s and s["snapshot_mode"]:
+            snapshot_mode = s["snapshot_mode"]
+
+        self.logger.info("Begin: %s %s" % (machine["unit_name"], source_name))
+        timeline = Timeline(source_name)
+        self.source_timelines[source_name] = timeline
+        with span(timeline, "prepare"):
             rsync_args = [
                 "rsync",
                 "--archive",
@@ -214,21 +433,26 @@ class StoragePing:
                 "--delete",
                 "--delete-excluded",
             ]
-            rsync_args.append("--verbose")
+            rsync_args += RSYNC_OUTPUT_ARGS
 
             dest_dir = os.path.join(machine_dir, source_name)
             if not os.path.exists(dest_dir):
                 os.makedirs(dest_dir)
-            if snapshot_mode == "link-dest":
-                snapshot_dir = os.path.join(machine_dir, "%s.snapshots" % source_name)
-                if not os.path.exists(snapshot_dir):
-                    os.makedirs(snapshot_dir)
-                snapshots = get_snapshots_from_dir(pathlib.Path(snapshot_dir))
-                base_snapshot = get_latest_snapshot(snapshots)
-                if base_snapshot:
-                    rsync_args.append("--link-dest={}".format(base_snapshot["directory"]))
-            else:
-                rsync_args.append("--inplace")
+            backend = get_snapshot_backend(
+                snapshot_mode,
+                machine_dir,
+                source_name,
+                timeline=timeline,
+                link_dest_bases=int(self.config["link_dest_bases"]),
+                link_dest_retention=(s.get("retention") if self.config["link_dest_retention_anchors"] else None),
+                resume=self.config["resume_syncs"],
+                manifests=self.config["snapshot_manifests"],
+                catalogs=self.catalogs,
+            )
+            with span(timeline, "snapshot_listing"):
+                rsync_args += backend.prepare()
+            if backend.attempts > 1:
+                self.logger.info("Resuming %s, attempt %d" % (source_name, backend.attempts))
             if self.config["preserve_hard_links"]:
                 rsync_args.append("--hard-links")
 
@@ -244,100 +468,188 @@ class StoragePing:
                 for exclude in s["exclude"]:
                     filter_data += "- %s\n" % exclude
             if filter_data:
-                filter_file = tempfile.NamedTemporaryFile(mode="w+", encoding="UTF-8")
-                filter_file.write(filter_data)
-                filter_file.flush()
+                with span(timeline, "filter_file"):
+                    filter_file = tempfile.NamedTemporaryFile(mode="w+", encoding="UTF-8")
+                    filter_file.write(filter_data)
+                    filter_file.flush()
                 rsync_args.append("--filter=merge %s" % filter_file.name)
 
             if "bwlimit" in s and s["bwlimit"]:
                 rsync_args.append("--bwlimit=%s" % s["bwlimit"])
 
-            rsync_args.append("rsync://%s@127.0.0.1:%d/%s/" % (source_username, forwarded_port, source_name))
-
-            rsync_args.append("%s/" % dest_dir)
+            rsync_source = "rsync://%s@127.0.0.1:%d/%s/" % (source_username, forwarded_port, source_name)
+            shards = int(s.get("shards") or 1)
 
             rsync_env = {"RSYNC_PASSWORD": source_password}
-            sync_begin = datetime.datetime.now().astimezone()
-            returncode = self.run_logging(rsync_args, env=rsync_env)
-            sync_finish = datetime.datetime.now().astimezone()
-            if returncode in (0, 24):
-                success = True
-            else:
+
+        # Limit the rsyncs running on the volume across all pings; a
+        # sharded sync takes a slot per concurrent shard, and runs no
+        # more shards at once than the volume has slots
+        semaphore = get_volume_semaphore(self.config, self.get_volume_name(machine_dir), "rsync")
+        max_workers = min(shards, semaphore.slots) if semaphore else shards
+        queue_error = None
+        if semaphore:
+            try:
+                with span(timeline, "queue_wait"):
+                    semaphore.acquire(max_workers)
+            except TimeoutError as e:
+                queue_error = e
+                self.logger.error(str(e))
+            self.logger.info(
+                "Waited %.1fs for %d rsync slot(s) on volume %s" % (semaphore.wait_time, max_workers, semaphore.volume_name)
+            )
+
+        sync_begin = datetime.datetime.now().astimezone()
+        rsync_output = RsyncOutput()
+        returncode = None
+        if not queue_error:
+            try:
+                with span(timeline, "rsync"):
+                    if shards > 1:
+                        returncode, rsync_output = self.run_sharded(
+                            rsync_args, rsync_source, dest_dir, shards, rsync_env, backend.base_snapshot, max_workers
+                        )
+                    else:
+                        returncode = self.run_logging(
+                            rsync_args + [rsync_source, "%s/" % dest_dir], env=rsync_env, output=rsync_output
+                        )
+            finally:
+                if semaphore:
+                    semaphore.release()
+        sync_finish = datetime.datetime.now().astimezone()
+        transfer = rsync_output.transfer_stats(link_dest=bool(backend.base_snapshot), resumed=backend.attempts > 1)
+        if returncode in (0, 24):
+            success = True
+        else:
+            success = False
+        self.logger.debug("rsync output: %d file lines, %s" % (rsync_output.file_lines, rsync_output.summary()))
+        if not success and rsync_output.buffer:
+            self.logger.warning("Last %d lines of rsync output for %s:" % (len(rsync_output.buffer), source_name))
+            for line in rsync_output.buffer:
+                self.logger.warning(line)
+        if filter_file:
+            filter_file.close()
+
+        snapshot_name = None
+        summary_output = None
+        expired = []
+        if success and backend.keeps_snapshots:
+            summary_output = ""
+            if shards > 1:
+                summary_output += "Shards: {}\n".format(shards)
+            if backend.attempts > 1:
+                summary_output += "Attempts: {}\n".format(backend.attempts)
+            if backend.base_snapshot:
+                summary_output += "Base snapshot: {}\n".format(backend.base_snapshot["name"])
+            if len(backend.base_snapshots) > 1:
+                summary_output += "Other base snapshots: {}\n".format(", ".join(x["name"] for x in backend.base_snapshots[1:]))
+            if rsync_output.stats:
+                summary_output += "Transfer: {}\n".format(rsync_output.summary())
+            if backend.base_snapshots and "linked_files" in transfer:
+                summary_output += "Linked: {} files ({} bytes), copied: {} files ({} bytes)\n".format(
+                    transfer["linked_files"],
+                    transfer.get("linked_bytes", 0),
+                    transfer["copied_files"],
+                    transfer.get("transferred_bytes", 0),
+                )
+            info = {
+                "transfer": transfer,
+                "shards": shards,
+            }
+            if "retention" in s:
+                info["retention"] = s["retention"]
+            try:
+                with span(timeline, "snapshot"):
+                    snapshot_name = backend.create(sync_begin, sync_finish, info)
+            except OSError as e:
+                self.logger.exception(e)
                 success = False
-            if filter_file:
-                filter_file.close()
-
-            snapshot_name = None
-            summary_output = None
-            if success:
-                if snapshot_mode == "link-dest":
-                    summary_output = ""
-                    if base_snapshot:
-                        summary_output += "Base snapshot: {}\n".format(base_snapshot["name"])
-                    snapshot_name = "{}_{}_{}".format(
-                        source_name,
-                        sync_finish.strftime("%Y%m%d-%H%M%S"),
-                        str(uuid.uuid4())[0:4],
-                    )
-                    os.rename(dest_dir, os.path.join(snapshot_dir, snapshot_name))
-                    info_out = {
-                        "name": snapshot_name,
-                        "base": (base_snapshot["name"] if base_snapshot else None),
-                        "sync_begin": sync_begin.isoformat(),
-                        "sync_finish": sync_finish.isoformat(),
+                summary_output += "Snapshot failed: {}\n".format(e)
+            if snapshot_name and "retention" in s:
+                with span(timeline, "retention"):
+                    expired = backend.expire(s["retention"])
+                for snapshot in expired:
+                    summary_output += "Removed old snapshot: {}\n".format(snapshot["name"])
+            if snapshot_name and snapshot_mode == "link-dest" and self.config["snapshot_usage"]:
+                try:
+                    with span(timeline, "usage_scan"):
+                        update_usage(backend.catalog, latest_only=True)
+                except (OSError, ValueError) as e:
+                    self.logger.warning("Cannot record usage of snapshot %s: %s" % (snapshot_name, e))
+        elif queue_error:
+            summary_output = str(queue_error)
+        elif not success:
+            summary_output = "rsync exited with return code %d" % returncode
+            if backend.failed():
+                summary_output += "\nAttempt %d; the next backup will resume" % backend.attempts
+
+        time_end = time.time()
+        phases = timeline.durations(PHASES)
+        if snapshot_name:
+            # Recorded once retention is done, so the metadata and the API update agree
+            try:
+                backend.update_info(snapshot_name, {"phases": phases})
+            except (OSError, ValueError) as e:
+                self.logger.warning("Cannot record phases of snapshot %s: %s" % (snapshot_name, e))
+        api_out = {
+            "storage": {
+                "name": self.config["name"],
+                "secret": self.config["secret"],
+            },
+            "machine": {
+                "uuid": self.arg_uuid,
+                "sources": {
+                    source_name: {
+                        "success": success,
+                        "snapshot": snapshot_name,
+                        "summary": summary_output,
+                        "time_begin": time_begin,
+                        "time_end": time_end,
+                        "transfer": transfer,
+                        "phases": phases,
                     }
-                    with open(os.path.join(snapshot_dir, "{}.json".format(snapshot_name)), "w") as f:
-                        json.dump(info_out, f, sort_keys=True, indent=4)
-                    if os.path.islink(os.path.join(snapshot_dir, "latest")):
-                        os.unlink(os.path.join(snapshot_dir, "latest"))
-                    if not os.path.exists(os.path.join(snapshot_dir, "latest")):
-                        os.symlink(snapshot_name, os.path.join(snapshot_dir, "latest"))
-                    if "retention" in s:
-                        snapshots = get_snapshots_from_dir(pathlib.Path(snapshot_dir))
-                        to_delete = get_snapshots_to_delete(s["retention"], snapshots)
-                        for snapshot in to_delete:
-                            temp_delete_tree = snapshot["directory"].parent.joinpath(
-                                "_delete-{}".format(snapshot["directory"].parts[-1])
-                            )
-                            if snapshot["info_file"] and snapshot["info_file"].exists():
-                                snapshot["info_file"].unlink()
-                            snapshot["directory"].rename(temp_delete_tree)
-                            # A subprocess call is used here instead of shutil.rmtree
-                            # as the latter can be very slow, especially for large trees.
-                            subprocess.call(["rm", "-rf", str(temp_delete_tree)])
-                            summary_output += "Removed old snapshot: {}\n".format(snapshot["name"])
-            else:
-                summary_output = "rsync exited with return code %d" % returncode
-
-            time_end = time.time()
-            api_out = {
-                "storage": {
-                    "name": self.config["name"],
-                    "secret": self.config["secret"],
                 },
-                "machine": {
-                    "uuid": self.arg_uuid,
-                    "sources": {
-                        source_name: {
-                            "success": success,
-                            "snapshot": snapshot_name,
-                            "summary": summary_output,
-                            "time_begin": time_begin,
-                            "time_end": time_end,
-                        }
-                    },
+            },
+        }
+        with span(timeline, "api_update"):
+            self.api.call("storage_ping_source_update", api_out)
+
+        self.logger.info(
+            "Timing: %s"
+            % json.dumps(
+                {
+                    "machine": self.arg_uuid,
+                    "unit_name": machine["unit_name"],
+                    "source": source_name,
+                    "success": success,
+                    "duration": time.time() - time_begin,
+                    "ping": self.timeline.durations(),
+                    "spans": timeline.durations(),
                 },
-            }
-            api_reply = api_call(self.config["api_url"], "storage_ping_source_update", api_out)
-
-            self.logger.info("End: %s %s" % (machine["unit_name"], source_name))
-
-        self.logger.info("Done")
-        lock.close()
+                sort_keys=True,
+            )
+        )
+        self.logger.info("End: %s %s" % (machine["unit_name"], source_name))
+
+        result = {
+            "time_end": time_end,
+            "success": success,
+            "duration": time_end - time_begin,
+            "sync_duration": phases.get("rsync"),
+            "queue_wait": phases.get("queue_wait"),
+            "attempts": backend.attempts,
+            "returncode": returncode,
+            "retention_duration": phases.get("retention"),
+            "retention_deleted": len(expired),
+            "snapshots": len(backend.catalog.snapshots()) if backend.catalog else None,
+        }
+        for k in ("received_bytes", "literal_bytes", "total_bytes", "transferred_files", "linked_files", "linked_bytes"):
+            result[k] = transfer.get(k)
+        return result
 
-    def main(self):
+    def main(self, jsonin=None):
         try:
-            return self.process_ping()
+            return self.process_ping(jsonin)
         except Exception as e:
             self.logger.exception(e)
             return 1
@@ -352,6 +664,47 @@ def parse_args():
     return parser.parse_args()
 
 
+def is_restore(jsonin):
+    try:
+        return json.loads(jsonin).get("action") == "restore"
+    except (ValueError, AttributeError):
+        return False
+
+
+def ping_daemon(socket_file, uuid, jsonin):
+    """Run a ping in turku-storage-daemon, copying its console output to stderr
+
+    Returns the ping's exit code, or None if the daemon could not be
+    reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except OSError:
+        sock.close()
+        return None
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps({"uuid": uuid, "jsonin": jsonin}).encode("UTF-8") + b"\n")
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            if "log" in message:
+                print(message["log"], file=sys.stderr, flush=True)
+            elif "returncode" in message:
+                return message["returncode"]
+    print("Connection to turku-storage-daemon lost", file=sys.stderr)
+    return 1
+
+
 def main():
     args = parse_args()
-    sys.exit(StoragePing(args.uuid, config_dir=args.config_dir).main())
+    config = load_config_cached(args.config_dir)
+    jsonin = None
+    if config["daemon_socket"]:
+        jsonin = read_request(sys.stdin)
+        # Restore mode idles on the agent's tunnel, so is always run here
+        if not is_restore(jsonin):
+            returncode = ping_daemon(config["daemon_socket"], args.uuid, jsonin)
+            if returncode is not None:
+                sys.exit(returncode)
+    sys.exit(StoragePing(args.uuid, config_dir=args.config_dir, config=config).main(jsonin))
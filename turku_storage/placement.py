@@ -0,0 +1,236 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import copy
+import glob
+import json
+import logging
+import os
+import time
+
+from .utils import load_config, lock_holder_alive, random_weighted, safe_write
+
+
+def read_diskstats():
+    """Return sectors written per (major, minor) device, from /proc/diskstats"""
+    sectors_written = {}
+    try:
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 10:
+                    continue
+                sectors_written[(int(fields[0]), int(fields[1]))] = int(fields[9])
+    except OSError:
+        pass
+    return sectors_written
+
+
+def count_active_jobs(config):
+    """Return the number of running pings per machine directory parent"""
+    active = {}
+    var_machines = os.path.join(config["var_dir"], "machines")
+    for lock_file in glob.glob(os.path.join(glob.escape(config["lock_dir"]), "turku-storage-ping-*.lock")):
+        machine_uuid = os.path.basename(lock_file)[len("turku-storage-ping-") : -len(".lock")]
+        machine_link = os.path.join(var_machines, machine_uuid)
+        if not os.path.islink(machine_link):
+            continue
+        if not lock_holder_alive(lock_file):
+            continue
+        parent = os.path.realpath(os.path.dirname(os.readlink(machine_link)))
+        active[parent] = active.get(parent, 0) + 1
+    return active
+
+
+def get_volume_status(config, max_age=None):
+    """Return current statistics for all volumes
+
+    Results are cached in var_dir for volume_status_max_age seconds, so
+    repeated placement decisions do not each statvfs every volume.
+    """
+    if max_age is None:
+        max_age = config["volume_status_max_age"]
+    cache_file = os.path.join(config["var_dir"], "volume_status.json")
+    previous = None
+    try:
+        with open(cache_file) as f:
+            previous = json.load(f)
+        if previous.get("volumes", {}).keys() == config["volumes"].keys() and time.time() - previous["time"] < max_age:
+            return previous["volumes"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        previous = None
+
+    now = time.time()
+    diskstats = read_diskstats()
+    active = count_active_jobs(config)
+    volumes = {}
+    for volume_name in config["volumes"]:
+        v = config["volumes"][volume_name]
+        try:
+            sv = os.statvfs(v["path"])
+            st_dev = os.stat(v["path"]).st_dev
+        except OSError:
+            continue
+        s_t = sv.f_bsize * sv.f_blocks / 1048576
+        s_a = sv.f_bsize * sv.f_bavail / 1048576
+        status = {
+            "st_dev": st_dev,
+            "space_total": s_t,
+            "space_available": s_a,
+            "pct_used": (1.0 - float(s_a) / float(s_t)) * 100.0 if s_t else 100.0,
+            "inodes_total": sv.f_files,
+            "inodes_available": sv.f_favail,
+            # Filesystems without fixed inode tables (e.g. btrfs) report 0
+            "pct_inodes_used": (1.0 - float(sv.f_favail) / float(sv.f_files)) * 100.0 if sv.f_files else 0.0,
+            "active_jobs": active.get(os.path.realpath(v["path"]), 0),
+            "sectors_written": diskstats.get((os.major(st_dev), os.minor(st_dev))),
+            "write_bytes_per_sec": None,
+        }
+        if previous and volume_name in previous["volumes"]:
+            prev = previous["volumes"][volume_name]
+            elapsed = now - previous["time"]
+            if status["sectors_written"] is not None and prev.get("sectors_written") is not None and elapsed > 0:
+                status["write_bytes_per_sec"] = max(status["sectors_written"] - prev["sectors_written"], 0) * 512 / elapsed
+        volumes[volume_name] = status
+
+    try:
+        with safe_write(cache_file) as f:
+            json.dump({"time": now, "volumes": volumes}, f, sort_keys=True)
+    except OSError as e:
+        logging.debug("Cannot write volume status cache {}: {}".format(cache_file, e))
+    return volumes
+
+
+def volume_weight(v, status):
+    """Return the placement weight of a volume, or 0 if it cannot accept new machines"""
+    if not v["accept_new"]:
+        return 0
+    if status["pct_used"] > v["accept_new_high_water_pct"]:
+        return 0
+    if status["pct_inodes_used"] > v["accept_new_inodes_high_water_pct"]:
+        return 0
+    weight = status["space_available"]
+    if status["inodes_total"]:
+        weight *= float(status["inodes_available"]) / float(status["inodes_total"])
+    weight /= 1 + status["active_jobs"]
+    if status["write_bytes_per_sec"]:
+        weight /= 1 + status["write_bytes_per_sec"] / v["placement_write_reference"]
+    return weight
+
+
+def get_volume_weights(config, volumes=None):
+    if volumes is None:
+        volumes = get_volume_status(config)
+    weights = {}
+    for volume_name in volumes:
+        weight = volume_weight(config["volumes"][volume_name], volumes[volume_name])
+        if weight > 0:
+            weights[volume_name] = weight
+    return weights
+
+
+def choose_volume(config, volumes=None):
+    """Pick a volume for a new machine, or None if no volume is suitable"""
+    weights = get_volume_weights(config, volumes)
+    if len(weights) == 0:
+        return None
+    return random_weighted(weights)
+
+
+def get_space_totals(config, volumes=None):
+    """Return (space_total, space_available) in MiB, counting each filesystem once"""
+    if volumes is None:
+        volumes = get_volume_status(config)
+    space_total = 0
+    space_available = 0
+    seen_devs = []
+    for volume_name in volumes:
+        v = config["volumes"][volume_name]
+        status = volumes[volume_name]
+        if status["st_dev"] in seen_devs:
+            continue
+        seen_devs.append(status["st_dev"])
+        s_a = status["space_available"]
+        if (not v["accept_new"]) or (status["pct_used"] > v["accept_new_high_water_pct"]):
+            s_a = 0
+        space_total += status["space_total"]
+        space_available += s_a
+    return space_total, space_available
+
+
+def simulate(config, machines, machine_size, machine_inodes, volumes=None):
+    """Replay placement of new machines, returning a count per volume
+
+    Each placed machine is assumed to use machine_size MiB and
+    machine_inodes inodes, and to be running its first backup.
+    """
+    if volumes is None:
+        volumes = get_volume_status(config)
+    volumes = copy.deepcopy(volumes)
+    placed = {volume_name: 0 for volume_name in volumes}
+    for i in range(machines):
+        volume_name = choose_volume(config, volumes)
+        if volume_name is None:
+            break
+        placed[volume_name] += 1
+        for status in volumes.values():
+            if status["st_dev"] != volumes[volume_name]["st_dev"]:
+                continue
+            status["space_available"] = max(status["space_available"] - machine_size, 0)
+            status["pct_used"] = (
+                (1.0 - status["space_available"] / status["space_total"]) * 100.0 if status["space_total"] else 100.0
+            )
+            if status["inodes_total"]:
+                status["inodes_available"] = max(status["inodes_available"] - machine_inodes, 0)
+                status["pct_inodes_used"] = (1.0 - float(status["inodes_available"]) / float(status["inodes_total"])) * 100.0
+        volumes[volume_name]["active_jobs"] += 1
+    return placed
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--simulate", type=int, metavar="MACHINES", help="Simulate placement of this many new machines")
+    parser.add_argument("--machine-size", type=float, default=10240, help="Assumed size of each simulated machine, in MiB")
+    parser.add_argument("--machine-inodes", type=int, default=100000, help="Assumed inodes used by each simulated machine")
+    parser.add_argument("--debug", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+    volumes = get_volume_status(config, max_age=0)
+    weights = get_volume_weights(config, volumes)
+    total_weight = sum(weights.values())
+    for volume_name in sorted(volumes):
+        status = volumes[volume_name]
+        print(
+            "{}: {:.0f}/{:.0f} MiB available ({:.1f}% used), {:.1f}% inodes used, {} active, {} write B/s, weight {:.1f}%".format(
+                volume_name,
+                status["space_available"],
+                status["space_total"],
+                status["pct_used"],
+                status["pct_inodes_used"],
+                status["active_jobs"],
+                "unknown" if status["write_bytes_per_sec"] is None else "{:.0f}".format(status["write_bytes_per_sec"]),
+                weights.get(volume_name, 0) / total_weight * 100.0 if total_weight else 0.0,
+            )
+        )
+
+    if args.simulate:
+        placed = simulate(config, args.simulate, args.machine_size, args.machine_inodes, volumes)
+        print("Simulated placement of {} machines:".format(args.simulate))
+        for volume_name in sorted(placed):
+            print("{}: {}".format(volume_name, placed[volume_name]))
+        if sum(placed.values()) < args.simulate:
+            print("{} machines could not be placed".format(args.simulate - sum(placed.values())))
@@ -0,0 +1,182 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from .admission import get_volume_semaphore
+from .deletion import TreeDeleter
+from .utils import load_config, RuntimeLock
+
+
+def find_delete_trees(volume_path):
+    """Return expired snapshot trees waiting to be removed from a volume
+
+    Trees reached through a symlinked machine or snapshots directory
+    are skipped, so nothing outside the volume is ever removed.
+    """
+    trees = []
+    for tree in glob.glob(os.path.join(glob.escape(volume_path), "*", "*.snapshots", "_delete-*")):
+        snapshots_dir = os.path.dirname(tree)
+        if not os.path.isdir(tree):
+            continue
+        if any(os.path.islink(path) for path in (tree, snapshots_dir, os.path.dirname(snapshots_dir))):
+            continue
+        trees.append(tree)
+    return sorted(trees)
+
+
+class VolumeReaper(threading.Thread):
+    """Remove all pending delete trees on one volume, one at a time"""
+
+    def __init__(self, volume_name, volume_path, ionice_class=None, threads=4, ops_per_sec=None, semaphore=None):
+        super().__init__(name="reaper-{}".format(volume_name))
+        self.volume_name = volume_name
+        self.volume_path = volume_path
+        self.ionice_class = ionice_class
+        self.semaphore = semaphore
+        self.deleter = TreeDeleter(threads=threads, ops_per_sec=ops_per_sec, initializer=self.set_ionice)
+        self.trees = 0
+        self.failures = 0
+        self.entries = 0
+        self.bytes_freed = 0
+        self.inodes_freed = 0
+        self.elapsed = 0.0
+        self.queue_wait = 0.0
+
+    def set_ionice(self):
+        """Set the I/O scheduling class of the calling deletion thread"""
+        if not (self.ionice_class and shutil.which("ionice")):
+            return
+        subprocess.call(["ionice", "-c", str(self.ionice_class), "-p", str(threading.get_native_id())])
+
+    def progress(self, entries, errors, elapsed):
+        logging.info(
+            "{}: {} entries removed in {:.0f}s ({:.0f} entries/s), {} errors".format(
+                self.volume_name, entries, elapsed, entries / elapsed if elapsed else 0, errors
+            )
+        )
+
+    def run(self):
+        for tree in find_delete_trees(self.volume_path):
+            if self.semaphore:
+                try:
+                    self.semaphore.acquire()
+                except TimeoutError as e:
+                    logging.error("{}: {}".format(self.volume_name, e))
+                    self.queue_wait += self.semaphore.wait_time
+                    return
+                self.queue_wait += self.semaphore.wait_time
+                logging.debug("{}: Waited {:.1f}s for a deletion slot".format(self.volume_name, self.semaphore.wait_time))
+            try:
+                self.delete_tree(tree)
+            finally:
+                if self.semaphore:
+                    self.semaphore.release()
+
+    def delete_tree(self, tree):
+        sv_before = os.statvfs(self.volume_path)
+        time_begin = time.time()
+        try:
+            entries, errors, elapsed = self.deleter.delete(tree, progress=self.progress)
+        except OSError as e:
+            entries, errors, elapsed = 0, 1, time.time() - time_begin
+            logging.error("{}: Cannot remove {}: {}".format(self.volume_name, tree, e))
+        sv_after = os.statvfs(self.volume_path)
+        # Other activity on the volume skews these, so never report negative
+        bytes_freed = max((sv_after.f_bfree - sv_before.f_bfree) * sv_after.f_frsize, 0)
+        inodes_freed = max(sv_after.f_ffree - sv_before.f_ffree, 0)
+        self.trees += 1
+        self.entries += entries
+        self.bytes_freed += bytes_freed
+        self.inodes_freed += inodes_freed
+        self.elapsed += elapsed
+        if errors:
+            self.failures += 1
+            logging.error("{}: {} errors removing {}".format(self.volume_name, errors, tree))
+            return
+        logging.info(
+            "{}: Removed {}: {} entries, {} bytes, {} inodes in {:.1f}s ({:.0f} bytes/s, {:.0f} inodes/s)".format(
+                self.volume_name,
+                tree,
+                entries,
+                bytes_freed,
+                inodes_freed,
+                elapsed,
+                bytes_freed / elapsed if elapsed else 0,
+                inodes_freed / elapsed if elapsed else 0,
+            )
+        )
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--debug", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    lock = RuntimeLock(lock_dir=config["lock_dir"])
+
+    # Volumes sharing a filesystem share a worker, so deletions never
+    # compete with each other for the same disks.
+    reapers = []
+    seen_devs = []
+    for volume_name in config["volumes"]:
+        v = config["volumes"][volume_name]
+        try:
+            st_dev = os.stat(v["path"]).st_dev
+        except OSError:
+            continue
+        if st_dev in seen_devs:
+            continue
+        seen_devs.append(st_dev)
+        reapers.append(
+            VolumeReaper(
+                volume_name,
+                v["path"],
+                ionice_class=v["reaper_ionice_class"],
+                threads=v["reaper_threads"],
+                ops_per_sec=v["reaper_ops_per_sec"],
+                semaphore=get_volume_semaphore(config, volume_name, "deletion"),
+            )
+        )
+
+    for reaper in reapers:
+        reaper.start()
+    for reaper in reapers:
+        reaper.join()
+        if reaper.trees:
+            logging.info(
+                "{}: {} trees, {} entries, {} bytes, {} inodes in {:.1f}s ({:.0f} bytes/s, {:.0f} inodes/s), {:.1f}s queued".format(
+                    reaper.volume_name,
+                    reaper.trees,
+                    reaper.entries,
+                    reaper.bytes_freed,
+                    reaper.inodes_freed,
+                    reaper.elapsed,
+                    reaper.bytes_freed / reaper.elapsed if reaper.elapsed else 0,
+                    reaper.inodes_freed / reaper.elapsed if reaper.elapsed else 0,
+                    reaper.queue_wait,
+                )
+            )
+
+    lock.close()
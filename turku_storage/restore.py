@@ -0,0 +1,274 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .catalog import SnapshotCatalog
+from .manifest import count_top_level, get_manifest_file
+from .rsync import RsyncOutput, RSYNC_OUTPUT_ARGS
+from .usage import format_bytes
+from .utils import load_config
+
+
+def get_restore_file(config, machine_uuid):
+    """Return the file recording a machine's active restore tunnel"""
+    return os.path.join(config["var_dir"], "restore", "{}.json".format(machine_uuid))
+
+
+def get_restore_port(config, machine_uuid):
+    """Return the forwarded port of a machine in restore mode, or None"""
+    try:
+        with open(get_restore_file(config, machine_uuid)) as f:
+            restore = json.load(f)
+        port = restore["port"]
+        pid = restore["pid"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    # The ping holding the tunnel must still be running.  It may run as
+    # another user, in which case it cannot be signalled but is alive.
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    except (OSError, TypeError, ValueError):
+        return None
+    return port
+
+
+def count_entries(path):
+    """Return the number of files and directories at or below path"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return 1
+    entries = 1
+    for dirpath, dirnames, filenames in os.walk(path):
+        entries += len(dirnames) + len(filenames)
+    return entries
+
+
+def get_entry_counts(source_dir):
+    """Return (name, number of entries) for each top-level entry of source_dir
+
+    The numbers are counted from the snapshot's manifest where there is
+    one, so a large snapshot is not walked before the restore starts.
+    Otherwise each top-level entry is walked.
+    """
+    names = sorted(os.listdir(source_dir))
+    manifest_file = get_manifest_file(os.path.dirname(source_dir), os.path.basename(source_dir))
+    counts = None
+    if os.path.exists(manifest_file):
+        try:
+            counts = count_top_level(manifest_file)
+        except (OSError, EOFError, ValueError) as e:
+            logging.debug("Cannot count entries from {}: {}".format(manifest_file, e))
+    if counts:
+        return [(name, counts.get(name, 1)) for name in names]
+    return [(name, count_entries(os.path.join(source_dir, name))) for name in names]
+
+
+def split_streams(items, streams):
+    """Split (name, count) items into at most streams lists with similar total counts
+
+    Items are assigned largest first, each to the stream with the
+    lowest total so far.
+    """
+    buckets = [[0, []] for i in range(max(min(streams, len(items)), 1))]
+    for name, count in sorted(items, key=lambda x: (-x[1], x[0])):
+        bucket = min(buckets, key=lambda x: x[0])
+        bucket[0] += count
+        bucket[1].append(name)
+    return [sorted(names) for total, names in buckets if names]
+
+
+class RestoreStream(threading.Thread):
+    """Run one rsync restoring a list of top-level entries"""
+
+    def __init__(self, progress, rsync_args, env):
+        super().__init__()
+        self.progress = progress
+        self.rsync_args = rsync_args
+        self.env = env
+        self.output = RsyncOutput()
+        self.returncode = None
+
+    def run(self):
+        try:
+            proc = subprocess.Popen(
+                self.rsync_args,
+                env=self.env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                errors="replace",
+            )
+        except OSError as e:
+            logging.error("Cannot run rsync: {}".format(e))
+            self.returncode = -1
+            return
+        for line in proc.stdout:
+            file_lines = self.output.file_lines
+            diagnostic = self.output.feed(line)
+            if diagnostic:
+                logging.warning(diagnostic)
+            elif self.output.file_lines > file_lines:
+                self.progress.add(line.rstrip("\n"))
+        self.returncode = proc.wait()
+
+
+class RestoreProgress:
+    """Aggregate progress of all streams, counted from the file names rsync prints"""
+
+    def __init__(self, source_dir, total_entries):
+        self.source_dir = source_dir
+        self.total_entries = total_entries
+        self.entries = 0
+        self.bytes = 0
+        self.time_begin = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        try:
+            st = os.lstat(os.path.join(self.source_dir, name))
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+        except OSError:
+            size = 0
+        with self.lock:
+            self.entries += 1
+            self.bytes += size
+
+    def summary(self):
+        with self.lock:
+            entries, bytes = self.entries, self.bytes
+        elapsed = time.monotonic() - self.time_begin
+        return "{}/{} entries ({:.0f}%), {} in {:.0f}s ({}/s)".format(
+            entries,
+            self.total_entries,
+            entries * 100.0 / self.total_entries if self.total_entries else 100.0,
+            format_bytes(bytes),
+            elapsed,
+            format_bytes(int(bytes / elapsed) if elapsed else 0),
+        )
+
+
+def find_restore_dir(config, machine, source, snapshot=None):
+    """Return (machine UUID, directory to restore) for a machine's source
+
+    Without a snapshot name, the latest snapshot is used, or the
+    working tree of a source which does not keep snapshots.
+    """
+    machine_dir = os.path.realpath(os.path.join(config["var_dir"], "machines", machine))
+    if not os.path.isdir(machine_dir):
+        raise ValueError("Unknown machine {}".format(machine))
+    machine_uuid = os.path.basename(machine_dir)
+    snapshots_dir = os.path.join(machine_dir, "{}.snapshots".format(source))
+    if os.path.isdir(snapshots_dir):
+        catalog = SnapshotCatalog(snapshots_dir)
+        if snapshot is None:
+            found = catalog.latest()
+        else:
+            found = ([x for x in catalog.snapshots() if x["name"] == snapshot] or [None])[0]
+        if found is None:
+            raise ValueError("Snapshot {} not found for {} {}".format(snapshot or "latest", machine, source))
+        return machine_uuid, str(found["directory"])
+    if snapshot is None and os.path.isdir(os.path.join(machine_dir, source)):
+        return machine_uuid, os.path.join(machine_dir, source)
+    raise ValueError("Source {} not found for {}".format(source, machine))
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Restore a snapshot to a machine in restore mode (turku-agent-ping --restore)",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument("--username", "-u", type=str, required=True, help="Restore module username, as shown by the agent")
+    parser.add_argument(
+        "--password-file", type=str, help="File holding the restore module password (default: RSYNC_PASSWORD environment)"
+    )
+    parser.add_argument("--port", type=int, help="Forwarded restore port (default: the active one for the machine)")
+    parser.add_argument("--module", type=str, default="turku-restore", help="Restore rsync module")
+    parser.add_argument("--dest", type=str, default="", help="Path within the restore module to restore to")
+    parser.add_argument("--streams", "-j", type=int, default=4, help="Parallel rsync streams")
+    parser.add_argument("--progress-interval", type=float, default=10.0, help="Seconds between progress reports")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("machine", help="Machine UUID or unit name")
+    parser.add_argument("source", help="Source name")
+    parser.add_argument("snapshot", nargs="?", help="Snapshot name (default: latest)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    try:
+        machine_uuid, source_dir = find_restore_dir(config, args.machine, args.source, args.snapshot)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    port = args.port or get_restore_port(config, machine_uuid)
+    if not port:
+        print("{} is not in restore mode; run turku-agent-ping --restore on it".format(args.machine), file=sys.stderr)
+        sys.exit(1)
+    if args.password_file:
+        with open(args.password_file) as f:
+            password = f.read().strip()
+    elif "RSYNC_PASSWORD" in os.environ:
+        password = os.environ["RSYNC_PASSWORD"]
+    else:
+        print("Restore module password required, in RSYNC_PASSWORD or --password-file", file=sys.stderr)
+        sys.exit(1)
+
+    items = get_entry_counts(source_dir)
+    streams = split_streams(items, args.streams)
+    progress = RestoreProgress(source_dir, sum(count for name, count in items))
+    dest = "rsync://{}@127.0.0.1:{}/{}/{}".format(args.username, port, args.module, args.dest.strip("/"))
+    logging.info("Restoring {} ({} entries) to {} in {} streams".format(source_dir, progress.total_entries, dest, len(streams)))
+
+    workers = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        for i, names in enumerate(streams):
+            files_from = os.path.join(tempdir, "stream{}".format(i))
+            with open(files_from, "w") as f:
+                f.write("".join("{}\n".format(name) for name in names))
+            # --files-from restores the listed top-level entries, relative to source_dir
+            rsync_args = ["rsync", "--archive", "--recursive", "--compress", "--numeric-ids", "--files-from", files_from]
+            rsync_args += RSYNC_OUTPUT_ARGS
+            rsync_args += ["{}/".format(source_dir), "{}/".format(dest.rstrip("/"))]
+            logging.debug("Stream {}: {}".format(i, ", ".join(names)))
+            workers.append(RestoreStream(progress, rsync_args, {"RSYNC_PASSWORD": password}))
+        for worker in workers:
+            worker.start()
+        while True:
+            alive = [worker for worker in workers if worker.is_alive()]
+            if not alive:
+                break
+            alive[0].join(args.progress_interval)
+            if any(worker.is_alive() for worker in workers):
+                logging.info("Progress: {}".format(progress.summary()))
+
+    failed = [worker for worker in workers if worker.returncode not in (0, 24)]
+    transferred_bytes = sum(worker.output.transfer_stats().get("transferred_bytes", 0) for worker in workers)
+    logging.info("Done: {}, {} transferred".format(progress.summary(), format_bytes(transferred_bytes)))
+    if failed:
+        for worker in failed:
+            logging.error("rsync exited with return code {}".format(worker.returncode))
+        sys.exit(1)
@@ -0,0 +1,72 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import os
+import sys
+
+from .catalog import SnapshotCatalog
+from .utils import load_config, RetentionPolicy
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Show which snapshots a retention policy would keep or delete, without deleting anything",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument(
+        "--retention",
+        "-r",
+        type=str,
+        help="Retention string (default: the one recorded with the latest snapshot)",
+    )
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("machine", help="Machine UUID or unit name symlink under var_dir/machines")
+    parser.add_argument("source")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    machine_dir = os.path.join(config["var_dir"], "machines", args.machine)
+    snapshots_dir = os.path.join(machine_dir, "{}.snapshots".format(args.source))
+    if not os.path.isdir(snapshots_dir):
+        print("No snapshots directory for {} {}".format(args.machine, args.source), file=sys.stderr)
+        sys.exit(1)
+
+    snapshots = SnapshotCatalog(os.path.realpath(snapshots_dir)).snapshots()
+    retention = args.retention
+    if retention is None:
+        for snapshot in sorted(snapshots, key=lambda x: x["sync_finish"], reverse=True):
+            if snapshot.get("retention"):
+                retention = snapshot["retention"]
+                break
+    if retention is None:
+        print("No retention recorded for {} {}; use --retention".format(args.machine, args.source), file=sys.stderr)
+        sys.exit(1)
+
+    policy = RetentionPolicy(retention)
+    to_keep, to_delete = policy.evaluate(snapshots)
+    kept = set(id(snapshot) for snapshot in to_keep)
+    print("Retention: {}".format(retention))
+    for snapshot in sorted(snapshots, key=lambda x: x["sync_finish"]):
+        print(
+            "{:6} {} {}".format(
+                "keep" if id(snapshot) in kept else "delete",
+                snapshot["sync_finish"].isoformat(),
+                snapshot["name"],
+            )
+        )
+    print("{} kept, {} to delete".format(len(to_keep), len(to_delete)))
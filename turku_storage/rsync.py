@@ -0,0 +1,157 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import collections
+import re
+
+# Output selection: transferred file names plus the --stats block.
+# --info requires rsync 3.1 or later.
+RSYNC_OUTPUT_ARGS = ["--info=name1,stats2"]
+
+STATS_LINE_RE = re.compile(r"^([A-Z][A-Za-z ]+): ([\d,]+(?:\.\d+)?)(?: [a-z]+)?(?: \((.*)\))?$")
+STATS_BREAKDOWN_RE = re.compile(r"(\w+): ([\d,]+)")
+SENT_RECEIVED_RE = re.compile(r"^sent ([\d,]+) bytes\s+received ([\d,]+) bytes\s+([\d,.]+) bytes/sec$")
+TOTAL_SPEEDUP_RE = re.compile(r"^total size is ([\d,]+)\s+speedup is ([\d,.]+)")
+DIAGNOSTIC_PREFIXES = ("rsync:", "rsync error:", "rsync warning:", "file has vanished:", "@ERROR", "ERROR:", "WARNING:")
+NOISE_LINES = ("sending incremental file list", "receiving incremental file list", "receiving file list ... done", "")
+
+
+def parse_number(s):
+    s = s.replace(",", "")
+    return float(s) if "." in s else int(s)
+
+
+def stats_key(s):
+    return re.sub(r"[^a-z0-9]+", "_", s.lower()).strip("_")
+
+
+class RsyncOutput:
+    """Streaming processor for rsync output
+
+    Summary statistics are parsed into the stats dict.  Diagnostic lines
+    (errors and warnings) are returned to the caller to be logged right
+    away, while per-file lines only go to a bounded ring buffer, which
+    can be dumped if the sync fails.
+    """
+
+    def __init__(self, buffer_lines=100):
+        self.stats = {}
+        self.file_lines = 0
+        self.buffer = collections.deque(maxlen=buffer_lines)
+
+    def feed(self, line):
+        """Process one output line, returning it if it should be logged"""
+        line = line.rstrip("\n")
+        if line.startswith(DIAGNOSTIC_PREFIXES):
+            self.buffer.append(line)
+            return line
+        if line in NOISE_LINES:
+            return None
+        m = SENT_RECEIVED_RE.match(line)
+        if m:
+            self.stats["sent_bytes"] = parse_number(m.group(1))
+            self.stats["received_bytes"] = parse_number(m.group(2))
+            self.stats["bytes_per_sec"] = float(parse_number(m.group(3)))
+            return None
+        m = TOTAL_SPEEDUP_RE.match(line)
+        if m:
+            self.stats["total_size"] = parse_number(m.group(1))
+            self.stats["speedup"] = float(parse_number(m.group(2)))
+            return None
+        m = STATS_LINE_RE.match(line)
+        if m:
+            key = stats_key(m.group(1))
+            self.stats[key] = parse_number(m.group(2))
+            if m.group(3):
+                for k, v in STATS_BREAKDOWN_RE.findall(m.group(3)):
+                    self.stats["{}_{}".format(key, stats_key(k))] = parse_number(v)
+            return None
+        self.file_lines += 1
+        self.buffer.append(line)
+        return None
+
+    def transfer_stats(self, link_dest=False, resumed=False):
+        """Return normalized transfer statistics for metadata and the API
+
+        With --link-dest, every regular file which was not transferred was
+        hard-linked from a base snapshot; otherwise it was left in place.
+        A resumed sync also leaves in place the files an earlier attempt
+        transferred, which cannot be told apart from linked ones, so
+        then nothing is reported as linked.
+        """
+        transfer = {}
+        for key, stats_key in (
+            ("files", "number_of_files"),
+            ("regular_files", "number_of_files_reg"),
+            ("transferred_files", "number_of_regular_files_transferred"),
+            ("created_files", "number_of_created_files"),
+            ("deleted_files", "number_of_deleted_files"),
+            ("total_bytes", "total_file_size"),
+            ("transferred_bytes", "total_transferred_file_size"),
+            ("literal_bytes", "literal_data"),
+            ("matched_bytes", "matched_data"),
+            ("sent_bytes", "total_bytes_sent"),
+            ("received_bytes", "total_bytes_received"),
+            ("file_list_generation_time", "file_list_generation_time"),
+            ("file_list_transfer_time", "file_list_transfer_time"),
+        ):
+            if stats_key in self.stats:
+                transfer[key] = self.stats[stats_key]
+        if "regular_files" not in transfer and "files" in transfer and "number_of_files_dir" not in self.stats:
+            transfer["regular_files"] = transfer["files"]
+        if "regular_files" in transfer and "transferred_files" in transfer:
+            transfer["copied_files"] = transfer["transferred_files"]
+        if resumed:
+            return transfer
+        if "regular_files" in transfer and "transferred_files" in transfer:
+            transfer["linked_files"] = (transfer["regular_files"] - transfer["transferred_files"]) if link_dest else 0
+        if "total_bytes" in transfer and "transferred_bytes" in transfer:
+            transfer["linked_bytes"] = (transfer["total_bytes"] - transfer["transferred_bytes"]) if link_dest else 0
+        return transfer
+
+    def discount_dirs(self, keep=0):
+        """Stop counting directories which another rsync of the same transfer already counted
+
+        The first keep directories, such as the top directory of the
+        transfer, stay counted.
+        """
+        dirs = max(self.stats.get("number_of_files_dir", 0) - keep, 0)
+        for key in ("number_of_files", "number_of_files_dir"):
+            if key in self.stats:
+                self.stats[key] -= dirs
+
+    @classmethod
+    def merge(cls, outputs):
+        """Combine the output of several rsyncs which together made one transfer"""
+        merged = cls()
+        for output in outputs:
+            merged.file_lines += output.file_lines
+            merged.buffer.extend(output.buffer)
+            for k, v in output.stats.items():
+                if k != "speedup":
+                    merged.stats[k] = merged.stats.get(k, 0) + v
+        if merged.stats.get("total_size") and merged.stats.get("sent_bytes", 0) + merged.stats.get("received_bytes", 0):
+            merged.stats["speedup"] = round(
+                merged.stats["total_size"] / (merged.stats.get("sent_bytes", 0) + merged.stats.get("received_bytes", 0)), 2
+            )
+        return merged
+
+    def summary(self):
+        """Return a short human-readable summary of the parsed statistics"""
+        parts = []
+        for key, label in (
+            ("number_of_files", "files"),
+            ("number_of_regular_files_transferred", "transferred"),
+            ("total_bytes_sent", "bytes sent"),
+            ("total_bytes_received", "bytes received"),
+            ("literal_data", "literal"),
+            ("matched_data", "matched"),
+            ("speedup", "speedup"),
+        ):
+            if key in self.stats:
+                parts.append("{}: {}".format(label, self.stats[key]))
+        return ", ".join(parts)
@@ -0,0 +1,374 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import abc
+import fcntl
+import json
+import logging
+import os
+import stat
+import uuid
+
+from .catalog import SnapshotCatalog
+from .manifest import get_manifest_file, write_manifest
+from .timing import span
+from .utils import compile_retention, get_snapshots_to_delete, safe_write
+
+# From linux/fs.h; only exposed by the fcntl module from Python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+# rsync accepts at most this many --link-dest directories
+MAX_LINK_DEST = 20
+# Relative to the destination; rsync protects it from --delete
+PARTIAL_DIR = ".turku-partial"
+
+
+def clone_file(src, dst):
+    """Create dst as a copy-on-write clone of the regular file src"""
+    with open(src, "rb") as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+        finally:
+            os.close(fd)
+
+
+def copy_metadata(st, dst, chown=False):
+    if chown:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    # chmod() on a symlink is not supported on Linux, and is meaningless anyway
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def clone_tree(src, dst, clone=clone_file):
+    """Recreate the tree src at dst, cloning each regular file
+
+    Hard links within src are kept as hard links.  Ownership is only
+    copied when running as root, as with rsync.
+    """
+    chown = os.geteuid() == 0
+    inodes = {}
+    os.mkdir(dst, 0o700)
+    dirs = [(src, dst)]
+    done_dirs = []
+    while dirs:
+        src_dir, dst_dir = dirs.pop()
+        done_dirs.append((src_dir, dst_dir))
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                dst_path = os.path.join(dst_dir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    os.mkdir(dst_path, 0o700)
+                    dirs.append((entry.path, dst_path))
+                    continue
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in inodes:
+                        os.link(inodes[(st.st_dev, st.st_ino)], dst_path, follow_symlinks=False)
+                        continue
+                    inodes[(st.st_dev, st.st_ino)] = dst_path
+                if stat.S_ISREG(st.st_mode):
+                    clone(entry.path, dst_path)
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(entry.path), dst_path)
+                else:
+                    os.mknod(dst_path, st.st_mode, st.st_rdev)
+                copy_metadata(st, dst_path, chown)
+    # Directory mtimes are set last, as populating a directory changes them
+    for src_dir, dst_dir in reversed(done_dirs):
+        copy_metadata(os.lstat(src_dir), dst_dir, chown)
+
+
+def select_bases(snapshots, count=1, retention=None):
+    """Return the snapshots to pass to rsync --link-dest, newest first
+
+    These are the latest count snapshots, followed by the snapshots the
+    retention policy keeps if one is given, up to MAX_LINK_DEST.  rsync
+    links a file from the first of them holding an identical copy, so
+    a file which reverted to an older version is still linked.
+    """
+    snapshots = sorted(snapshots, key=lambda x: x["sync_finish"], reverse=True)
+    bases = snapshots[: max(count, 1)]
+    if retention:
+        to_keep = compile_retention(retention).evaluate(snapshots)[0]
+        names = set(snapshot["name"] for snapshot in bases)
+        for snapshot in to_keep:
+            if len(bases) >= MAX_LINK_DEST:
+                break
+            if snapshot["name"] not in names:
+                names.add(snapshot["name"])
+                bases.append(snapshot)
+    return bases[:MAX_LINK_DEST]
+
+
+class SnapshotBackend:
+    """Snapshot handling for a single source
+
+    prepare() is called before rsync runs and returns extra rsync
+    arguments.  After a successful sync, create() turns the synced tree
+    into a snapshot and returns its name, and expire() applies a
+    retention policy, returning the snapshots it removed.  After a
+    failed sync, failed() records what the next attempt needs to resume,
+    returning whether it will.
+    With manifests, a manifest of each new snapshot is written next to
+    its metadata.  A catalogs dict, keyed by snapshots directory, keeps
+    catalogs in memory between backups.
+    """
+
+    keeps_snapshots = False
+
+    def __init__(
+        self,
+        machine_dir,
+        source_name,
+        timeline=None,
+        link_dest_bases=1,
+        link_dest_retention=None,
+        resume=False,
+        manifests=False,
+        catalogs=None,
+    ):
+        self.source_name = source_name
+        self.timeline = timeline
+        self.link_dest_bases = link_dest_bases
+        self.link_dest_retention = link_dest_retention
+        self.resume = resume
+        self.manifests = manifests
+        self.catalogs = catalogs
+        self.dest_dir = os.path.join(machine_dir, source_name)
+        self.snapshot_dir = os.path.join(machine_dir, "%s.snapshots" % source_name)
+        self.resume_file = os.path.join(machine_dir, "%s.resume.json" % source_name)
+        self.catalog = None
+        self.base_snapshot = None
+        self.base_snapshots = []
+        self.attempts = 1
+        self.resume_state = None
+
+    def prepare(self):
+        return []
+
+    def create(self, sync_begin, sync_finish, info):
+        return None
+
+    def failed(self):
+        return False
+
+    def update_info(self, snapshot_name, info):
+        pass
+
+    def expire(self, retention):
+        return []
+
+
+class InplaceBackend(SnapshotBackend):
+    """Sync in place, keeping no history
+
+    --inplace keeps partially transferred data, so an interrupted sync
+    always resumes where it stopped.
+    """
+
+    def prepare(self):
+        return ["--inplace"]
+
+
+class SnapshotDirBackend(SnapshotBackend, abc.ABC):
+    """Base for backends keeping snapshots in <source>.snapshots
+
+    Subclasses must implement make_snapshot().
+    """
+
+    keeps_snapshots = True
+
+    def prepare(self):
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        if self.catalogs is None:
+            self.catalog = SnapshotCatalog(self.snapshot_dir)
+        else:
+            if self.snapshot_dir not in self.catalogs:
+                self.catalogs[self.snapshot_dir] = SnapshotCatalog(self.snapshot_dir)
+            self.catalog = self.catalogs[self.snapshot_dir]
+            self.catalog.refresh()
+        self.resume_state = self.load_resume_state()
+        if self.resume_state:
+            self.attempts = self.resume_state["attempts"] + 1
+        return []
+
+    def load_resume_state(self):
+        """Return the state recorded by failed(), if any"""
+        if not self.resume:
+            return None
+        try:
+            with open(self.resume_file) as f:
+                state = json.load(f)
+            state["attempts"] = int(state["attempts"])
+            state["bases"] = list(state["bases"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return state
+
+    def failed(self):
+        if not self.resume:
+            return False
+        with safe_write(self.resume_file) as f:
+            json.dump(
+                {"attempts": self.attempts, "bases": [snapshot["name"] for snapshot in self.base_snapshots]},
+                f,
+                sort_keys=True,
+            )
+        return True
+
+    def clear_resume_state(self):
+        if os.path.exists(self.resume_file):
+            os.unlink(self.resume_file)
+
+    @abc.abstractmethod
+    def make_snapshot(self, snapshot_path):
+        """Create snapshot_path from the synced tree"""
+
+    def create(self, sync_begin, sync_finish, info):
+        snapshot_name = "{}_{}_{}".format(
+            self.source_name,
+            sync_finish.strftime("%Y%m%d-%H%M%S"),
+            str(uuid.uuid4())[0:4],
+        )
+        info_out = {
+            "name": snapshot_name,
+            "base": (self.base_snapshot["name"] if self.base_snapshot else None),
+            "bases": [snapshot["name"] for snapshot in self.base_snapshots],
+            "sync_begin": sync_begin.isoformat(),
+            "sync_finish": sync_finish.isoformat(),
+            "attempts": self.attempts,
+        }
+        info_out.update(info)
+        # The metadata is written before the directory is moved into
+        # place, so the catalog never sees a snapshot without it.
+        info_file = os.path.join(self.snapshot_dir, "{}.json".format(snapshot_name))
+        with span(self.timeline, "metadata_write"):
+            with open(info_file, "w") as f:
+                json.dump(info_out, f, sort_keys=True, indent=4)
+        try:
+            with span(self.timeline, "snapshot_create"):
+                self.make_snapshot(os.path.join(self.snapshot_dir, snapshot_name))
+        except Exception:
+            os.unlink(info_file)
+            raise
+        if self.manifests:
+            with span(self.timeline, "manifest_write"):
+                try:
+                    write_manifest(
+                        os.path.join(self.snapshot_dir, snapshot_name), get_manifest_file(self.snapshot_dir, snapshot_name)
+                    )
+                except OSError as e:
+                    # The snapshot itself is complete; it is only missing from turku-storage-find
+                    logging.warning("Cannot write manifest of snapshot {}: {}".format(snapshot_name, e))
+        latest_link = os.path.join(self.snapshot_dir, "latest")
+        if os.path.islink(latest_link):
+            os.unlink(latest_link)
+        if not os.path.exists(latest_link):
+            os.symlink(snapshot_name, latest_link)
+        self.catalog.add(snapshot_name)
+        self.clear_resume_state()
+        return snapshot_name
+
+    def update_info(self, snapshot_name, info):
+        """Merge info into the metadata of a snapshot made by create()"""
+        if not os.path.isdir(os.path.join(self.snapshot_dir, snapshot_name)):
+            # Removed by retention
+            return
+        info_file = os.path.join(self.snapshot_dir, "{}.json".format(snapshot_name))
+        with open(info_file) as f:
+            info_out = json.load(f)
+        info_out.update(info)
+        with safe_write(info_file) as f:
+            json.dump(info_out, f, sort_keys=True, indent=4)
+        self.catalog.update({snapshot_name: info})
+
+    def expire(self, retention):
+        with span(self.timeline, "retention_evaluation"):
+            to_delete = get_snapshots_to_delete(retention, self.catalog.snapshots())
+        with span(self.timeline, "deletion"):
+            for snapshot in to_delete:
+                # Only rename here; the tree itself is removed later by
+                # turku-storage-reaper, so the agent is not kept waiting.
+                temp_delete_tree = snapshot["directory"].parent.joinpath("_delete-{}".format(snapshot["directory"].parts[-1]))
+                if snapshot["info_file"] and snapshot["info_file"].exists():
+                    snapshot["info_file"].unlink()
+                manifest_file = get_manifest_file(snapshot["directory"].parent, snapshot["name"])
+                if os.path.exists(manifest_file):
+                    os.unlink(manifest_file)
+                snapshot["directory"].rename(temp_delete_tree)
+            self.catalog.remove(*[snapshot["directory"].name for snapshot in to_delete])
+        return to_delete
+
+
+class LinkDestBackend(SnapshotDirBackend):
+    """Hard-link unchanged files against earlier snapshots with rsync --link-dest
+
+    By default only the latest snapshot is used; link_dest_bases and
+    link_dest_retention select more, as in select_bases().  With resume,
+    partially transferred files are kept in PARTIAL_DIR, and a sync
+    resuming after a failure reuses the bases of the failed attempt.
+    """
+
+    def prepare(self):
+        rsync_args = super().prepare()
+        if self.resume:
+            rsync_args.append("--partial-dir={}".format(PARTIAL_DIR))
+        snapshots = self.catalog.snapshots()
+        self.base_snapshots = []
+        if self.resume_state:
+            by_name = {snapshot["name"]: snapshot for snapshot in snapshots}
+            if all(name in by_name for name in self.resume_state["bases"]):
+                self.base_snapshots = [by_name[name] for name in self.resume_state["bases"]]
+        if not self.base_snapshots:
+            self.base_snapshots = select_bases(snapshots, self.link_dest_bases, self.link_dest_retention)
+        self.base_snapshot = self.base_snapshots[0] if self.base_snapshots else None
+        for snapshot in self.base_snapshots:
+            rsync_args.append("--link-dest={}".format(snapshot["directory"]))
+        return rsync_args
+
+    def make_snapshot(self, snapshot_path):
+        os.rename(self.dest_dir, snapshot_path)
+
+
+class ReflinkBackend(SnapshotDirBackend):
+    """Sync in place, then reflink-clone the working tree into a snapshot
+
+    Requires a filesystem supporting FICLONE, such as XFS or btrfs.
+    Files which change in place only cost the changed extents per
+    snapshot.
+    """
+
+    def prepare(self):
+        return super().prepare() + ["--inplace"]
+
+    def make_snapshot(self, snapshot_path):
+        # Clone under a name the catalog ignores, so a partial clone is
+        # never mistaken for a snapshot
+        clone_path = os.path.join(self.snapshot_dir, "_clone-{}".format(os.path.basename(snapshot_path)))
+        try:
+            clone_tree(self.dest_dir, clone_path)
+        except OSError:
+            if os.path.lexists(clone_path):
+                logging.warning("Snapshot clone failed, leaving {} for turku-storage-reaper".format(clone_path))
+                os.rename(clone_path, os.path.join(self.snapshot_dir, "_delete-{}".format(os.path.basename(clone_path))))
+            raise
+        os.rename(clone_path, snapshot_path)
+
+
+SNAPSHOT_BACKENDS = {
+    "link-dest": LinkDestBackend,
+    "reflink": ReflinkBackend,
+    "none": InplaceBackend,
+}
+
+
+def get_snapshot_backend(snapshot_mode, machine_dir, source_name, **kwargs):
+    """Return the backend for a snapshot mode; unknown modes sync in place, as "none" """
+    return SNAPSHOT_BACKENDS.get(snapshot_mode, InplaceBackend)(machine_dir, source_name, **kwargs)
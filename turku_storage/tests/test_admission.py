@@ -0,0 +1,99 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from turku_storage import admission
+
+
+class TestVolumeSemaphore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def semaphore(self, slots=1, timeout=None):
+        semaphore = admission.VolumeSemaphore("vol", "rsync", slots, self.tempdir.name, timeout=timeout)
+        semaphore.poll_interval = 0.01
+        return semaphore
+
+    def test_slots(self):
+        first = self.semaphore(2)
+        second = self.semaphore(2)
+        third = self.semaphore(2, timeout=0.05)
+        first.acquire()
+        second.acquire()
+        with self.assertRaises(TimeoutError):
+            third.acquire()
+        self.assertGreaterEqual(third.wait_time, 0.05)
+        first.release()
+        third.acquire()
+        second.release()
+        third.release()
+        self.assertEqual([fn for fn in os.listdir(third.dir) if fn.startswith("wait.")], [])
+
+    def test_multiple_slots(self):
+        single = self.semaphore(3)
+        single.acquire()
+        sharded = self.semaphore(3, timeout=0.05)
+        # All or nothing: two of three free slots are not taken
+        with self.assertRaises(TimeoutError):
+            sharded.acquire(3)
+        self.assertEqual(sharded.slot_fhs, [])
+        # Capped at the number of slots
+        single.release()
+        sharded.acquire(5)
+        self.assertEqual(len(sharded.slot_fhs), 3)
+        with self.assertRaises(TimeoutError):
+            self.semaphore(3, timeout=0.05).acquire()
+        sharded.release()
+
+    def test_fifo(self):
+        holder = self.semaphore()
+        holder.acquire()
+        order = []
+        threads = []
+
+        def waiter(i):
+            with self.semaphore():
+                order.append(i)
+
+        for i in range(5):
+            threads.append(threading.Thread(target=waiter, args=(i,)))
+            threads[-1].start()
+            # Wait for the thread to take its ticket
+            while len([fn for fn in os.listdir(holder.dir) if fn.startswith("wait.")]) <= i:
+                time.sleep(0.01)
+        holder.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, list(range(5)))
+
+    def test_stale_waiter(self):
+        semaphore = self.semaphore()
+        os.makedirs(semaphore.dir)
+        # A waiter which exited without cleaning up holds no lock
+        with open(os.path.join(semaphore.dir, "queue"), "w") as f:
+            f.write("1\n")
+        open(semaphore.wait_file(0), "w").close()
+        semaphore.timeout = 1
+        semaphore.acquire()
+        semaphore.release()
+        self.assertFalse(os.path.exists(semaphore.wait_file(0)))
+
+    def test_get_volume_semaphore(self):
+        config = {
+            "lock_dir": self.tempdir.name,
+            "volumes": {"vol": {"max_concurrent_rsyncs": 2, "max_concurrent_deletions": None, "admission_timeout": 10}},
+        }
+        semaphore = admission.get_volume_semaphore(config, "vol", "rsync")
+        self.assertEqual((semaphore.slots, semaphore.timeout), (2, 10))
+        self.assertIsNone(admission.get_volume_semaphore(config, "vol", "deletion"))
+        self.assertIsNone(admission.get_volume_semaphore(config, None, "rsync"))
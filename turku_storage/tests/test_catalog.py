@@ -0,0 +1,135 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import catalog, utils
+
+
+class TestSnapshotCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.snapshots_dir = pathlib.Path(self.tempdir.name).joinpath("src.snapshots")
+        self.snapshots_dir.mkdir()
+        self.make_snapshot("2015-02-20T03:20:36")
+        self.make_snapshot("src_20150221-000000_abcd", sync_finish="2015-02-21T00:00:00+00:00")
+        self.snapshots_dir.joinpath("latest").symlink_to("src_20150221-000000_abcd")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_snapshot(self, name, sync_finish=None):
+        if sync_finish:
+            with self.snapshots_dir.joinpath("{}.json".format(name)).open("w") as f:
+                json.dump({"name": name, "sync_finish": sync_finish}, f)
+        self.snapshots_dir.joinpath(name).mkdir()
+
+    def names(self, snapshots):
+        return sorted(s["name"] for s in snapshots)
+
+    def test_matches_directory_scan(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        self.assertEqual(c.snapshots(), utils.get_snapshots_from_dir(self.snapshots_dir))
+        self.assertTrue(c.catalog_file.exists())
+        self.assertEqual(c.latest()["name"], "src_20150221-000000_abcd")
+
+    def test_fresh_catalog_not_rescanned(self):
+        catalog.SnapshotCatalog(self.snapshots_dir).load()
+        with unittest.mock.patch.object(catalog, "get_snapshot_from_dir") as mock_get:
+            snapshots = catalog.SnapshotCatalog(self.snapshots_dir).snapshots()
+        mock_get.assert_not_called()
+        self.assertEqual(len(snapshots), 2)
+
+    def test_stale_catalog_reconciled(self):
+        catalog.SnapshotCatalog(self.snapshots_dir).load()
+        self.make_snapshot("src_20150222-000000_abcd", sync_finish="2015-02-22T00:00:00+00:00")
+        os.rmdir(self.snapshots_dir.joinpath("2015-02-20T03:20:36"))
+        with unittest.mock.patch.object(catalog, "get_snapshot_from_dir", wraps=utils.get_snapshot_from_dir) as mock_get:
+            snapshots = catalog.SnapshotCatalog(self.snapshots_dir).snapshots()
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(self.names(snapshots), ["src_20150221-000000_abcd", "src_20150222-000000_abcd"])
+
+    def test_corrupt_catalog_rebuilt(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.catalog_file.write_text("{")
+        self.assertEqual(len(c.snapshots()), 2)
+
+    def test_add_remove(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.load()
+        self.make_snapshot("src_20150222-000000_abcd", sync_finish="2015-02-22T00:00:00+00:00")
+        c.add("src_20150222-000000_abcd")
+        self.snapshots_dir.joinpath("2015-02-20T03:20:36").rename(self.snapshots_dir.joinpath("_delete-2015-02-20T03:20:36"))
+        c.remove("2015-02-20T03:20:36")
+        # Only the name this process did not record is examined
+        with unittest.mock.patch.object(catalog, "get_snapshot_from_dir", wraps=utils.get_snapshot_from_dir) as mock_get:
+            snapshots = catalog.SnapshotCatalog(self.snapshots_dir).snapshots()
+        self.assertEqual(
+            [call.args[0].name for call in mock_get.call_args_list], ["_delete-2015-02-20T03:20:36"]
+        )
+        self.assertEqual(self.names(snapshots), ["src_20150221-000000_abcd", "src_20150222-000000_abcd"])
+
+    def test_add_after_external_change(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.load()
+        # Another process changes the directory after the load
+        other = catalog.SnapshotCatalog(self.snapshots_dir)
+        other.load()
+        with utils.safe_write(str(self.snapshots_dir.joinpath("src_20150221-000000_abcd.json"))) as f:
+            json.dump({"name": "src_20150221-000000_abcd", "sync_finish": "2015-02-21T00:00:00+00:00", "usage": {}}, f)
+        other.add("src_20150221-000000_abcd")
+        os.rmdir(self.snapshots_dir.joinpath("2015-02-20T03:20:36"))
+        self.make_snapshot("src_20150222-000000_abcd", sync_finish="2015-02-22T00:00:00+00:00")
+        self.make_snapshot("src_20150223-000000_abcd", sync_finish="2015-02-23T00:00:00+00:00")
+        c.add("src_20150223-000000_abcd")
+        snapshots = catalog.SnapshotCatalog(self.snapshots_dir).snapshots()
+        self.assertEqual(
+            self.names(snapshots),
+            ["src_20150221-000000_abcd", "src_20150222-000000_abcd", "src_20150223-000000_abcd"],
+        )
+        self.assertEqual(snapshots[0]["usage"], {})
+
+    def test_racy_timestamp(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.load()
+        # A snapshot created in the same timestamp tick as the listing
+        mtime_ns = os.stat(self.snapshots_dir).st_mtime_ns
+        self.make_snapshot("src_20150222-000000_abcd", sync_finish="2015-02-22T00:00:00+00:00")
+        os.utime(self.snapshots_dir, ns=(mtime_ns, mtime_ns))
+        self.assertIn("src_20150222-000000_abcd", self.names(catalog.SnapshotCatalog(self.snapshots_dir).snapshots()))
+
+        # Once the listing is well after the last change, the catalog is trusted
+        os.utime(self.snapshots_dir, ns=(mtime_ns - catalog.RACY_NS, mtime_ns - catalog.RACY_NS))
+        catalog.SnapshotCatalog(self.snapshots_dir).load()
+        with unittest.mock.patch.object(catalog.os, "listdir") as mock_listdir:
+            catalog.SnapshotCatalog(self.snapshots_dir).load()
+        mock_listdir.assert_not_called()
+
+    def test_sidecar_changed(self):
+        catalog.SnapshotCatalog(self.snapshots_dir).load()
+        with utils.safe_write(str(self.snapshots_dir.joinpath("src_20150221-000000_abcd.json"))) as f:
+            json.dump({"sync_finish": "2015-02-21T00:00:00+00:00", "attempts": 2}, f)
+        self.assertEqual(catalog.SnapshotCatalog(self.snapshots_dir).latest()["attempts"], 2)
+
+    def test_updates_not_relisted(self):
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.load()
+        self.make_snapshot("src_20150222-000000_abcd", sync_finish="2015-02-22T00:00:00+00:00")
+        self.snapshots_dir.joinpath("2015-02-20T03:20:36").rename(self.snapshots_dir.joinpath("2015-02-20T03:20:37"))
+        with unittest.mock.patch.object(catalog.os, "listdir") as mock_listdir:
+            with unittest.mock.patch.object(c, "save", wraps=c.save) as mock_save:
+                c.add("src_20150222-000000_abcd")
+                c.rename("2015-02-20T03:20:36", "2015-02-20T03:20:37")
+                c.remove("src_20150221-000000_abcd")
+        mock_listdir.assert_not_called()
+        self.assertEqual(mock_save.call_count, 3)
+        self.assertEqual(self.names(c.snapshots()), ["2015-02-20T03:20:37", "src_20150222-000000_abcd"])
@@ -0,0 +1,108 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from turku_storage import daemon, ping, utils
+
+
+def checkin(self, cmd, post_data, idempotent=False):
+    return {"machine": {"uuid": post_data["machine"]["uuid"], "unit_name": "m1", "scheduled_sources": {}}}
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        tempdir = self.tempdir.name
+        self.config_dir = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(self.config_dir, "config.d"))
+        self.socket_file = os.path.join(tempdir, "daemon.sock")
+        with open(os.path.join(self.config_dir, "config.d", "config.json"), "w") as f:
+            json.dump(
+                {
+                    "name": "primary",
+                    "secret": "secret",
+                    "api_url": "https://example.com/",
+                    "volumes": {"default": {"path": tempdir}},
+                    "var_dir": tempdir,
+                    "lock_dir": tempdir,
+                    "log_file": os.path.join(tempdir, "ping.log"),
+                    "ssh_ping_host": "storage.example.com",
+                    "ssh_ping_host_keys": [],
+                    "daemon_socket": self.socket_file,
+                },
+                f,
+            )
+        for patcher in (
+            unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var")),
+            unittest.mock.patch.object(utils.ApiClient, "call", checkin),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.daemon = daemon.StorageDaemon(self.config_dir)
+        self.daemon.load_config()
+        threading.Thread(target=self.daemon.serve, args=(self.socket_file,), daemon=True).start()
+        for i in range(100):
+            if os.path.exists(self.socket_file):
+                break
+            time.sleep(0.01)
+
+    def ping(self, uuid, jsonin):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            returncode = ping.ping_daemon(self.socket_file, uuid, jsonin)
+        return returncode, stderr.getvalue()
+
+    def test_ping(self):
+        returncode, stderr = self.ping("u1", '{"port": 1, "verbose": true}\n')
+        self.assertEqual(returncode, 0)
+        self.assertIn("INFO: No sources to back up now", stderr)
+        returncode, stderr = self.ping("u2", '{"port": 1}\n')
+        self.assertEqual((returncode, stderr), (0, ""))
+        # The API client is reused between jobs
+        self.assertEqual(len(self.daemon.api_clients), 1)
+        with open(os.path.join(self.tempdir.name, "ping.log")) as f:
+            self.assertIn(") u2: No sources to back up now", f.read())
+
+    def test_ping_error(self):
+        returncode, stderr = self.ping("u1", "not json\n")
+        self.assertEqual(returncode, 1)
+        self.assertIn("ERROR: Invalid input JSON", stderr)
+
+    def test_ping_locked(self):
+        # The daemon's threads are excluded by a machine's lock like separate pings
+        lock = utils.RuntimeLock(name="turku-storage-ping-u1", lock_dir=self.tempdir.name)
+        try:
+            returncode, stderr = self.ping("u1", '{"port": 1}\n')
+        finally:
+            lock.close()
+        self.assertEqual(returncode, 1)
+        self.assertIn("Resource temporarily unavailable", stderr)
+
+    def test_log_handler_stalled(self):
+        conn, client = socket.socketpair()
+        self.addCleanup(conn.close)
+        self.addCleanup(client.close)
+        lh = daemon.ConnectionLogHandler(conn, timeout=0.1)
+        # The client never reads, so the socket buffer fills
+        while lh.connected:
+            lh.send({"log": "x" * 65536})
+        lh.send({"returncode": 0})
+
+    def test_no_daemon(self):
+        self.assertIsNone(ping.ping_daemon(os.path.join(self.tempdir.name, "missing.sock"), "u1", "{}"))
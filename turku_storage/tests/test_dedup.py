@@ -0,0 +1,88 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+
+from turku_storage import dedup
+
+
+class TestDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.index_file = os.path.join(self.tempdir.name, "dedup.sqlite")
+
+    def make_file(self, path, data, mtime=1000000000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def run_dedup(self, *snapshot_dirs, **kwargs):
+        index = dedup.DedupIndex(self.index_file)
+        deduplicator = dedup.Deduplicator(index, **kwargs)
+        for snapshot_dir in snapshot_dirs:
+            deduplicator.scan(snapshot_dir)
+        index.prune(deduplicator.seen)
+        index.close()
+        return deduplicator
+
+    def test_dedup(self):
+        a = os.path.join(self.tempdir.name, "a")
+        b = os.path.join(self.tempdir.name, "b")
+        self.make_file(os.path.join(a, "etc", "same"), "same data")
+        self.make_file(os.path.join(b, "etc", "same"), "same data")
+        self.make_file(os.path.join(a, "etc", "other_mtime"), "same data", mtime=1000000001)
+        self.make_file(os.path.join(b, "etc", "other_mtime"), "same data", mtime=1000000002)
+        self.make_file(os.path.join(a, "etc", "other_data"), "data one")
+        self.make_file(os.path.join(b, "etc", "other_data"), "data two")
+        os.utime(os.path.join(b, "etc"), (1000000000, 1000000000))
+
+        deduplicator = self.run_dedup(a, b)
+        self.assertEqual(deduplicator.linked_files, 1)
+        self.assertEqual(deduplicator.hashed_files, 6)
+        self.assertEqual(os.stat(os.path.join(a, "etc", "same")).st_ino, os.stat(os.path.join(b, "etc", "same")).st_ino)
+        for name in ("other_mtime", "other_data"):
+            self.assertNotEqual(os.stat(os.path.join(a, "etc", name)).st_ino, os.stat(os.path.join(b, "etc", name)).st_ino)
+        self.assertEqual(os.stat(os.path.join(b, "etc")).st_mtime, 1000000000)
+        self.assertEqual(sorted(os.listdir(os.path.join(b, "etc"))), ["other_data", "other_mtime", "same"])
+
+        # Unchanged inodes are not hashed again
+        c = os.path.join(self.tempdir.name, "c")
+        self.make_file(os.path.join(c, "etc", "same"), "same data")
+        deduplicator = self.run_dedup(a, b, c)
+        self.assertEqual((deduplicator.hashed_files, deduplicator.linked_files), (1, 1))
+        self.assertEqual(os.stat(os.path.join(c, "etc", "same")).st_nlink, 3)
+
+    def test_dry_run(self):
+        a = os.path.join(self.tempdir.name, "a")
+        b = os.path.join(self.tempdir.name, "b")
+        self.make_file(os.path.join(a, "same"), "same data")
+        self.make_file(os.path.join(b, "same"), "same data")
+        deduplicator = self.run_dedup(a, b, dry_run=True)
+        self.assertEqual(deduplicator.linked_files, 1)
+        self.assertEqual(os.stat(os.path.join(b, "same")).st_nlink, 1)
+
+    def test_min_size(self):
+        a = os.path.join(self.tempdir.name, "a")
+        b = os.path.join(self.tempdir.name, "b")
+        self.make_file(os.path.join(a, "same"), "same data")
+        self.make_file(os.path.join(b, "same"), "same data")
+        deduplicator = self.run_dedup(a, b, min_size=100)
+        self.assertEqual((deduplicator.files, deduplicator.linked_files), (0, 0))
+
+    def test_linked_snapshots(self):
+        snapshots_dirs = [os.path.join(self.tempdir.name, "{}.snapshots".format(source)) for source in ("a", "b")]
+        a = os.path.join(snapshots_dirs[0], "snap1")
+        b = os.path.join(snapshots_dirs[1], "snap2")
+        self.make_file(os.path.join(a, "etc", "same"), "same data")
+        self.make_file(os.path.join(b, "etc", "same"), "same data")
+        self.make_file(os.path.join(b, "etc", "other"), "other data")
+        deduplicator = self.run_dedup(a, b, snapshots_dirs=snapshots_dirs)
+        self.assertEqual(sorted(str(x) for x in deduplicator.linked_snapshots), [a, b])
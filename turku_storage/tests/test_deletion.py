@@ -0,0 +1,56 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import time
+import unittest
+
+from turku_storage import deletion
+
+
+def make_tree(path, width=3, depth=4):
+    """Create a tree of directories and files, returning its entry count"""
+    os.mkdir(path)
+    entries = 1
+    for i in range(width):
+        with open(os.path.join(path, "file{}".format(i)), "w") as f:
+            f.write("data")
+        os.link(os.path.join(path, "file{}".format(i)), os.path.join(path, "link{}".format(i)))
+        entries += 2
+        if depth:
+            entries += make_tree(os.path.join(path, "dir{}".format(i)), width, depth - 1)
+    return entries
+
+
+class TestTreeDeleter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.tree = os.path.join(self.tempdir.name, "_delete-tree")
+
+    def test_delete(self):
+        expected = make_tree(self.tree)
+        outside = os.path.join(self.tempdir.name, "outside")
+        os.mkdir(outside)
+        with open(os.path.join(outside, "keep"), "w") as f:
+            f.write("data")
+        os.symlink(outside, os.path.join(self.tree, "dir0", "symlink"))
+        progress = []
+        deleter = deletion.TreeDeleter(threads=3, split_depth=2, progress_interval=0.001)
+        entries, errors, elapsed = deleter.delete(self.tree, progress=lambda *args: progress.append(args))
+        self.assertFalse(os.path.lexists(self.tree))
+        self.assertTrue(os.path.exists(os.path.join(outside, "keep")))
+        self.assertEqual((entries, errors), (expected + 1, 0))
+
+    def test_ops_per_sec(self):
+        expected = make_tree(self.tree, width=2, depth=2)
+        deleter = deletion.TreeDeleter(threads=2, ops_per_sec=200)
+        time_begin = time.monotonic()
+        entries, errors, elapsed = deleter.delete(self.tree)
+        self.assertEqual(entries, expected)
+        self.assertGreaterEqual(time.monotonic() - time_begin, (expected - 1) / 200.0)
@@ -0,0 +1,80 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import os
+import stat
+import tempfile
+import unittest
+
+from turku_storage import manifest, snapshot
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.src = os.path.join(self.tempdir.name, "source")
+        os.makedirs(os.path.join(self.src, "etc", "ssh"))
+        for path in ("etc/hosts", "etc/ssh/sshd_config", "odd\tname\n", "back\\slash"):
+            with open(os.path.join(self.src, path), "w") as f:
+                f.write(path)
+        os.utime(os.path.join(self.src, "etc", "hosts"), (1600000000, 1600000000))
+        os.symlink("etc/hosts", os.path.join(self.src, "hosts"))
+        open(os.path.join(os.fsencode(self.src), b"undecodable\xff"), "w").close()
+
+    def test_roundtrip(self):
+        manifest_file = os.path.join(self.tempdir.name, "source.manifest.gz")
+        self.assertEqual(manifest.write_manifest(self.src, manifest_file), 8)
+        entries = {entry[0]: entry for entry in manifest.read_manifest(manifest_file)}
+        self.assertEqual(
+            sorted(entries),
+            ["back\\slash", "etc", "etc/hosts", "etc/ssh", "etc/ssh/sshd_config", "hosts", "odd\tname\n", "undecodable\udcff"],
+        )
+        st = os.lstat(os.path.join(self.src, "etc", "hosts"))
+        self.assertEqual(entries["etc/hosts"], ("etc/hosts", 9, 1600000000, st.st_mode, st.st_ino))
+        self.assertTrue(stat.S_ISLNK(entries["hosts"][3]))
+        self.assertEqual([x for x in os.listdir(self.tempdir.name) if x.endswith("~")], [])
+
+    def test_count_top_level(self):
+        manifest_file = os.path.join(self.tempdir.name, "source.manifest.gz")
+        manifest.write_manifest(self.src, manifest_file)
+        self.assertEqual(
+            manifest.count_top_level(manifest_file),
+            {"back\\slash": 1, "etc": 4, "hosts": 1, "odd\tname\n": 1, "undecodable\udcff": 1},
+        )
+
+    def test_match_entries(self):
+        manifest_file = os.path.join(self.tempdir.name, "source.manifest.gz")
+        manifest.write_manifest(self.src, manifest_file)
+
+        def match(*args):
+            return sorted(entry[0] for entry in manifest.match_entries(manifest.read_manifest(manifest_file), *args))
+
+        self.assertEqual(match("*conf*"), ["etc/ssh/sshd_config"])
+        self.assertEqual(match("/etc/*"), ["etc/hosts", "etc/ssh", "etc/ssh/sshd_config"])
+        self.assertEqual(match("hosts"), ["etc/hosts", "hosts"])
+        self.assertEqual(match(None, None, 1600000001), ["etc/hosts"])
+        self.assertEqual(match("hosts", 1600000001), ["hosts"])
+
+    def test_snapshot_manifests(self):
+        machine_dir = self.tempdir.name
+        now = datetime.datetime.now().astimezone()
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", manifests=True)
+        backend.prepare()
+        name = backend.create(now - datetime.timedelta(hours=1), now - datetime.timedelta(hours=1), {})
+        manifest_file = manifest.get_manifest_file(backend.snapshot_dir, name)
+        self.assertIn("etc/ssh/sshd_config", [entry[0] for entry in manifest.read_manifest(manifest_file)])
+        # The manifest is not mistaken for a snapshot
+        self.assertEqual([x["name"] for x in backend.catalog.snapshots()], [name])
+
+        os.mkdir(self.src)
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", manifests=True)
+        backend.prepare()
+        backend.create(now, now, {})
+        self.assertEqual([x["name"] for x in backend.expire("last 1 snapshots")], [name])
+        self.assertFalse(os.path.exists(manifest_file))
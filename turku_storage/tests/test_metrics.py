@@ -0,0 +1,67 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+
+from turku_storage import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        text = metrics.MetricsText()
+        text.add("turku_storage_test", "Test metric", 1, {"source": 'a "b"\\c'})
+        text.add("turku_storage_test", "Test metric", True, {"source": "d"})
+        text.add("turku_storage_skipped", "Skipped metric", None)
+        self.assertEqual(
+            text.render(),
+            "# HELP turku_storage_test Test metric\n"
+            "# TYPE turku_storage_test gauge\n"
+            'turku_storage_test{source="a \\"b\\"\\\\c"} 1.0\n'
+            'turku_storage_test{source="d"} 1.0\n',
+        )
+
+    def test_write_ping_metrics(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"metrics_dir": os.path.join(tempdir, "metrics")}
+            machine = {"uuid": "00000000-0000-0000-0000-000000000000", "unit_name": "machine"}
+            api_stats = {"storage_ping_checkin": {"calls": 2, "errors": 0, "retries": 1, "time_total": 1.0, "time_max": 0.75}}
+            metrics.write_ping_metrics(config, machine, {"etc": {"success": True, "returncode": 0}}, api_stats)
+            metrics.write_ping_metrics(config, machine, {"srv": {"success": False, "returncode": 23}}, {})
+            prom_file = os.path.join(config["metrics_dir"], "turku_storage_ping_00000000-0000-0000-0000-000000000000.prom")
+            with open(prom_file) as f:
+                lines = f.read().splitlines()
+        labels = 'machine="machine",machine_uuid="00000000-0000-0000-0000-000000000000"'
+        self.assertIn('turku_storage_source_success{%s,source="etc"} 1.0' % labels, lines)
+        self.assertIn('turku_storage_source_rsync_return_code{%s,source="srv"} 23.0' % labels, lines)
+        self.assertFalse([line for line in lines if line.startswith("turku_storage_api_")])
+
+    def test_update_config_metrics(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"metrics_dir": tempdir, "volumes": {}}
+            api_stats = {"storage_update_config": {"calls": 1, "errors": 0, "retries": 0, "time_total": 0.5, "time_max": 0.5}}
+            metrics.write_update_config_metrics(config, {}, 0, api_stats)
+            with open(os.path.join(tempdir, "turku_storage_update_config.prom")) as f:
+                lines = f.read().splitlines()
+        # Not the per-machine turku_storage_api_* family, which has more labels
+        self.assertIn('turku_storage_update_config_api_calls{cmd="storage_update_config"} 1.0', lines)
+        self.assertFalse([line for line in lines if line.startswith("turku_storage_api_")])
+
+    def test_prune_ping_metrics(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"metrics_dir": tempdir}
+            for machine_uuid in ("u1", "u2"):
+                metrics.write_ping_metrics(
+                    config, {"uuid": machine_uuid, "unit_name": machine_uuid}, {"etc": {"success": True}}, {}
+                )
+            open(os.path.join(tempdir, "turku_storage_update_config.prom"), "w").close()
+            metrics.prune_ping_metrics(config, ["u1"])
+            self.assertEqual(
+                sorted(os.listdir(tempdir)),
+                ["turku_storage_ping_u1.json", "turku_storage_ping_u1.prom", "turku_storage_update_config.prom"],
+            )
@@ -0,0 +1,206 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from turku_storage import ping, utils
+
+SOURCES = ("a", "b", "c", "d", "e")
+
+
+class TestSourcePool(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        tempdir = self.tempdir.name
+        self.config_dir = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(self.config_dir, "config.d"))
+        os.makedirs(os.path.join(tempdir, "vol"))
+        with open(os.path.join(self.config_dir, "config.d", "config.json"), "w") as f:
+            json.dump(
+                {
+                    "name": "primary",
+                    "secret": "secret",
+                    "api_url": "https://example.com/",
+                    "volumes": {"default": {"path": os.path.join(tempdir, "vol")}},
+                    "var_dir": tempdir,
+                    "lock_dir": tempdir,
+                    "log_file": os.path.join(tempdir, "ping.log"),
+                    "ssh_ping_host": "storage.example.com",
+                    "ssh_ping_host_keys": [],
+                    "max_concurrent_sources": 2,
+                },
+                f,
+            )
+        self.api_calls = []
+        for patcher in (
+            unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var")),
+            unittest.mock.patch.object(utils.ApiClient, "call", self.api_call),
+            unittest.mock.patch.object(ping.StoragePing, "backup_source", self.backup_source),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.finished = []
+
+    def api_call(self, cmd, post_data, idempotent=False):
+        self.api_calls.append(cmd)
+        scheduled_sources = {source_name: {"username": "u", "password": "p"} for source_name in SOURCES}
+        return {"machine": {"uuid": "u1", "unit_name": "m1", "scheduled_sources": scheduled_sources}}
+
+    def backup_source(self, machine, machine_dir, forwarded_port, source_name, s, username, password):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            # Later sources finish first
+            time.sleep(0.01 * (len(SOURCES) - SOURCES.index(source_name)))
+            if source_name == "b":
+                raise Exception("Source b broke")
+            with self.lock:
+                self.finished.append(source_name)
+            return {"success": True, "time_end": SOURCES.index(source_name)}
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def run_ping(self):
+        storage_ping = ping.StoragePing("u1", config_dir=self.config_dir)
+        with unittest.mock.patch.object(ping.sys, "stdin", io.StringIO('{"port": 1}\n.\n')):
+            return storage_ping.main()
+
+    def test_concurrency_limit(self):
+        self.run_ping()
+        self.assertEqual(self.max_running, 2)
+
+    def test_failure_isolation(self):
+        self.assertEqual(self.run_ping(), 1)
+        # The failing source does not stop the others
+        self.assertEqual(sorted(self.finished), ["a", "c", "d", "e"])
+        with open(os.path.join(self.tempdir.name, "ping.log")) as f:
+            log = f.read()
+        self.assertIn('Source "b" failed', log)
+        self.assertIn("Source b broke", log)
+        # Results are recorded for every source which finished
+        with open(os.path.join(self.tempdir.name, "metrics", "turku_storage_ping_u1.json")) as f:
+            self.assertEqual(sorted(json.load(f)["sources"]), ["a", "c", "d", "e"])
+
+    def test_result_order(self):
+        self.run_ping()
+        self.assertNotEqual(self.finished, sorted(self.finished))
+        # The summary lists sources by name, not in the order they finished
+        with open(os.path.join(self.tempdir.name, "metrics", "turku_storage_ping_u1.prom")) as f:
+            prom_sources = [
+                line.split('source="')[1].split('"')[0] for line in f if line.startswith("turku_storage_source_success{")
+            ]
+        self.assertEqual(prom_sources, ["a", "c", "d", "e"])
+
+    def test_all_succeed(self):
+        with unittest.mock.patch.object(ping.StoragePing, "backup_source", lambda *args: {"success": True}):
+            self.assertIsNone(self.run_ping())
+
+    def test_main_loads_config_once(self):
+        with unittest.mock.patch.object(ping, "load_config_cached", wraps=utils.load_config_cached) as mock_load:
+            with unittest.mock.patch.object(ping.sys, "argv", ["turku-storage-ping", "-c", self.config_dir, "u1"]):
+                with unittest.mock.patch.object(ping.sys, "stdin", io.StringIO('{"port": 1}\n.\n')):
+                    with self.assertRaises(SystemExit):
+                        ping.main()
+        self.assertEqual(mock_load.call_count, 1)
+
+
+@unittest.skipUnless(shutil.which("rsync"), "rsync not installed")
+class TestShardedSync(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        tempdir = self.tempdir.name
+        config_dir = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(config_dir, "config.d"))
+        with open(os.path.join(config_dir, "config.d", "config.json"), "w") as f:
+            json.dump(
+                {
+                    "name": "primary",
+                    "secret": "secret",
+                    "api_url": "https://example.com/",
+                    "volumes": {"default": {"path": tempdir}},
+                    "var_dir": tempdir,
+                    "lock_dir": tempdir,
+                    "log_file": os.path.join(tempdir, "ping.log"),
+                    "ssh_ping_host": "storage.example.com",
+                    "ssh_ping_host_keys": [],
+                },
+                f,
+            )
+        patcher = unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage_ping = ping.StoragePing("u1", config_dir=config_dir)
+        self.rsync_args = ["rsync", "--archive", "--numeric-ids", "--delete", "--delete-excluded"] + ping.RSYNC_OUTPUT_ARGS
+
+    def make_file(self, path, data=""):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(data)
+
+    def make_dest(self, dest):
+        # Left over from an earlier backup
+        self.make_file(os.path.join(dest, "a", "stale"), "stale")
+        self.make_file(os.path.join(dest, "gone", "file"), "gone")
+        self.make_file(os.path.join(dest, "gone_file"), "gone")
+
+    def tree(self, root):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    content = os.readlink(path)
+                elif os.path.isdir(path):
+                    content = None
+                else:
+                    with open(path) as f:
+                        content = f.read()
+                tree[os.path.relpath(path, root)] = (st.st_mode, int(st.st_mtime), content)
+        return tree
+
+    def test_run_sharded(self):
+        src = os.path.join(self.tempdir.name, "src")
+        for i in range(5):
+            self.make_file(os.path.join(src, "dir{}".format(i), "sub", "file{}".format(i)), "data {}".format(i))
+        self.make_file(os.path.join(src, "a", "kept"), "kept")
+        os.makedirs(os.path.join(src, "empty"))
+        self.make_file(os.path.join(src, "top_file"), "top")
+        os.symlink("top_file", os.path.join(src, "top_link"))
+        os.chmod(os.path.join(src, "dir1"), 0o700)
+
+        single = os.path.join(self.tempdir.name, "single")
+        self.make_dest(single)
+        output = ping.RsyncOutput()
+        self.assertEqual(self.storage_ping.run_logging(self.rsync_args + ["{}/".format(src), single], output=output), 0)
+
+        sharded = os.path.join(self.tempdir.name, "sharded")
+        self.make_dest(sharded)
+        returncode, merged = self.storage_ping.run_sharded(self.rsync_args, "{}/".format(src), sharded, 3, None)
+        self.assertEqual(returncode, 0)
+
+        self.assertEqual(self.tree(sharded), self.tree(single))
+        self.assertEqual(self.tree(sharded), self.tree(src))
+        single_stats = output.transfer_stats()
+        merged_stats = merged.transfer_stats()
+        for key in ("files", "regular_files", "transferred_files"):
+            self.assertEqual(merged_stats[key], single_stats[key], key)
@@ -0,0 +1,85 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import placement, utils
+
+
+def make_status(st_dev, space_available, inodes_available=1000000, active_jobs=0):
+    return {
+        "st_dev": st_dev,
+        "space_total": 1000000.0,
+        "space_available": space_available,
+        "pct_used": (1.0 - space_available / 1000000.0) * 100.0,
+        "inodes_total": 1000000,
+        "inodes_available": inodes_available,
+        "pct_inodes_used": (1.0 - inodes_available / 1000000.0) * 100.0,
+        "active_jobs": active_jobs,
+        "sectors_written": None,
+        "write_bytes_per_sec": None,
+    }
+
+
+class TestPlacement(unittest.TestCase):
+    def setUp(self):
+        volume = {
+            "accept_new": True,
+            "accept_new_high_water_pct": 80,
+            "accept_new_inodes_high_water_pct": 90,
+            "placement_write_reference": 104857600,
+        }
+        self.config = {"volumes": {"a": dict(volume), "b": dict(volume), "c": dict(volume)}}
+
+    def test_weights(self):
+        volumes = {
+            "a": make_status(1, 500000.0),
+            "b": make_status(2, 500000.0, active_jobs=4),
+            "c": make_status(3, 500000.0, inodes_available=50000),
+        }
+        weights = placement.get_volume_weights(self.config, volumes)
+        self.assertEqual(sorted(weights), ["a", "b"])
+        self.assertAlmostEqual(weights["a"], weights["b"] * 5)
+
+    def test_space_totals_dedup(self):
+        volumes = {
+            "a": make_status(1, 500000.0),
+            "b": make_status(1, 500000.0),
+            "c": make_status(2, 100000.0),
+        }
+        self.assertEqual(placement.get_space_totals(self.config, volumes), (2000000.0, 500000.0))
+
+    def test_simulate(self):
+        volumes = {
+            "a": make_status(1, 800000.0),
+            "b": make_status(2, 800000.0),
+            "c": make_status(3, 300000.0),
+        }
+        placed = placement.simulate(self.config, 300, 1000.0, 1000, volumes)
+        self.assertEqual(sum(placed.values()), 300)
+        self.assertGreater(placed["a"], placed["c"])
+        self.assertGreater(placed["b"], placed["c"])
+
+    def test_count_active_jobs(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"var_dir": os.path.join(tempdir, "var"), "lock_dir": tempdir}
+            os.makedirs(os.path.join(tempdir, "var", "machines"))
+            for machine_uuid in ("u1", "u2", "u3"):
+                os.makedirs(os.path.join(tempdir, "vol", machine_uuid))
+                os.symlink(os.path.join(tempdir, "vol", machine_uuid), os.path.join(tempdir, "var", "machines", machine_uuid))
+            lock = utils.RuntimeLock(name="turku-storage-ping-u1", lock_dir=tempdir)
+            # Left by a ping which died
+            with open(os.path.join(tempdir, "turku-storage-ping-u2.lock"), "w") as f:
+                f.write("")
+            with unittest.mock.patch.object(utils.fcntl, "flock") as mock_flock:
+                self.assertEqual(placement.count_active_jobs(config), {os.path.join(os.path.realpath(tempdir), "vol"): 1})
+            # Counting does not touch the lock, so the ping's machine stays locked
+            mock_flock.assert_not_called()
+            lock.close()
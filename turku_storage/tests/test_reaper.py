@@ -0,0 +1,69 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import tempfile
+import unittest
+
+from turku_storage import reaper
+
+
+def make_file(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("data")
+
+
+class TestReaper(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.volume = os.path.join(self.tempdir.name, "volume")
+        self.outside = os.path.join(self.tempdir.name, "outside")
+        snapshots_dir = os.path.join(self.volume, "machine", "source.snapshots")
+
+        # Expired trees, one holding a symlink out of the volume
+        make_file(os.path.join(snapshots_dir, "_delete-1", "etc", "hosts"))
+        make_file(os.path.join(snapshots_dir, "_delete-2", "hosts"))
+        os.symlink(self.outside, os.path.join(snapshots_dir, "_delete-2", "outside"))
+        # Live snapshots and other files are left alone
+        make_file(os.path.join(snapshots_dir, "2020-01-01T00:00:00", "hosts"))
+        make_file(os.path.join(snapshots_dir, "_delete-file"))
+        make_file(os.path.join(self.volume, "machine", "source", "hosts"))
+
+        # Trees outside the volume, reachable only through symlinks
+        make_file(os.path.join(self.outside, "keep"))
+        make_file(os.path.join(self.outside, "machine", "source.snapshots", "_delete-1", "keep"))
+        make_file(os.path.join(self.outside, "source.snapshots", "_delete-1", "keep"))
+        os.symlink(self.outside, os.path.join(snapshots_dir, "_delete-link"))
+        os.symlink(os.path.join(self.outside, "machine"), os.path.join(self.volume, "linked-machine"))
+        os.symlink(os.path.join(self.outside, "source.snapshots"), os.path.join(self.volume, "machine", "linked.snapshots"))
+
+    def test_find_delete_trees(self):
+        snapshots_dir = os.path.join(self.volume, "machine", "source.snapshots")
+        self.assertEqual(
+            reaper.find_delete_trees(self.volume),
+            [os.path.join(snapshots_dir, "_delete-1"), os.path.join(snapshots_dir, "_delete-2")],
+        )
+        self.assertEqual(reaper.find_delete_trees(os.path.join(self.tempdir.name, "missing")), [])
+
+    def test_volume_reaper(self):
+        volume_reaper = reaper.VolumeReaper("default", self.volume, threads=2)
+        volume_reaper.start()
+        volume_reaper.join()
+        self.assertEqual((volume_reaper.trees, volume_reaper.failures), (2, 0))
+        self.assertEqual(reaper.find_delete_trees(self.volume), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.volume, "machine", "source.snapshots"))),
+            ["2020-01-01T00:00:00", "_delete-file", "_delete-link"],
+        )
+        for path in (
+            "keep",
+            os.path.join("machine", "source.snapshots", "_delete-1", "keep"),
+            os.path.join("source.snapshots", "_delete-1", "keep"),
+        ):
+            self.assertTrue(os.path.exists(os.path.join(self.outside, path)), path)
@@ -0,0 +1,81 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import manifest, restore
+
+
+class TestRestore(unittest.TestCase):
+    def test_split_streams(self):
+        items = [("usr", 100), ("etc", 40), ("var", 50), ("home", 10), ("vmlinuz", 1)]
+        streams = restore.split_streams(items, 2)
+        self.assertEqual(streams, [["usr", "vmlinuz"], ["etc", "home", "var"]])
+        self.assertEqual(restore.split_streams(items[:2], 4), [["usr"], ["etc"]])
+        self.assertEqual(restore.split_streams([], 4), [])
+
+    def test_count_entries(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            os.makedirs(os.path.join(tempdir, "a", "b"))
+            open(os.path.join(tempdir, "a", "b", "file"), "w").close()
+            os.symlink("a", os.path.join(tempdir, "link"))
+            self.assertEqual(restore.count_entries(os.path.join(tempdir, "a")), 3)
+            self.assertEqual(restore.count_entries(os.path.join(tempdir, "link")), 1)
+
+    def test_get_entry_counts(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            snapshot_dir = os.path.join(tempdir, "snap")
+            os.makedirs(os.path.join(snapshot_dir, "a", "b"))
+            open(os.path.join(snapshot_dir, "a", "b", "file"), "w").close()
+            open(os.path.join(snapshot_dir, "c"), "w").close()
+            expected = [("a", 3), ("c", 1)]
+            self.assertEqual(restore.get_entry_counts(snapshot_dir), expected)
+            manifest.write_manifest(snapshot_dir, manifest.get_manifest_file(tempdir, "snap"))
+            with unittest.mock.patch.object(restore, "count_entries") as mock_count:
+                self.assertEqual(restore.get_entry_counts(snapshot_dir), expected)
+            mock_count.assert_not_called()
+
+    def test_get_restore_port(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"var_dir": tempdir}
+            self.assertIsNone(restore.get_restore_port(config, "uuid"))
+            os.mkdir(os.path.join(tempdir, "restore"))
+            with open(restore.get_restore_file(config, "uuid"), "w") as f:
+                json.dump({"port": 64951, "pid": os.getpid()}, f)
+            self.assertEqual(restore.get_restore_port(config, "uuid"), 64951)
+            with unittest.mock.patch.object(restore.os, "kill", side_effect=PermissionError()):
+                self.assertEqual(restore.get_restore_port(config, "uuid"), 64951)
+            with unittest.mock.patch.object(restore.os, "kill", side_effect=ProcessLookupError()):
+                self.assertIsNone(restore.get_restore_port(config, "uuid"))
+
+    def test_find_restore_dir(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {"var_dir": tempdir}
+            machine_dir = os.path.join(tempdir, "volume", "uuid")
+            os.makedirs(os.path.join(machine_dir, "etc.snapshots", "2020-01-01T00:00:00"))
+            os.makedirs(os.path.join(machine_dir, "etc.snapshots", "2020-01-02T00:00:00"))
+            os.makedirs(os.path.join(machine_dir, "srv"))
+            os.makedirs(os.path.join(tempdir, "machines"))
+            os.symlink(machine_dir, os.path.join(tempdir, "machines", "uuid"))
+            os.symlink("uuid", os.path.join(tempdir, "machines", "machine"))
+            self.assertEqual(
+                restore.find_restore_dir(config, "machine", "etc"),
+                ("uuid", os.path.join(machine_dir, "etc.snapshots", "2020-01-02T00:00:00")),
+            )
+            self.assertEqual(
+                restore.find_restore_dir(config, "uuid", "etc", "2020-01-01T00:00:00")[1],
+                os.path.join(machine_dir, "etc.snapshots", "2020-01-01T00:00:00"),
+            )
+            self.assertEqual(restore.find_restore_dir(config, "uuid", "srv")[1], os.path.join(machine_dir, "srv"))
+            with self.assertRaises(ValueError):
+                restore.find_restore_dir(config, "uuid", "etc", "2020-01-03T00:00:00")
+            with self.assertRaises(ValueError):
+                restore.find_restore_dir(config, "other", "etc")
@@ -0,0 +1,97 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import retention, utils
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        tempdir = self.tempdir.name
+        self.config_dir = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(self.config_dir, "config.d"))
+        with open(os.path.join(self.config_dir, "config.d", "config.json"), "w") as f:
+            json.dump(
+                {
+                    "name": "primary",
+                    "secret": "secret",
+                    "api_url": "https://example.com/",
+                    "volumes": {"default": {"path": tempdir}},
+                    "var_dir": tempdir,
+                    "lock_dir": tempdir,
+                    "ssh_ping_host": "storage.example.com",
+                    "ssh_ping_host_keys": [],
+                },
+                f,
+            )
+        patcher = unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.snapshots_dir = os.path.join(tempdir, "machines", "u1", "src.snapshots")
+        os.makedirs(self.snapshots_dir)
+        self.make_snapshot("src_1", "2015-02-20T00:00:00+00:00", "last 5 snapshots")
+        self.make_snapshot("src_2", "2015-02-21T00:00:00+00:00", "last 2 snapshots")
+        self.make_snapshot("src_3", "2015-02-22T00:00:00+00:00")
+
+    def make_snapshot(self, name, sync_finish, snapshot_retention=None):
+        os.mkdir(os.path.join(self.snapshots_dir, name))
+        with open(os.path.join(self.snapshots_dir, "{}.json".format(name)), "w") as f:
+            json.dump({"name": name, "sync_finish": sync_finish, "retention": snapshot_retention}, f)
+
+    def run_main(self, *args):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        argv = ["turku-storage-retention", "--config-dir", self.config_dir] + list(args)
+        with unittest.mock.patch.object(retention.sys, "argv", argv), contextlib.redirect_stdout(
+            stdout
+        ), contextlib.redirect_stderr(stderr):
+            try:
+                retention.main()
+                returncode = 0
+            except SystemExit as e:
+                returncode = e.code
+        return returncode, stdout.getvalue().splitlines(), stderr.getvalue()
+
+    def test_recorded_retention(self):
+        returncode, lines, stderr = self.run_main("u1", "src")
+        self.assertEqual(returncode, 0)
+        # The newest snapshot recording a retention string is used
+        self.assertEqual(lines[0], "Retention: last 2 snapshots")
+        self.assertEqual(
+            [line.split()[0] + " " + line.split()[2] for line in lines[1:4]], ["delete src_1", "keep src_2", "keep src_3"]
+        )
+        self.assertEqual(lines[4], "2 kept, 1 to delete")
+        # Nothing is removed
+        self.assertEqual(sorted(x for x in os.listdir(self.snapshots_dir) if not x.endswith(".json")), ["src_1", "src_2", "src_3"])
+
+    def test_retention_argument(self):
+        returncode, lines, stderr = self.run_main("--retention", "last 1 snapshots", "u1", "src")
+        self.assertEqual(returncode, 0)
+        self.assertEqual(lines[0], "Retention: last 1 snapshots")
+        self.assertEqual(lines[-1], "1 kept, 2 to delete")
+
+    def test_no_retention(self):
+        for name in ("src_1", "src_2"):
+            os.unlink(os.path.join(self.snapshots_dir, "{}.json".format(name)))
+        returncode, lines, stderr = self.run_main("u1", "src")
+        self.assertEqual(returncode, 1)
+        self.assertIn("No retention recorded for u1 src", stderr)
+
+    def test_missing_source(self):
+        returncode, lines, stderr = self.run_main("u1", "missing")
+        self.assertEqual(returncode, 1)
+        self.assertIn("No snapshots directory for u1 missing", stderr)
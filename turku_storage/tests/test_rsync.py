@@ -0,0 +1,86 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from turku_storage import rsync
+
+RSYNC_OUTPUT = """receiving incremental file list
+etc/hostname
+etc/passwd
+rsync: [sender] send_files failed to open "/etc/shadow": Permission denied (13)
+
+Number of files: 1,234 (reg: 1,000, dir: 200, link: 34)
+Number of created files: 5 (reg: 5)
+Number of deleted files: 0
+Number of regular files transferred: 2
+Total file size: 123,456 bytes
+Total transferred file size: 1,234 bytes
+Literal data: 1,000 bytes
+Matched data: 234 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 123
+Total bytes received: 4,567
+
+sent 123 bytes  received 4,567 bytes  9,380.00 bytes/sec
+total size is 123,456  speedup is 26.32
+"""
+
+
+class TestRsyncOutput(unittest.TestCase):
+    def test_feed(self):
+        output = rsync.RsyncOutput(buffer_lines=2)
+        logged = [line for line in (output.feed(line) for line in RSYNC_OUTPUT.splitlines(True)) if line is not None]
+        self.assertEqual(logged, ['rsync: [sender] send_files failed to open "/etc/shadow": Permission denied (13)'])
+        self.assertEqual(output.file_lines, 2)
+        self.assertEqual(len(output.buffer), 2)
+        self.assertEqual(output.stats["number_of_files"], 1234)
+        self.assertEqual(output.stats["number_of_files_reg"], 1000)
+        self.assertEqual(output.stats["number_of_regular_files_transferred"], 2)
+        self.assertEqual(output.stats["literal_data"], 1000)
+        self.assertEqual(output.stats["matched_data"], 234)
+        self.assertEqual(output.stats["file_list_generation_time"], 0.001)
+        self.assertEqual(output.stats["total_bytes_received"], 4567)
+        self.assertEqual(output.stats["received_bytes"], 4567)
+        self.assertEqual(output.stats["speedup"], 26.32)
+
+    def test_transfer_stats(self):
+        output = rsync.RsyncOutput()
+        for line in RSYNC_OUTPUT.splitlines(True):
+            output.feed(line)
+        transfer = output.transfer_stats(link_dest=True)
+        self.assertEqual(transfer["files"], 1234)
+        self.assertEqual(transfer["copied_files"], 2)
+        self.assertEqual(transfer["linked_files"], 998)
+        self.assertEqual(transfer["literal_bytes"], 1000)
+        self.assertEqual(output.transfer_stats()["linked_files"], 0)
+        resumed = output.transfer_stats(link_dest=True, resumed=True)
+        self.assertEqual(resumed["copied_files"], 2)
+        self.assertNotIn("linked_files", resumed)
+        self.assertNotIn("linked_bytes", resumed)
+
+    def test_merge(self):
+        outputs = []
+        for i in range(2):
+            outputs.append(rsync.RsyncOutput())
+            for line in RSYNC_OUTPUT.splitlines(True):
+                outputs[-1].feed(line)
+        merged = rsync.RsyncOutput.merge(outputs)
+        self.assertEqual(merged.stats["number_of_files"], 2468)
+        self.assertEqual(merged.file_lines, outputs[0].file_lines * 2)
+        self.assertEqual(merged.transfer_stats(link_dest=True)["linked_files"], 1996)
+        self.assertEqual(merged.stats["speedup"], outputs[0].stats["speedup"])
+
+    def test_discount_dirs(self):
+        output = rsync.RsyncOutput()
+        for line in RSYNC_OUTPUT.splitlines(True):
+            output.feed(line)
+        output.discount_dirs(keep=1)
+        self.assertEqual((output.stats["number_of_files"], output.stats["number_of_files_dir"]), (1035, 1))
+        self.assertEqual(output.stats["number_of_files_reg"], 1000)
@@ -0,0 +1,158 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import errno
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.src = os.path.join(self.tempdir.name, "src")
+        os.makedirs(os.path.join(self.src, "dir"))
+        with open(os.path.join(self.src, "dir", "file"), "w") as f:
+            f.write("data")
+        os.link(os.path.join(self.src, "dir", "file"), os.path.join(self.src, "link"))
+        os.symlink("dir/file", os.path.join(self.src, "symlink"))
+        os.chmod(os.path.join(self.src, "dir", "file"), 0o640)
+        os.utime(os.path.join(self.src, "dir"), (1000000000, 1000000000))
+
+    def test_clone_tree(self):
+        dst = os.path.join(self.tempdir.name, "dst")
+        snapshot.clone_tree(self.src, dst, clone=shutil.copyfile)
+        with open(os.path.join(dst, "dir", "file")) as f:
+            self.assertEqual(f.read(), "data")
+        self.assertTrue(os.path.samefile(os.path.join(dst, "dir", "file"), os.path.join(dst, "link")))
+        self.assertFalse(os.path.samefile(os.path.join(dst, "dir", "file"), os.path.join(self.src, "dir", "file")))
+        self.assertEqual(os.readlink(os.path.join(dst, "symlink")), "dir/file")
+        self.assertEqual(os.stat(os.path.join(dst, "dir", "file")).st_mode & 0o777, 0o640)
+        self.assertEqual(os.stat(os.path.join(dst, "dir")).st_mtime, 1000000000)
+
+    def test_clone_file(self):
+        dst = os.path.join(self.tempdir.name, "clone")
+        try:
+            snapshot.clone_file(os.path.join(self.src, "dir", "file"), dst)
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                self.skipTest("Filesystem does not support FICLONE")
+            raise
+        with open(dst) as f:
+            self.assertEqual(f.read(), "data")
+
+    def test_reflink_backend(self):
+        machine_dir = self.tempdir.name
+        os.rename(self.src, os.path.join(machine_dir, "source"))
+        backend = snapshot.get_snapshot_backend("reflink", machine_dir, "source")
+        self.assertIsInstance(backend, snapshot.ReflinkBackend)
+        self.assertEqual(backend.prepare(), ["--inplace"])
+        now = datetime.datetime.now().astimezone()
+        names = []
+        with unittest.mock.patch.object(snapshot.clone_tree, "__defaults__", (shutil.copyfile,)):
+            for i in range(3):
+                sync_finish = now - datetime.timedelta(minutes=3 - i)
+                names.append(backend.create(sync_finish, sync_finish, {"retention": "last 2 snapshots"}))
+        self.assertEqual([s["name"] for s in backend.expire("last 2 snapshots")], names[:1])
+        self.assertEqual(sorted(s["name"] for s in backend.catalog.snapshots()), sorted(names[1:]))
+        self.assertTrue(os.path.isfile(os.path.join(machine_dir, "source", "link")))
+        self.assertEqual(os.readlink(os.path.join(backend.snapshot_dir, "latest")), names[-1])
+
+    def test_unknown_mode(self):
+        backend = snapshot.get_snapshot_backend("bogus", self.tempdir.name, "source")
+        self.assertFalse(backend.keeps_snapshots)
+        self.assertEqual(backend.prepare(), ["--inplace"])
+
+    def test_incomplete_backend(self):
+        class IncompleteBackend(snapshot.SnapshotDirBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend(self.tempdir.name, "source")
+
+    def test_select_bases(self):
+        now = datetime.datetime.now().astimezone()
+        snapshots = [{"name": str(i), "sync_finish": now - datetime.timedelta(days=i)} for i in range(40)]
+        self.assertEqual([x["name"] for x in snapshot.select_bases(snapshots)], ["0"])
+        self.assertEqual([x["name"] for x in snapshot.select_bases(snapshots, 3)], ["0", "1", "2"])
+        bases = snapshot.select_bases(snapshots, 2, "last 3 snapshots, earliest of 2 month")
+        self.assertEqual([x["name"] for x in bases[:3]], ["0", "1", "2"])
+        self.assertEqual(len(bases), 4)
+        self.assertEqual(len(snapshot.select_bases(snapshots, 30, "last 40 days")), snapshot.MAX_LINK_DEST)
+        self.assertEqual(snapshot.select_bases([], 3, "last 3 snapshots"), [])
+
+    def test_link_dest_backend(self):
+        machine_dir = self.tempdir.name
+        now = datetime.datetime.now().astimezone()
+        names = []
+        for i in range(3):
+            os.rename(self.src, os.path.join(machine_dir, "source"))
+            backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", link_dest_bases=2)
+            rsync_args = backend.prepare()
+            self.assertEqual(rsync_args, ["--link-dest={}".format(os.path.join(backend.snapshot_dir, x)) for x in names[:2]])
+            names.insert(0, backend.create(now - datetime.timedelta(hours=3 - i), now - datetime.timedelta(hours=3 - i), {}))
+            shutil.copytree(os.path.join(backend.snapshot_dir, names[0]), self.src, symlinks=True)
+
+    def test_update_info(self):
+        machine_dir = self.tempdir.name
+        now = datetime.datetime.now().astimezone()
+        os.rename(self.src, os.path.join(machine_dir, "source"))
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source")
+        backend.prepare()
+        name = backend.create(now, now, {"shards": 1})
+        backend.update_info(name, {"phases": {"retention": 0.5}})
+        with open(os.path.join(backend.snapshot_dir, "{}.json".format(name))) as f:
+            info = json.load(f)
+        self.assertEqual((info["shards"], info["phases"]), (1, {"retention": 0.5}))
+        self.assertEqual(snapshot.SnapshotCatalog(backend.snapshot_dir).latest()["phases"], {"retention": 0.5})
+
+    def test_resume(self):
+        machine_dir = self.tempdir.name
+        now = datetime.datetime.now().astimezone()
+        os.rename(self.src, os.path.join(machine_dir, "source"))
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", resume=True)
+        backend.prepare()
+        backend.create(now - datetime.timedelta(hours=2), now - datetime.timedelta(hours=2), {})
+        shutil.copytree(os.path.join(backend.snapshot_dir, "latest"), os.path.join(machine_dir, "source"), symlinks=True)
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", resume=True)
+        backend.prepare()
+        latest = backend.create(now - datetime.timedelta(hours=1), now - datetime.timedelta(hours=1), {})
+        os.mkdir(os.path.join(machine_dir, "source"))
+
+        # A failed sync is resumed against the same bases
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", resume=True)
+        self.assertIn("--partial-dir={}".format(snapshot.PARTIAL_DIR), backend.prepare())
+        self.assertEqual(backend.attempts, 1)
+        self.assertTrue(backend.failed())
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", resume=True, link_dest_bases=2)
+        backend.prepare()
+        self.assertEqual((backend.attempts, [x["name"] for x in backend.base_snapshots]), (2, [latest]))
+        backend.failed()
+
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source", resume=True)
+        backend.prepare()
+        self.assertEqual(backend.attempts, 3)
+        name = backend.create(now, now, {})
+        self.assertFalse(os.path.exists(backend.resume_file))
+        with open(os.path.join(backend.snapshot_dir, "{}.json".format(name))) as f:
+            self.assertEqual(json.load(f)["attempts"], 3)
+
+        # Without resume, or in place, nothing is recorded for the next attempt
+        backend = snapshot.get_snapshot_backend("link-dest", machine_dir, "source")
+        backend.prepare()
+        self.assertFalse(backend.failed())
+        backend = snapshot.get_snapshot_backend("none", machine_dir, "source", resume=True)
+        backend.prepare()
+        self.assertFalse(backend.failed())
+        self.assertFalse(os.path.exists(backend.resume_file))
@@ -0,0 +1,102 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Cold start budget for turku-storage-ping, from interpreter start to
+# the first API call, in seconds
+STARTUP_BUDGET = float(os.environ.get("TURKU_STORAGE_STARTUP_BUDGET", "1.0"))
+HEAVY_MODULES = ("requests", "urllib3", "yaml", "systemd")
+
+FIRST_API_CALL_SCRIPT = """
+import os
+import sys
+
+from turku_storage import ping, utils
+
+utils.DEFAULT_VAR_DIR = sys.argv[2]
+
+
+def first_call(self, cmd, post_data, idempotent=False):
+    self.get_session()
+    sys.stdout.write(cmd + "\\n")
+    sys.stdout.flush()
+    os._exit(0)
+
+
+utils.ApiClient.call = first_call
+sys.exit(ping.StoragePing("00000000-0000-0000-0000-000000000000", config_dir=sys.argv[1]).main())
+"""
+
+
+def parse_importtime(stderr, limit=15):
+    """Return the slowest top-level imports from python -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:") :].split("|")
+        # Nested imports are indented beyond the single separating space
+        if not fields[0].strip().isdigit() or fields[2][1:2] == " ":
+            continue
+        imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import json, sys, turku_storage.ping, turku_storage.update_config; "
+                "print(json.dumps(sorted(m for m in sys.modules if m.split('.')[0] in {})))".format(repr(HEAVY_MODULES)),
+            ],
+            encoding="UTF-8",
+        )
+        self.assertEqual(json.loads(out), [])
+
+    def test_cold_start_budget(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config_dir = os.path.join(tempdir, "etc")
+            os.makedirs(os.path.join(config_dir, "config.d"))
+            with open(os.path.join(config_dir, "config.d", "config.json"), "w") as f:
+                json.dump(
+                    {
+                        "name": "primary",
+                        "secret": "secret",
+                        "api_url": "https://example.com/",
+                        "volumes": {"default": {"path": tempdir}},
+                        "var_dir": tempdir,
+                        "lock_dir": tempdir,
+                        "log_file": os.path.join(tempdir, "ping.log"),
+                        "ssh_ping_host": "storage.example.com",
+                        "ssh_ping_host_keys": [],
+                    },
+                    f,
+                )
+            args = [sys.executable, "-X", "importtime", "-c", FIRST_API_CALL_SCRIPT, config_dir, os.path.join(tempdir, "var")]
+            # Warm the config cache, as update-config would
+            subprocess.run(args, input='{"port": 1}\n.\n', capture_output=True, encoding="UTF-8")
+            time_begin = time.monotonic()
+            proc = subprocess.run(args, input='{"port": 1}\n.\n', capture_output=True, encoding="UTF-8")
+            elapsed = time.monotonic() - time_begin
+        self.assertEqual(proc.stdout, "storage_ping_checkin\n", proc.stderr)
+        breakdown = "\n".join("{:>10} us  {}".format(us, name) for us, name in parse_importtime(proc.stderr))
+        self.assertLess(
+            elapsed,
+            STARTUP_BUDGET,
+            "Cold start to first API call took {:.3f}s (budget {:.3f}s); slowest imports:\n{}".format(
+                elapsed, STARTUP_BUDGET, breakdown
+            ),
+        )
@@ -0,0 +1,51 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import tempfile
+import unittest
+
+from turku_storage import timing
+
+
+class TestTiming(unittest.TestCase):
+    def test_durations(self):
+        timeline = timing.Timeline("etc")
+        with timeline.span("rsync"):
+            pass
+        with timeline.span("rsync"):
+            pass
+        with self.assertRaises(ValueError):
+            with timing.span(timeline, "deletion"):
+                raise ValueError()
+        durations = timeline.durations()
+        self.assertEqual(sorted(durations), ["deletion", "rsync"])
+        self.assertEqual(len(timeline.spans), 3)
+        self.assertTrue(all(duration >= 0 for duration in durations.values()))
+        self.assertEqual(sorted(timeline.durations(("rsync", "snapshot"))), ["rsync"])
+
+    def test_span_none(self):
+        with timing.span(None, "rsync"):
+            pass
+
+    def test_write_trace(self):
+        ping = timing.Timeline("ping")
+        source = timing.Timeline("etc")
+        with ping.span("api_checkin"):
+            pass
+        with source.span("rsync"):
+            pass
+        with tempfile.TemporaryDirectory() as tempdir:
+            trace_file = os.path.join(tempdir, "trace.json")
+            timing.write_trace(trace_file, [ping, source])
+            with open(trace_file) as f:
+                events = json.load(f)["traceEvents"]
+        self.assertEqual(
+            [(e["ph"], e["tid"], e["name"]) for e in events if e["ph"] == "X"], [("X", 0, "api_checkin"), ("X", 1, "rsync")]
+        )
+        self.assertEqual([e["args"]["name"] for e in events if e["ph"] == "M"], ["ping", "etc"])
@@ -0,0 +1,127 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import pwd
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import update_config, utils
+
+
+def make_machine(name):
+    return {"ssh_public_key": "ssh-ed25519 AAAA{}".format(name), "unit_name": name}
+
+
+class TestUpdateConfig(unittest.TestCase):
+    def test_get_machines(self):
+        state = {"machines": {"a": make_machine("a"), "b": make_machine("b")}}
+        self.assertEqual(update_config.get_machines({"machines": {}}, state), {})
+        self.assertIs(update_config.get_machines({"machines_unchanged": True}, state), state["machines"])
+        delta = {"machines_delta": {"updated": {"c": make_machine("c")}, "removed": ["a"]}}
+        self.assertEqual(sorted(update_config.get_machines(delta, state)), ["b", "c"])
+        self.assertEqual(sorted(state["machines"]), ["a", "b"])
+        with self.assertRaises(ValueError):
+            update_config.get_machines({"machines_unchanged": True}, {})
+
+    def test_build_authorized_keys(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {
+                "authorized_keys_file": os.path.join(tempdir, "authorized_keys"),
+                "authorized_keys_command": "turku-storage-ping",
+            }
+            with open(config["authorized_keys_file"] + ".static", "w") as f:
+                f.write("ssh-ed25519 AAAAstatic\n")
+            out = update_config.build_authorized_keys(config, {"a": make_machine("a")})
+        lines = out.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[2], "ssh-ed25519 AAAAstatic")
+        self.assertEqual(
+            lines[3],
+            'no-pty,no-agent-forwarding,no-X11-forwarding,no-user-rc,command="turku-storage-ping a" ssh-ed25519 AAAAa (a)',
+        )
+
+
+class TestUpdateConfigMain(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        tempdir = self.tempdir.name
+        self.config_dir = os.path.join(tempdir, "etc")
+        os.makedirs(os.path.join(self.config_dir, "config.d"))
+        self.authorized_keys_file = os.path.join(tempdir, "ssh", "authorized_keys")
+        with open(os.path.join(self.config_dir, "config.d", "config.json"), "w") as f:
+            json.dump(
+                {
+                    "name": "primary",
+                    "secret": "secret",
+                    "api_url": "https://example.com/",
+                    "volumes": {"default": {"path": tempdir}},
+                    "var_dir": tempdir,
+                    "lock_dir": tempdir,
+                    "ssh_ping_host": "storage.example.com",
+                    "ssh_ping_host_keys": [],
+                    "authorized_keys_file": self.authorized_keys_file,
+                    "authorized_keys_user": pwd.getpwuid(os.getuid()).pw_name,
+                },
+                f,
+            )
+        self.api_replies = []
+        self.api_requests = []
+        for patcher in (
+            unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var")),
+            unittest.mock.patch.object(utils.ApiClient, "call", self.api_call),
+            unittest.mock.patch("sys.argv", ["turku-storage-update-config", "-c", self.config_dir]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def api_call(self, cmd, post_data, idempotent=False):
+        self.api_requests.append(post_data)
+        return self.api_replies.pop(0)
+
+    def run_main(self, api_reply):
+        self.api_replies.append(api_reply)
+        update_config.main()
+        with open(os.path.join(self.tempdir.name, "update_config.json")) as f:
+            state = json.load(f)
+        with open(self.authorized_keys_file) as f:
+            authorized_keys = f.read()
+        return state, authorized_keys, os.stat(self.authorized_keys_file).st_ino
+
+    def test_main(self):
+        state, authorized_keys, inode = self.run_main(
+            {"machines": {"a": make_machine("a"), "b": make_machine("b")}, "machines_revision": 1}
+        )
+        self.assertNotIn("machines_revision", self.api_requests[-1]["storage"])
+        self.assertEqual((state["machines_revision"], sorted(state["machines"])), (1, ["a", "b"]))
+        self.assertIn("AAAAa (a)", authorized_keys)
+
+        # An unchanged fleet leaves authorized_keys alone
+        state, authorized_keys, unchanged_inode = self.run_main({"machines_unchanged": True, "machines_revision": 1})
+        self.assertEqual(self.api_requests[-1]["storage"]["machines_revision"], 1)
+        self.assertEqual(sorted(state["machines"]), ["a", "b"])
+        self.assertEqual(unchanged_inode, inode)
+
+        # A delta is applied to the saved machines
+        state, authorized_keys, inode = self.run_main(
+            {"machines_delta": {"updated": {"c": make_machine("c")}, "removed": ["a"]}, "machines_revision": 2}
+        )
+        self.assertEqual(self.api_requests[-1]["storage"]["machines_revision"], 1)
+        self.assertEqual((state["machines_revision"], sorted(state["machines"])), (2, ["b", "c"]))
+        self.assertNotEqual(inode, unchanged_inode)
+        self.assertNotIn("AAAAa (a)", authorized_keys)
+        self.assertIn("AAAAc (c)", authorized_keys)
+
+        # A file changed behind our back is rewritten, even for an unchanged fleet
+        with open(self.authorized_keys_file, "a") as f:
+            f.write("ssh-ed25519 AAAAlocal\n")
+        state, authorized_keys, inode = self.run_main({"machines_unchanged": True, "machines_revision": 2})
+        self.assertNotIn("AAAAlocal", authorized_keys)
+        self.assertIn("AAAAc (c)", authorized_keys)
@@ -0,0 +1,115 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from turku_storage import catalog, usage
+
+
+class TestUsage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.snapshots_dir = os.path.join(self.tempdir.name, "source.snapshots")
+        os.mkdir(self.snapshots_dir)
+        self.previous = None
+
+    def make_snapshot(self, name, files):
+        """Create a snapshot as rsync --link-dest would, linking unchanged files"""
+        snapshot_dir = os.path.join(self.snapshots_dir, name)
+        os.mkdir(snapshot_dir)
+        for fn, data in files.items():
+            previous_fn = os.path.join(self.snapshots_dir, self.previous, fn) if self.previous else None
+            if previous_fn and os.path.exists(previous_fn):
+                with open(previous_fn) as f:
+                    if f.read() == data:
+                        os.link(previous_fn, os.path.join(snapshot_dir, fn))
+                        continue
+            with open(os.path.join(snapshot_dir, fn), "w") as f:
+                f.write(data)
+        self.previous = name
+        return {fn: os.stat(os.path.join(snapshot_dir, fn)).st_blocks * 512 for fn in files}
+
+    def get_usage(self, rescan=False):
+        result = {}
+        for snapshot in usage.update_usage(catalog.SnapshotCatalog(self.snapshots_dir), rescan=rescan):
+            result[snapshot["name"]] = {k: v for k, v in snapshot["usage"].items() if k != "time"}
+        return result
+
+    def test_update_usage(self):
+        big = "x" * 65536
+        sizes = self.make_snapshot("2020-01-01T00:00:00", {"a": big, "b": big})
+        first = self.get_usage()["2020-01-01T00:00:00"]
+        self.assertEqual(first["bytes"], sizes["a"] + sizes["b"])
+        self.assertEqual(first["unique_bytes"], sizes["a"] + sizes["b"])
+        self.assertIsNone(first["next"])
+
+        # Incremental: the new snapshot links b, taking it from the first
+        new_sizes = self.make_snapshot("2020-01-02T00:00:00", {"a": big + "changed", "b": big})
+        result = self.get_usage()
+        self.assertEqual(result["2020-01-01T00:00:00"]["unique_bytes"], sizes["a"])
+        self.assertEqual(result["2020-01-01T00:00:00"]["shared_next_bytes"], sizes["b"])
+        self.assertEqual(result["2020-01-01T00:00:00"]["next"], "2020-01-02T00:00:00")
+        self.assertEqual(result["2020-01-02T00:00:00"]["shared_prev_bytes"], sizes["b"])
+        self.assertEqual(result["2020-01-02T00:00:00"]["unique_bytes"], new_sizes["a"])
+
+        # Recorded in the snapshot metadata, and matching a full rescan
+        self.assertEqual(self.get_usage(), result)
+        self.assertEqual(self.get_usage(rescan=True), result)
+
+        # Deleting the first snapshot makes b unique to the second
+        shutil.rmtree(os.path.join(self.snapshots_dir, "2020-01-01T00:00:00"))
+        os.unlink(os.path.join(self.snapshots_dir, "2020-01-01T00:00:00.json"))
+        result = self.get_usage()
+        self.assertEqual(result["2020-01-02T00:00:00"]["unique_bytes"], new_sizes["a"] + new_sizes["b"])
+
+    def test_catalog_saved_once(self):
+        for day in range(1, 6):
+            self.make_snapshot("2020-01-0{}T00:00:00".format(day), {"a": str(day)})
+        c = catalog.SnapshotCatalog(self.snapshots_dir)
+        c.load()
+        with unittest.mock.patch.object(c, "save", wraps=c.save) as mock_save:
+            usage.update_usage(c)
+        self.assertEqual(mock_save.call_count, 1)
+        snapshots = catalog.SnapshotCatalog(self.snapshots_dir).snapshots()
+        self.assertTrue(all(snapshot.get("usage") for snapshot in snapshots))
+
+    def test_non_adjacent_bases(self):
+        big = "x" * 65536
+        first = "2020-01-01T00:00:00"
+        sizes = self.make_snapshot(first, {"a": big})
+        self.make_snapshot("2020-01-02T00:00:00", {"a": big + "changed"})
+        self.get_usage()
+        self.assertEqual(self.get_usage()[first]["unique_bytes"], sizes["a"])
+
+        # A third snapshot links a back from the first, as with link_dest_bases
+        self.previous = first
+        self.make_snapshot("2020-01-03T00:00:00", {"a": big})
+        with open(os.path.join(self.snapshots_dir, "2020-01-03T00:00:00.json"), "w") as f:
+            json.dump({"bases": ["2020-01-02T00:00:00", first]}, f)
+
+        # After a backup, only the new snapshot is scanned
+        latest = usage.update_usage(catalog.SnapshotCatalog(self.snapshots_dir), latest_only=True)
+        self.assertEqual(latest[0]["usage"]["unique_bytes"], sizes["a"])
+        self.assertEqual(latest[2]["usage"]["related"], [first])
+
+        result = self.get_usage()
+        self.assertLess(result[first]["unique_bytes"], sizes["a"])
+        self.assertEqual(result[first]["related"], ["2020-01-03T00:00:00"])
+        self.assertEqual(self.get_usage(rescan=True), result)
+
+    def test_clear_usage(self):
+        self.make_snapshot("2020-01-01T00:00:00", {"a": "data"})
+        result = self.get_usage()
+        usage.clear_usage(catalog.SnapshotCatalog(self.snapshots_dir), {"2020-01-01T00:00:00"})
+        self.assertIsNone(catalog.SnapshotCatalog(self.snapshots_dir).snapshots()[0]["usage"])
+        self.assertEqual(self.get_usage(), result)
@@ -5,15 +5,273 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import datetime
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 import unittest.mock
 
 from turku_storage import utils
 
 
+def reference_snapshots_to_delete(retention, snapshots, now):
+    """The list-scanning retention evaluation RetentionPolicy replaced"""
+    to_keep = []
+    for ritem in retention.split(","):
+        ritem = ritem.strip()
+        r = re.findall(r"^earliest of (?:(\d+) )?(day|week|month)", ritem)
+        if len(r) > 0:
+            if r[0][0] == "":
+                earliest_num = 1
+            else:
+                earliest_num = int(r[0][0])
+            earliest_word = r[0][1]
+            if earliest_word == "day":
+                cutoff_time = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=(earliest_num - 1))
+            elif earliest_word == "week":
+                cutoff_time = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(
+                    days=((now.weekday() + 1) % 7)
+                )
+                for i in range(earliest_num - 1):
+                    cutoff_time = (cutoff_time - datetime.timedelta(weeks=1)).replace(
+                        day=1, hour=0, minute=0, second=0, microsecond=0
+                    )
+            else:
+                cutoff_time = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                for i in range(earliest_num - 1):
+                    cutoff_time = (cutoff_time - datetime.timedelta(days=1)).replace(
+                        day=1, hour=0, minute=0, second=0, microsecond=0
+                    )
+            candidate_snapshot = None
+            for snapshot in snapshots:
+                if snapshot["sync_finish"] < cutoff_time:
+                    continue
+                if not candidate_snapshot:
+                    candidate_snapshot = snapshot
+                    continue
+                if snapshot["sync_finish"] >= candidate_snapshot["sync_finish"]:
+                    continue
+                candidate_snapshot = snapshot
+            if candidate_snapshot and candidate_snapshot not in to_keep:
+                to_keep.append(candidate_snapshot)
+        r = re.findall(r"^last (\d+) day", ritem)
+        if len(r) > 0:
+            cutoff_time = now - datetime.timedelta(days=int(r[0]))
+            for snapshot in snapshots:
+                if snapshot["sync_finish"] < cutoff_time:
+                    continue
+                if snapshot not in to_keep:
+                    to_keep.append(snapshot)
+        r = re.findall(r"^last (\d+) snapshot", ritem)
+        if len(r) > 0:
+            last_snapshots = int(r[0])
+            i = 0
+            for snapshot in sorted(snapshots, key=lambda x: x["sync_finish"], reverse=True):
+                i = i + 1
+                if snapshot not in to_keep:
+                    to_keep.append(snapshot)
+                if i == last_snapshots:
+                    break
+    if len(to_keep) == 0:
+        return []
+    return [snapshot for snapshot in snapshots if snapshot not in to_keep]
+
+
 class TestUtils(unittest.TestCase):
     def test_api_call(self):
         with unittest.mock.patch.object(utils, "requests") as mock_requests:
-            mock_requests.post.return_value.json.return_value = {"machine": {"sources": {}}}
+            mock_requests.Session.return_value.post.return_value.json.return_value = {"machine": {"sources": {}}}
             j = utils.api_call("https://example.com/", "cmd", {})
         self.assertIn("machine", j)
+
+    def test_api_client_retry(self):
+        exceptions = utils.import_requests().exceptions
+        import urllib3.exceptions
+
+        with unittest.mock.patch.object(utils, "requests") as mock_requests, unittest.mock.patch.object(utils.time, "sleep"):
+            mock_requests.exceptions = exceptions
+            mock_post = mock_requests.Session.return_value.post
+            mock_post.return_value.status_code = 200
+            mock_post.return_value.json.return_value = {"machines": {}}
+            mock_post.side_effect = [exceptions.ReadTimeout(), mock_post.return_value]
+            client = utils.ApiClient("https://example.com/")
+            j = client.call("cmd", {}, idempotent=True)
+            self.assertIn("machines", j)
+            self.assertEqual(client.stats["cmd"]["retries"], 1)
+
+            mock_post.side_effect = exceptions.ReadTimeout()
+            with self.assertRaises(exceptions.ReadTimeout):
+                client.call("cmd", {})
+            self.assertEqual(client.stats["cmd"]["errors"], 1)
+
+            # A refused connection never reached the server, so is retried
+            # even when the call is not idempotent; a reset might have
+            refused = exceptions.ConnectionError(
+                urllib3.exceptions.MaxRetryError(None, "/cmd", urllib3.exceptions.NewConnectionError(None, "refused"))
+            )
+            mock_post.side_effect = [refused, mock_post.return_value]
+            self.assertIn("machines", client.call("cmd", {}))
+            self.assertEqual(client.stats["cmd"]["retries"], 2)
+            mock_post.side_effect = exceptions.ConnectionError("Connection reset by peer")
+            with self.assertRaises(exceptions.ConnectionError):
+                client.call("cmd", {})
+            self.assertEqual(client.stats["cmd"]["errors"], 2)
+
+    def test_runtime_lock(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            lock = utils.RuntimeLock(name="test", lock_dir=tempdir)
+            lock_file = os.path.join(tempdir, "test.lock")
+            self.assertTrue(utils.lock_holder_alive(lock_file))
+            # Another process cannot take it...
+            proc = subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import sys; from turku_storage import utils; utils.RuntimeLock(name='test', lock_dir=sys.argv[1])",
+                    tempdir,
+                ],
+                env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(utils.__file__))),
+                stderr=subprocess.PIPE,
+                encoding="UTF-8",
+            )
+            self.assertNotEqual(proc.returncode, 0)
+            self.assertIn("BlockingIOError", proc.stderr)
+            # ... and does not clobber the holder's PID trying
+            self.assertTrue(utils.lock_holder_alive(lock_file))
+            # Held per open file, so neither can another thread of this one
+            with self.assertRaises(BlockingIOError):
+                utils.RuntimeLock(name="test", lock_dir=tempdir)
+            self.assertTrue(utils.lock_holder_alive(lock_file))
+            lock.close()
+            self.assertFalse(utils.lock_holder_alive(lock_file))
+
+            with open(lock_file, "w") as f:
+                f.write("%10s\n" % 99999999)
+            with unittest.mock.patch.object(utils.os, "kill", side_effect=ProcessLookupError()):
+                self.assertFalse(utils.lock_holder_alive(lock_file))
+            with unittest.mock.patch.object(utils.os, "kill", side_effect=PermissionError()):
+                self.assertTrue(utils.lock_holder_alive(lock_file))
+
+    def test_lock_holder_pid_reused(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            lock_file = os.path.join(tempdir, "test.lock")
+            with open(lock_file, "w") as f:
+                f.write("%10s\n" % os.getpid())
+            start_time = utils.get_process_start_time(os.getpid())
+            if start_time is None:
+                self.skipTest("Process start times are not available")
+            self.assertLessEqual(start_time, time.time())
+            self.assertTrue(utils.lock_holder_alive(lock_file))
+            # Written before this process started, so by an earlier one with the same PID
+            os.utime(lock_file, (start_time - 60, start_time - 60))
+            self.assertFalse(utils.lock_holder_alive(lock_file))
+
+    def test_runtime_lock_context_manager(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            lock_file = os.path.join(tempdir, "test.lock")
+            with utils.RuntimeLock(name="test", lock_dir=tempdir) as lock:
+                self.assertIsInstance(lock, utils.RuntimeLock)
+                self.assertTrue(utils.lock_holder_alive(lock_file))
+            self.assertFalse(os.path.exists(lock_file))
+            # Released on exit, so the lock can be taken again
+            with utils.RuntimeLock(name="test", lock_dir=tempdir):
+                pass
+
+    def make_snapshots(self, now, hours):
+        return [{"name": str(h), "sync_finish": now - datetime.timedelta(hours=h)} for h in hours]
+
+    def test_retention_last_snapshots(self):
+        now = datetime.datetime(2015, 2, 20, 12, 0, 0).astimezone()
+        snapshots = self.make_snapshots(now, [5, 1, 3, 2, 4])
+        to_keep, to_delete = utils.RetentionPolicy("last 2 snapshots").evaluate(snapshots, now=now)
+        self.assertEqual([s["name"] for s in to_keep], ["1", "2"])
+        self.assertEqual([s["name"] for s in to_delete], ["5", "3", "4"])
+
+    def test_retention_earliest_and_last_days(self):
+        now = datetime.datetime(2015, 2, 20, 12, 0, 0).astimezone()
+        snapshots = self.make_snapshots(now, [1, 6, 11, 30, 60, 400])
+        policy = utils.RetentionPolicy("earliest of month, last 1 day")
+        to_delete = policy.get_snapshots_to_delete(snapshots, now=now)
+        self.assertEqual([s["name"] for s in to_delete], ["30", "60"])
+
+    def test_retention_nothing_kept(self):
+        now = datetime.datetime(2015, 2, 20, 12, 0, 0).astimezone()
+        snapshots = self.make_snapshots(now, [100, 200])
+        self.assertEqual(utils.RetentionPolicy("last 1 day").get_snapshots_to_delete(snapshots, now=now), [])
+
+    def test_retention_large(self):
+        now = datetime.datetime(2015, 2, 20, 12, 0, 0).astimezone()
+        snapshots = self.make_snapshots(now, range(100000))
+        policy = utils.RetentionPolicy("last 5 days, earliest of day, earliest of 8 weeks, earliest of 12 months, last 7 snapshots")
+        time_begin = time.time()
+        to_keep, to_delete = policy.evaluate(snapshots, now=now)
+        self.assertLess(time.time() - time_begin, 1.0)
+        self.assertEqual(len(to_keep) + len(to_delete), 100000)
+
+    def test_retention_matches_reference(self):
+        rng = random.Random(1)
+        rules = [
+            "earliest of day",
+            "earliest of 2 days",
+            "earliest of week",
+            "earliest of 3 weeks",
+            "earliest of month",
+            "earliest of 4 months",
+            "last 0 days",
+            "last 3 days",
+            "last 40 days",
+            "last 0 snapshots",
+            "last 1 snapshots",
+            "last 5 snapshots",
+            "last 50 snapshots",
+            "bogus",
+        ]
+        for i in range(500):
+            now = datetime.datetime(2015, 2, 20, 12, 0, 0).astimezone() + datetime.timedelta(hours=rng.randrange(24 * 60))
+            # Few distinct hours, so many snapshots tie on sync_finish
+            hours = [rng.randrange(24 * 90) for h in range(rng.randrange(12))]
+            snapshots = [
+                {"name": str(n), "sync_finish": now - datetime.timedelta(hours=rng.choice(hours))}
+                for n in range(rng.randrange(40) if hours else 0)
+            ]
+            retention = ", ".join(rng.sample(rules, rng.randrange(1, 4)))
+            self.assertEqual(
+                [s["name"] for s in utils.RetentionPolicy(retention).get_snapshots_to_delete(snapshots, now=now)],
+                [s["name"] for s in reference_snapshots_to_delete(retention, snapshots, now)],
+                (retention, now, snapshots),
+            )
+
+    def test_load_config_cached(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            config_dir = os.path.join(tempdir, "etc")
+            os.makedirs(os.path.join(config_dir, "config.d"))
+            config_file = os.path.join(config_dir, "config.d", "config.json")
+            config_in = {
+                "name": "primary",
+                "secret": "secret",
+                "api_url": "https://example.com/",
+                "volumes": {"default": {"path": tempdir}},
+                "ssh_ping_host_keys": [],
+                "log_file": "syslog",
+            }
+            with open(config_file, "w") as f:
+                json.dump(config_in, f)
+            with unittest.mock.patch.object(utils, "DEFAULT_VAR_DIR", os.path.join(tempdir, "var")):
+                with unittest.mock.patch.object(utils.socket, "getfqdn", return_value="storage.example.com") as mock_getfqdn:
+                    config = utils.load_config_cached(config_dir)
+                    self.assertEqual(config["ssh_ping_host"], "storage.example.com")
+                    self.assertEqual(utils.load_config_cached(config_dir), config)
+                    self.assertEqual(mock_getfqdn.call_count, 1)
+
+                    config_in["name"] = "secondary"
+                    with open(config_file, "w") as f:
+                        json.dump(config_in, f)
+                    os.utime(config_file, ns=(0, 0))
+                    self.assertEqual(utils.load_config_cached(config_dir)["name"], "secondary")
+                    self.assertEqual(mock_getfqdn.call_count, 2)
@@ -0,0 +1,77 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+from .utils import safe_write
+
+
+class Timeline:
+    """Named timing spans, measured with the monotonic clock"""
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        begin = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spans.append((name, begin, time.monotonic()))
+
+    def durations(self, names=None):
+        """Return the total seconds spent in each span name, or only those in names"""
+        durations = {}
+        with self.lock:
+            for name, begin, end in self.spans:
+                if names is not None and name not in names:
+                    continue
+                durations[name] = durations.get(name, 0.0) + (end - begin)
+        return durations
+
+
+def span(timeline, name):
+    """Return timeline.span(name), or a no-op context if timeline is None"""
+    if timeline is None:
+        return contextlib.nullcontext()
+    return timeline.span(name)
+
+
+def write_trace(file, timelines):
+    """Write timelines as a Trace Event Format file, one track each
+
+    The file can be loaded in Perfetto or chrome://tracing.
+    """
+    spans = [(tid, span) for tid, timeline in enumerate(timelines) for span in timeline.spans]
+    if not spans:
+        return
+    origin = min(begin for tid, (name, begin, end) in spans)
+    events = [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": timeline.name}}
+        for tid, timeline in enumerate(timelines)
+    ]
+    for tid, (name, begin, end) in spans:
+        events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "pid": os.getpid(),
+                "tid": tid,
+                "ts": round((begin - origin) * 1000000),
+                "dur": round((end - begin) * 1000000),
+            }
+        )
+    with safe_write(file) as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
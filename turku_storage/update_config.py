@@ -5,6 +5,8 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import hashlib
+import json
 import logging
 import os
 import random
@@ -15,7 +17,84 @@ try:
 except ImportError as e:
     pwd = e
 
-from .utils import load_config, RuntimeLock, api_call, safe_write
+from .metrics import prune_ping_metrics, write_update_config_metrics
+from .placement import get_space_totals, get_volume_status
+from .utils import load_config, RuntimeLock, get_api_client, safe_write, write_config_cache
+
+
+def get_state_file(config):
+    return os.path.join(config["var_dir"], "update_config.json")
+
+
+def load_state(config):
+    """Return the state saved by the last successful run, or an empty dict"""
+    try:
+        with open(get_state_file(config)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_state(config, state):
+    try:
+        with safe_write(get_state_file(config)) as f:
+            json.dump(state, f, sort_keys=True)
+    except OSError as e:
+        logging.warning("Cannot write update-config state {}: {}".format(get_state_file(config), e))
+
+
+def get_machines(api_reply, state):
+    """Return the full machines map from an API reply
+
+    The API may answer a request carrying machines_revision with
+    machines_unchanged, or with a machines_delta of updated and removed
+    machines, instead of the full map.
+    """
+    if "machines" in api_reply:
+        return api_reply["machines"]
+    if "machines" not in state:
+        raise ValueError("API sent an incremental machines reply, but no previous machines are known")
+    if api_reply.get("machines_unchanged"):
+        return state["machines"]
+    if "machines_delta" in api_reply:
+        machines = dict(state["machines"])
+        machines.update(api_reply["machines_delta"].get("updated", {}))
+        for machine_uuid in api_reply["machines_delta"].get("removed", []):
+            machines.pop(machine_uuid, None)
+        return machines
+    raise ValueError("API reply does not contain machines")
+
+
+def build_authorized_keys(config, machines):
+    out = [
+        "# Automatically generated, please do not edit\n",
+        "# Local additions may be placed in %s.static\n" % config["authorized_keys_file"],
+    ]
+    if os.path.isfile(config["authorized_keys_file"] + ".static"):
+        with open(config["authorized_keys_file"] + ".static") as f:
+            out.append(f.read())
+    for machine_uuid in machines:
+        machine = machines[machine_uuid]
+        out.append(
+            '%s,command="%s %s" %s (%s)\n'
+            % (
+                "no-pty,no-agent-forwarding,no-X11-forwarding,no-user-rc",
+                config["authorized_keys_command"],
+                machine_uuid,
+                machine["ssh_public_key"],
+                machine["unit_name"],
+            )
+        )
+    return "".join(out)
+
+
+def get_file_signature(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_uid, st.st_gid]
 
 
 def parse_args():
@@ -40,29 +119,13 @@ def main():
         time.sleep(random.uniform(0, args.wait))
 
     config = load_config(args.config_dir)
+    # Refresh the cache used by turku-storage-ping, e.g. if the FQDN changed
+    write_config_cache(args.config_dir, config)
 
     lock = RuntimeLock(lock_dir=config["lock_dir"])
 
-    space_total = 0
-    space_available = 0
-    seen_devs = []
-    for volume_name in config["volumes"]:
-        v = config["volumes"][volume_name]
-        st_dev = os.stat(v["path"]).st_dev
-        if st_dev in seen_devs:
-            continue
-        seen_devs.append(st_dev)
-        try:
-            sv = os.statvfs(v["path"])
-        except OSError:
-            continue
-        s_t = sv.f_bsize * sv.f_blocks / 1048576
-        s_a = sv.f_bsize * sv.f_bavail / 1048576
-        pct_used = (1.0 - float(s_a) / float(s_t)) * 100.0
-        if (not v["accept_new"]) or (pct_used > v["accept_new_high_water_pct"]):
-            s_a = 0
-        space_total += s_t
-        space_available += s_a
+    volumes = get_volume_status(config)
+    space_total, space_available = get_space_totals(config, volumes)
 
     api_out = {
         "storage": {
@@ -92,22 +155,16 @@ def main():
     if "published" in config:
         api_out["storage"]["published"] = config["published"]
 
-    api_reply = api_call(config["api_url"], "storage_update_config", api_out)
+    state = load_state(config)
+    if "machines" in state and state.get("machines_revision") is not None:
+        api_out["storage"]["machines_revision"] = state["machines_revision"]
 
-    authorized_keys_out = "# Automatically generated, please do not edit\n"
-    authorized_keys_out += "# Local additions may be placed in %s.static\n" % config["authorized_keys_file"]
-    if os.path.isfile(config["authorized_keys_file"] + ".static"):
-        with open(config["authorized_keys_file"] + ".static") as f:
-            authorized_keys_out += f.read()
-    for machine_uuid in api_reply["machines"]:
-        machine = api_reply["machines"][machine_uuid]
-        authorized_keys_out += '%s,command="%s %s" %s (%s)\n' % (
-            "no-pty,no-agent-forwarding,no-X11-forwarding,no-user-rc",
-            config["authorized_keys_command"],
-            machine_uuid,
-            machine["ssh_public_key"],
-            machine["unit_name"],
-        )
+    api = get_api_client(config)
+    api_reply = api.call("storage_update_config", api_out, idempotent=True)
+    machines = get_machines(api_reply, state)
+
+    authorized_keys_out = build_authorized_keys(config, machines)
+    authorized_keys_hash = hashlib.sha256(authorized_keys_out.encode("UTF-8")).hexdigest()
 
     if isinstance(pwd, ImportError):
         f_uid = None
@@ -115,14 +172,36 @@ def main():
     else:
         f_uid = pwd.getpwnam(config["authorized_keys_user"]).pw_uid
         f_gid = pwd.getpwnam(config["authorized_keys_user"]).pw_gid
-    keys_dirname = os.path.dirname(config["authorized_keys_file"])
-    if not os.path.isdir(keys_dirname):
-        os.makedirs(keys_dirname)
-        if f_uid is not None:
-            os.chown(keys_dirname, f_uid, f_gid)
-    with safe_write(config["authorized_keys_file"]) as f:
-        if f_uid is not None:
-            os.fchown(f.fileno(), f_uid, f_gid)
-        f.write(authorized_keys_out)
+    # Skip the write if the content is unchanged and the file has not
+    # been touched since we last wrote it
+    if (
+        state.get("authorized_keys_sha256") == authorized_keys_hash
+        and state.get("authorized_keys_signature") is not None
+        and state["authorized_keys_signature"] == get_file_signature(config["authorized_keys_file"])
+    ):
+        logging.debug("{} is unchanged".format(config["authorized_keys_file"]))
+    else:
+        keys_dirname = os.path.dirname(config["authorized_keys_file"])
+        if not os.path.isdir(keys_dirname):
+            os.makedirs(keys_dirname)
+            if f_uid is not None:
+                os.chown(keys_dirname, f_uid, f_gid)
+        with safe_write(config["authorized_keys_file"]) as f:
+            if f_uid is not None:
+                os.fchown(f.fileno(), f_uid, f_gid)
+            f.write(authorized_keys_out)
+        logging.debug("Wrote {} ({} machines)".format(config["authorized_keys_file"], len(machines)))
+
+    new_state = {
+        "machines_revision": api_reply.get("machines_revision"),
+        "machines": machines,
+        "authorized_keys_sha256": authorized_keys_hash,
+        "authorized_keys_signature": get_file_signature(config["authorized_keys_file"]),
+    }
+    if new_state != state:
+        save_state(config, new_state)
+
+    write_update_config_metrics(config, volumes, len(machines), api.stats)
+    prune_ping_metrics(config, machines.keys())
 
     lock.close()
@@ -0,0 +1,335 @@
+# SPDX-PackageName: turku-storage
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-storage
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import glob
+import json
+import logging
+import os
+import stat
+import sys
+import time
+
+from .catalog import SnapshotCatalog
+from .utils import load_config, RetentionPolicy, RuntimeLock, safe_write
+
+
+def scan_snapshot(snapshot_dir, prev_dir=None, next_dir=None):
+    """Walk a link-dest snapshot once, returning its space usage
+
+    An entry whose inode has a single link is held only by this
+    snapshot, so deleting the snapshot frees it.  An entry with more
+    links is shared, and is compared by inode with the same path in
+    the neighbouring snapshots, which is where rsync --link-dest links
+    it from.  Hard links within a single snapshot are counted as
+    shared, as are files linked from outside the source, such as by
+    turku-storage-dedup.  Sizes are allocated bytes (st_blocks).
+    """
+    usage = {
+        "entries": 0,
+        "bytes": 0,
+        "unique_bytes": 0,
+        "shared_prev_bytes": 0,
+        "shared_next_bytes": 0,
+        # Bytes which were unique to prev_dir until this snapshot linked them
+        "prev_unique_lost": 0,
+    }
+    dirs = [""]
+    while dirs:
+        rel_dir = dirs.pop()
+        with os.scandir(os.path.join(snapshot_dir, rel_dir)) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                size = st.st_blocks * 512
+                usage["entries"] += 1
+                usage["bytes"] += size
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(rel_path)
+                    usage["unique_bytes"] += size
+                    continue
+                if st.st_nlink == 1:
+                    usage["unique_bytes"] += size
+                    continue
+                for neighbour_dir, key in ((prev_dir, "shared_prev_bytes"), (next_dir, "shared_next_bytes")):
+                    if neighbour_dir is None:
+                        continue
+                    try:
+                        neighbour_st = os.lstat(os.path.join(neighbour_dir, rel_path))
+                    except OSError:
+                        continue
+                    if (neighbour_st.st_dev, neighbour_st.st_ino) != (st.st_dev, st.st_ino):
+                        continue
+                    usage[key] += size
+                    if key == "shared_prev_bytes" and st.st_nlink == 2:
+                        usage["prev_unique_lost"] += size
+    return usage
+
+
+def write_usage(snapshot, usage):
+    """Record usage in a snapshot's JSON metadata, creating it if needed
+
+    Returns whether it was written.  The catalog is updated separately,
+    once all snapshots of a source are done.
+    """
+    info_file = snapshot["directory"].parent.joinpath("{}.json".format(snapshot["directory"].name))
+    try:
+        with info_file.open() as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        info = {}
+    if not snapshot["directory"].is_dir():
+        # Removed by retention in the meantime
+        return False
+    info["usage"] = usage
+    with safe_write(str(info_file)) as f:
+        json.dump(info, f, sort_keys=True, indent=4)
+    snapshot["usage"] = usage
+    return True
+
+
+def get_bases(snapshot):
+    """Return the names of the --link-dest bases a snapshot was made against"""
+    if snapshot.get("bases") is not None:
+        return snapshot["bases"]
+    return [snapshot["base"]] if snapshot.get("base") else []
+
+
+def get_related(snapshots):
+    """Return, for each snapshot, the other snapshots it may share files with beyond its neighbours
+
+    These are the non-adjacent snapshots it was linked against (with
+    link_dest_bases or link_dest_retention_anchors), and those linked
+    against it.
+    """
+    names = [snapshot["directory"].name for snapshot in snapshots]
+    related = [set() for snapshot in snapshots]
+    positions = {name: i for i, name in enumerate(names)}
+    for i, snapshot in enumerate(snapshots):
+        for base in get_bases(snapshot):
+            j = positions.get(base)
+            if j is not None and abs(i - j) > 1:
+                related[i].add(base)
+                related[j].add(names[i])
+    return [sorted(x) for x in related]
+
+
+def update_usage(catalog, rescan=False, latest_only=False):
+    """Bring the usage recorded with each snapshot up to date
+
+    Usage is recorded along with the neighbouring snapshots it was
+    computed against, and the other snapshots it was linked with.
+    Within a source, space only moves between snapshots linked with each
+    other, so a snapshot is only rescanned when one of them was deleted
+    or, for a non-adjacent base, a new snapshot was linked against it.
+    When a new snapshot arrives, its scan also updates the usage of the
+    previous snapshot, instead of rescanning it.  With latest_only,
+    only the latest snapshot is scanned, as after a backup.
+
+    Links from outside the source are not tracked: turku-storage-dedup
+    clears the usage of the snapshots it links files in, but space it
+    frees in their other snapshots is only seen with rescan.
+
+    Returns the snapshots, oldest first.
+    """
+    snapshots = sorted(catalog.snapshots(), key=lambda x: x["sync_finish"])
+    names = [snapshot["directory"].name for snapshot in snapshots]
+    related = get_related(snapshots)
+
+    def is_current(i):
+        usage = snapshots[i].get("usage")
+        return (
+            bool(usage)
+            and usage.get("prev") == (names[i - 1] if i > 0 else None)
+            and usage.get("next") == (names[i + 1] if i + 1 < len(names) else None)
+            and usage.get("related", []) == related[i]
+        )
+
+    def is_newest_pending(i):
+        # Only a new latest snapshot arrived since this one was scanned;
+        # it is fixed up when the new snapshot is scanned.
+        usage = snapshots[i].get("usage")
+        return (
+            i + 2 == len(names)
+            and bool(usage)
+            and usage.get("prev") == (names[i - 1] if i > 0 else None)
+            and usage.get("next") is None
+            and usage.get("related", []) == related[i]
+            and not is_current(i + 1)
+        )
+
+    updated = {}
+    for i, snapshot in enumerate(snapshots):
+        prev = snapshots[i - 1] if i > 0 else None
+        prev_name = names[i - 1] if i > 0 else None
+        next_name = names[i + 1] if i + 1 < len(names) else None
+        if latest_only and next_name is not None:
+            continue
+        if (not rescan) and (is_current(i) or is_newest_pending(i)):
+            continue
+        time_begin = time.monotonic()
+        try:
+            usage = scan_snapshot(
+                str(snapshot["directory"]),
+                str(prev["directory"]) if prev else None,
+                str(snapshots[i + 1]["directory"]) if next_name else None,
+            )
+        except OSError as e:
+            logging.warning("Cannot scan {}: {}".format(snapshot["directory"], e))
+            continue
+        logging.debug("Scanned {} in {:.1f}s".format(snapshot["directory"], time.monotonic() - time_begin))
+        prev_unique_lost = usage.pop("prev_unique_lost")
+        usage.update({"prev": prev_name, "next": next_name, "related": related[i], "time": time.time()})
+        if write_usage(snapshot, usage):
+            updated[snapshot["directory"].name] = {"usage": usage}
+        prev_usage = prev.get("usage") if prev else None
+        if (
+            next_name is None
+            and prev_usage
+            and prev_usage.get("next") is None
+            and prev_usage.get("prev") == (names[i - 2] if i > 1 else None)
+            and prev_usage.get("related", []) == related[i - 1]
+        ):
+            # The previous snapshot was scanned before this one existed.
+            # As this is the latest snapshot, anything it shares with the
+            # previous one at two links was unique to it until now.
+            prev_usage = dict(prev_usage)
+            prev_usage["unique_bytes"] = max(prev_usage["unique_bytes"] - prev_unique_lost, 0)
+            prev_usage["shared_next_bytes"] = usage["shared_prev_bytes"]
+            prev_usage["next"] = snapshot["directory"].name
+            if write_usage(prev, prev_usage):
+                updated[prev["directory"].name] = {"usage": prev_usage}
+    if updated:
+        catalog.update(updated)
+    return snapshots
+
+
+def clear_usage(catalog, names):
+    """Forget the usage recorded with snapshots whose files were linked elsewhere, so it is rescanned"""
+    updated = {}
+    for snapshot in catalog.snapshots():
+        if snapshot["directory"].name in names and snapshot.get("usage"):
+            if write_usage(snapshot, None):
+                updated[snapshot["directory"].name] = {"usage": None}
+    if updated:
+        catalog.update(updated)
+
+
+def find_sources(config, machine=None):
+    """Return (machine name, machine UUID, source, snapshots directory) for all sources with snapshots"""
+    var_machines = os.path.join(config["var_dir"], "machines")
+    unit_names = {}
+    uuids = []
+    try:
+        names = os.listdir(var_machines)
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            target = os.readlink(os.path.join(var_machines, name))
+        except OSError:
+            continue
+        if os.path.isabs(target):
+            uuids.append(name)
+        else:
+            unit_names[target] = name
+    if machine is not None:
+        uuids = [machine_uuid for machine_uuid in uuids if machine in (machine_uuid, unit_names.get(machine_uuid))]
+    sources = []
+    for machine_uuid in sorted(uuids, key=lambda x: unit_names.get(x, x)):
+        machine_dir = os.path.realpath(os.path.join(var_machines, machine_uuid))
+        for snapshots_dir in sorted(glob.glob(os.path.join(glob.escape(machine_dir), "*.snapshots"))):
+            if not os.path.isdir(snapshots_dir):
+                continue
+            source_name = os.path.basename(snapshots_dir)[: -len(".snapshots")]
+            sources.append((unit_names.get(machine_uuid, machine_uuid), machine_uuid, source_name, snapshots_dir))
+    return sources
+
+
+def format_bytes(num):
+    if num < 1024:
+        return "{} B".format(num)
+    for unit in ("KiB", "MiB", "GiB", "TiB"):
+        num /= 1024.0
+        if num < 1024 or unit == "TiB":
+            return "{:.1f} {}".format(num, unit)
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Show how much space deleting each retention candidate would reclaim",
+    )
+    parser.add_argument("--config-dir", "-c", type=str, default="/etc/turku-storage")
+    parser.add_argument(
+        "--retention",
+        "-r",
+        type=str,
+        help="Retention string (default: the one recorded with each source's latest snapshot)",
+    )
+    parser.add_argument("--all", "-a", action="store_true", help="List kept snapshots as well as retention candidates")
+    parser.add_argument("--rescan", action="store_true", help="Rescan all snapshots, ignoring recorded usage")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("machine", nargs="?", help="Machine UUID or unit name (default: all machines)")
+    parser.add_argument("source", nargs="?", help="Source name (default: all sources)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+
+    config = load_config(args.config_dir)
+
+    lock = RuntimeLock(lock_dir=config["lock_dir"])
+
+    sources = [source for source in find_sources(config, args.machine) if args.source in (None, source[2])]
+    if args.machine is not None and not sources:
+        print("No snapshots found for {}".format(" ".join(x for x in (args.machine, args.source) if x)), file=sys.stderr)
+        sys.exit(1)
+
+    for machine_name, machine_uuid, source_name, snapshots_dir in sources:
+        catalog = SnapshotCatalog(snapshots_dir)
+        snapshots = update_usage(catalog, rescan=args.rescan)
+        if not snapshots:
+            continue
+        retention = args.retention
+        if retention is None:
+            for snapshot in reversed(snapshots):
+                if snapshot.get("retention"):
+                    retention = snapshot["retention"]
+                    break
+        if retention is None:
+            to_delete = []
+        else:
+            to_keep, to_delete = RetentionPolicy(retention).evaluate(snapshots)
+        deleted = set(id(snapshot) for snapshot in to_delete)
+        print("{} {} (retention: {})".format(machine_name, source_name, retention))
+        for snapshot in snapshots:
+            if id(snapshot) not in deleted and not args.all:
+                continue
+            usage = snapshot.get("usage") or {}
+            print(
+                "    {:6} {}  {:>12} total  {:>12} reclaimable  {:>12} shared with previous".format(
+                    "delete" if id(snapshot) in deleted else "keep",
+                    snapshot["name"],
+                    format_bytes(usage.get("bytes", 0)),
+                    format_bytes(usage.get("unique_bytes", 0)),
+                    format_bytes(usage.get("shared_prev_bytes", 0)),
+                )
+            )
+        # Deleting neighbouring candidates together can free space they
+        # share with each other, so the sum is a lower bound
+        print(
+            "    {} to delete, at least {} reclaimable".format(
+                len(to_delete), format_bytes(sum((snapshot.get("usage") or {}).get("unique_bytes", 0) for snapshot in to_delete))
+            )
+        )
+
+    lock.close()
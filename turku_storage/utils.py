@@ -5,11 +5,14 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import bisect
 import copy
 import datetime
 import errno
 import fcntl
+import functools
 import glob
+import importlib
 import json
 import logging
 import os
@@ -17,21 +20,36 @@ import random
 import re
 import socket
 import sys
+import threading
 import time
 import urllib.parse
 import uuid
 
-import requests
+# Heavy and optional modules are only imported when first needed, as
+# turku-storage-ping is started for every agent connection.
+requests = None
+_lazy_modules = {}
 
-try:
-    import systemd.daemon as systemd_daemon
-except ImportError as e:
-    systemd_daemon = e
 
-try:
-    import yaml
-except ImportError as e:
-    yaml = e
+def lazy_import(name):
+    """Import a module on first use, returning the ImportError if it is unavailable"""
+    if name not in _lazy_modules:
+        try:
+            _lazy_modules[name] = importlib.import_module(name)
+        except ImportError as e:
+            _lazy_modules[name] = e
+    return _lazy_modules[name]
+
+
+def import_requests():
+    global requests
+    if requests is None:
+        import requests
+        import requests.adapters  # noqa: F401
+    return requests
+
+
+DEFAULT_VAR_DIR = "/var/lib/turku-storage"
 
 
 class RuntimeLock:
@@ -53,13 +71,21 @@ class RuntimeLock:
                 raise FileNotFoundError("Suitable lock directory not found")
         filename = os.path.join(lock_dir, "{}.lock".format(name))
 
-        # Do not set fh to self.fh until lockf/flush/etc all succeed
-        fh = open(filename, "w")
+        # Do not set fh to self.fh until flock/flush/etc all succeed.
+        # The file is only truncated once locked, so a failed attempt
+        # leaves the holder's PID in place for lock_holder_alive().
+        # flock() locks belong to the open file rather than the process,
+        # so threads of turku-storage-daemon exclude each other too, and
+        # reading the file elsewhere in the process does not release it.
+        fh = open(filename, "a+")
         try:
-            fcntl.lockf(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError as e:
             if e.errno in (errno.EACCES, errno.EAGAIN):
+                fh.close()
                 raise
+        fh.seek(0)
+        fh.truncate()
         fh.write("%10s\n" % os.getpid())
         fh.flush()
         fh.seek(0)
@@ -86,12 +112,51 @@ class RuntimeLock:
         return result
 
 
+def get_process_start_time(pid):
+    """Return the Unix time a process started at, or None if unknown (only known on Linux)"""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # The command name may contain spaces and parentheses
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime "))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+def lock_holder_alive(filename):
+    """Return whether the process which wrote a RuntimeLock file is running
+
+    The lock itself is not probed, as briefly holding it would make its
+    owner fail to start at that moment.  A process which started after
+    the file was written only reused the holder's PID.
+    """
+    try:
+        with open(filename) as f:
+            pid = int(f.read().strip())
+            written = os.fstat(f.fileno()).st_mtime
+    except (OSError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    start_time = get_process_start_time(pid)
+    # The boot time is only known to the second
+    if start_time is not None and start_time > written + 1:
+        return False
+    return True
+
+
 def config_load_file(file):
     """Load and return a .json or (if available) .yaml configuration file"""
     with open(file) as f:
         try:
-            if file.endswith(".yaml") and not isinstance(yaml, ImportError):
-                return yaml.safe_load(f)
+            if file.endswith(".yaml") and not isinstance(lazy_import("yaml"), ImportError):
+                return lazy_import("yaml").safe_load(f)
             else:
                 return json.load(f)
         except Exception:
@@ -130,16 +195,135 @@ def safe_write(file, **kwargs):
     return fh
 
 
+def connection_not_established(e):
+    """Return whether a requests exception was raised before the request was sent"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.exceptions.ConnectionError):
+        return False
+    import urllib3.exceptions
+
+    # Refused connections and failed name lookups; a connection reset
+    # may come after the server received the request
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class ApiClient:
+    """Turku API client
+
+    Connections are kept alive and reused between calls.  Calls which
+    never reached the server (the connection could not be established)
+    are always retried; calls marked idempotent are also retried on
+    other connection errors, read timeouts and server errors.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_url, connect_timeout=5, read_timeout=30, retries=3, backoff=0.5, pool_maxsize=10):
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_maxsize = pool_maxsize
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def get_session(self):
+        with self.session_lock:
+            if self.session is None:
+                import_requests()
+                self.session = requests.Session()
+                self.session.headers.update({"Accept": "application/json"})
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_maxsize)
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            return self.session
+
+    def record(self, cmd, elapsed, retries, error):
+        with self.stats_lock:
+            if cmd not in self.stats:
+                self.stats[cmd] = {"calls": 0, "errors": 0, "retries": 0, "time_total": 0.0, "time_max": 0.0}
+            stats = self.stats[cmd]
+            stats["calls"] += 1
+            stats["retries"] += retries
+            stats["time_total"] += elapsed
+            stats["time_max"] = max(stats["time_max"], elapsed)
+            if error:
+                stats["errors"] += 1
+
+    def call(self, cmd, post_data, idempotent=False):
+        url = urllib.parse.urljoin(self.api_url + "/", cmd)
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug("API request: {} {}".format(url, json.dumps(post_data, sort_keys=True, indent=4)))
+        session = self.get_session()
+        time_begin = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                r = session.post(url, json=post_data, timeout=self.timeout)
+                if not (idempotent and r.status_code in self.retry_statuses and attempt < self.retries):
+                    r.raise_for_status()
+                    response_json = r.json()
+                    break
+                reason = "HTTP status {}".format(r.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not (idempotent or connection_not_established(e)) or attempt >= self.retries:
+                    self.record(cmd, time.monotonic() - time_begin, attempt, True)
+                    raise
+                reason = str(e)
+            except Exception:
+                self.record(cmd, time.monotonic() - time_begin, attempt, True)
+                raise
+            delay = self.backoff * (2**attempt) * random.uniform(0.5, 1.5)
+            attempt += 1
+            logging.warning("API call {} failed ({}), retrying in {:.1f}s".format(cmd, reason, delay))
+            time.sleep(delay)
+        self.record(cmd, time.monotonic() - time_begin, attempt, False)
+        if debug:
+            logging.debug("API response: {} {}".format(r.status_code, json.dumps(response_json, sort_keys=True, indent=4)))
+        return response_json
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+    def stats_summary(self):
+        with self.stats_lock:
+            return [
+                "{}: {} calls, {} errors, {} retries, {:.3f}s avg, {:.3f}s max".format(
+                    cmd,
+                    stats["calls"],
+                    stats["errors"],
+                    stats["retries"],
+                    stats["time_total"] / stats["calls"],
+                    stats["time_max"],
+                )
+                for cmd, stats in sorted(self.stats.items())
+            ]
+
+
+def get_api_client(config):
+    """Return an ApiClient configured from a load_config() dict"""
+    return ApiClient(
+        config["api_url"],
+        connect_timeout=config["api_connect_timeout"],
+        read_timeout=config["api_read_timeout"],
+        retries=config["api_retries"],
+    )
+
+
+_api_clients = {}
+
+
 def api_call(api_url, cmd, post_data, timeout=5):
     """Turku API call client"""
-    url = urllib.parse.urljoin(api_url + "/", cmd)
-    headers = {"Accept": "application/json"}
-    logging.debug("API request: {} {}".format(url, json.dumps(post_data, sort_keys=True, indent=4)))
-    r = requests.post(url, json=post_data, headers=headers, timeout=timeout)
-    r.raise_for_status()
-    response_json = r.json()
-    logging.debug("API response: {} {}".format(r.status_code, json.dumps(response_json, sort_keys=True, indent=4)))
-    return response_json
+    if (api_url, timeout) not in _api_clients:
+        _api_clients[(api_url, timeout)] = ApiClient(api_url, connect_timeout=timeout, read_timeout=timeout)
+    return _api_clients[(api_url, timeout)].call(cmd, post_data)
 
 
 def random_weighted(m):
@@ -164,7 +348,7 @@ def load_config(config_dir):
     config_files = [
         os.path.join(config_d, fn)
         for fn in os.listdir(config_d)
-        if (fn.endswith(".json") or (fn.endswith(".yaml") and not isinstance(yaml, ImportError)))
+        if (fn.endswith(".json") or (fn.endswith(".yaml") and not isinstance(lazy_import("yaml"), ImportError)))
         and os.path.isfile(os.path.join(config_d, fn))
         and os.access(os.path.join(config_d, fn), os.R_OK)
     ]
@@ -179,6 +363,32 @@ def load_config(config_dir):
 
     if "accept_new_high_water_pct" not in config:
         config["accept_new_high_water_pct"] = 80
+    if "accept_new_inodes_high_water_pct" not in config:
+        config["accept_new_inodes_high_water_pct"] = 90
+    if "placement_write_reference" not in config:
+        config["placement_write_reference"] = 104857600
+    if "volume_status_max_age" not in config:
+        config["volume_status_max_age"] = 30
+    if "reaper_ionice_class" not in config:
+        config["reaper_ionice_class"] = "idle"
+    if "reaper_threads" not in config:
+        config["reaper_threads"] = 4
+    if "reaper_ops_per_sec" not in config:
+        config["reaper_ops_per_sec"] = None
+    if "max_concurrent_sources" not in config:
+        config["max_concurrent_sources"] = 1
+    if "max_concurrent_rsyncs" not in config:
+        config["max_concurrent_rsyncs"] = None
+    if "max_concurrent_deletions" not in config:
+        config["max_concurrent_deletions"] = None
+    if "admission_timeout" not in config:
+        config["admission_timeout"] = 3600
+    if "api_connect_timeout" not in config:
+        config["api_connect_timeout"] = 5
+    if "api_read_timeout" not in config:
+        config["api_read_timeout"] = 30
+    if "api_retries" not in config:
+        config["api_retries"] = 3
 
     for volume_name in config["volumes"]:
         if "path" not in config["volumes"][volume_name]:
@@ -188,11 +398,23 @@ def load_config(config_dir):
             config["volumes"][volume_name]["accept_new"] = True
         if "accept_new_high_water_pct" not in config["volumes"][volume_name]:
             config["volumes"][volume_name]["accept_new_high_water_pct"] = config["accept_new_high_water_pct"]
+        for k in ("accept_new_inodes_high_water_pct", "placement_write_reference"):
+            if k not in config["volumes"][volume_name]:
+                config["volumes"][volume_name][k] = config[k]
+        for k in ("reaper_ionice_class", "reaper_threads", "reaper_ops_per_sec"):
+            if k not in config["volumes"][volume_name]:
+                config["volumes"][volume_name][k] = config[k]
+        if "max_concurrent_sources" not in config["volumes"][volume_name]:
+            config["volumes"][volume_name]["max_concurrent_sources"] = config["max_concurrent_sources"]
+        for k in ("max_concurrent_rsyncs", "max_concurrent_deletions", "admission_timeout"):
+            if k not in config["volumes"][volume_name]:
+                config["volumes"][volume_name][k] = config[k]
 
     if len(config["volumes"]) == 0:
         raise Exception("Incomplete config")
 
     if "log_file" not in config:
+        systemd_daemon = lazy_import("systemd.daemon")
         if (not isinstance(systemd_daemon, ImportError)) and systemd_daemon.booted():
             config["log_file"] = "systemd"
         else:
@@ -203,10 +425,28 @@ def load_config(config_dir):
                 config["lock_dir"] = dir
                 break
     if "var_dir" not in config:
-        config["var_dir"] = "/var/lib/turku-storage"
+        config["var_dir"] = DEFAULT_VAR_DIR
+    if "metrics_dir" not in config:
+        config["metrics_dir"] = os.path.join(config["var_dir"], "metrics")
+    if "trace_dir" not in config:
+        config["trace_dir"] = None
+    if "daemon_socket" not in config:
+        config["daemon_socket"] = None
 
     if "snapshot_mode" not in config:
         config["snapshot_mode"] = "link-dest"
+    if "large_files_snapshot_mode" not in config:
+        config["large_files_snapshot_mode"] = "none"
+    if "link_dest_bases" not in config:
+        config["link_dest_bases"] = 1
+    if "link_dest_retention_anchors" not in config:
+        config["link_dest_retention_anchors"] = False
+    if "resume_syncs" not in config:
+        config["resume_syncs"] = False
+    if "snapshot_manifests" not in config:
+        config["snapshot_manifests"] = False
+    if "snapshot_usage" not in config:
+        config["snapshot_usage"] = False
     if "preserve_hard_links" not in config:
         config["preserve_hard_links"] = False
 
@@ -233,10 +473,83 @@ def load_config(config_dir):
 
     if "timezone" not in config:
         config["timezone"] = "UTC"
+    set_timezone(config)
+
+    return config
+
+
+def set_timezone(config):
     if config["timezone"]:
         os.environ["TZ"] = config["timezone"]
     time.tzset()
 
+
+def config_cache_file(config_dir):
+    """Return the location of the resolved config cache for a config directory
+
+    The cache must be found before the config (and so any configured
+    var_dir) is known, so it always lives in the default var_dir.
+    """
+    name = re.sub(r"[^A-Za-z0-9]+", "_", os.path.realpath(config_dir)).strip("_")
+    return os.path.join(DEFAULT_VAR_DIR, "config_cache", "{}.json".format(name))
+
+
+def get_config_inputs(config_dir, config):
+    """Return the mtimes of every file and directory a resolved config depends on"""
+    config_d = os.path.join(config_dir, "config.d")
+    paths = [config_d] + [os.path.join(config_d, fn) for fn in os.listdir(config_d)]
+    keys_glob = config.get("ssh_ping_host_keys_glob", "/etc/ssh/ssh_host_*_key.pub")
+    paths += [os.path.dirname(keys_glob)] + glob.glob(keys_glob)
+    inputs = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            inputs[path] = [st.st_mtime_ns, st.st_size]
+        except OSError:
+            inputs[path] = None
+    return inputs
+
+
+def write_config_cache(config_dir, config):
+    """Save a resolved config so load_config_cached() can skip resolving it"""
+    cache_file = config_cache_file(config_dir)
+    cache = {
+        "version": 1,
+        "config_dir": os.path.realpath(config_dir),
+        "inputs": get_config_inputs(config_dir, config),
+        "config": config,
+    }
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file), mode=0o700)
+        with safe_write(cache_file) as f:
+            os.fchmod(f.fileno(), 0o600)
+            json.dump(cache, f, sort_keys=True)
+    except OSError as e:
+        logging.debug("Cannot write config cache {}: {}".format(cache_file, e))
+
+
+def load_config_cached(config_dir):
+    """Return the resolved config, from the cache if none of its inputs changed"""
+    try:
+        with open(config_cache_file(config_dir)) as f:
+            cache = json.load(f)
+        if cache["version"] != 1 or cache["config_dir"] != os.path.realpath(config_dir):
+            raise ValueError("Config cache mismatch")
+        for path, expected in cache["inputs"].items():
+            try:
+                st = os.stat(path)
+                current = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                current = None
+            if current != expected:
+                raise ValueError("Config cache stale")
+        config = cache["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        config = load_config(config_dir)
+        write_config_cache(config_dir, config)
+        return config
+    set_timezone(config)
     return config
 
 
@@ -271,123 +584,166 @@ def get_latest_snapshot(snapshots):
     return sorted(snapshots, key=lambda x: x["sync_finish"])[-1]
 
 
+def get_snapshot_from_dir(snapshot_dir):
+    """Return snapshot information for a single snapshot directory, or None"""
+    dir = snapshot_dir.parts[-1]
+    if not snapshot_dir.is_dir():
+        return None
+    try:
+        dir_time_parsed = parse_snapshot_name(dir)
+    except ValueError:
+        dir_time_parsed = None
+    json_info_fn = snapshot_dir.parent.joinpath("{}.json".format(dir))
+    if json_info_fn.is_file():
+        with json_info_fn.open() as f:
+            snapshot_info = json.load(f)
+        snapshot_info["directory"] = snapshot_dir
+        snapshot_info["info_file"] = json_info_fn
+        if snapshot_info.get("sync_begin"):
+            snapshot_info["sync_begin"] = datetime.datetime.fromisoformat(snapshot_info["sync_begin"])
+        else:
+            snapshot_info["sync_begin"] = None
+        if snapshot_info.get("sync_finish"):
+            snapshot_info["sync_finish"] = datetime.datetime.fromisoformat(snapshot_info["sync_finish"])
+        else:
+            snapshot_info["sync_finish"] = dir_time_parsed
+        if not snapshot_info.get("name"):
+            snapshot_info["name"] = dir
+        if not snapshot_info.get("base"):
+            snapshot_info["base"] = None
+        if not snapshot_info["sync_finish"]:
+            return None
+        return snapshot_info
+    elif dir_time_parsed:
+        return {
+            "name": dir,
+            "directory": snapshot_dir,
+            "info_file": None,
+            "sync_begin": None,
+            "sync_finish": dir_time_parsed,
+            "base": None,
+        }
+    return None
+
+
 def get_snapshots_from_dir(snapshots_dir):
     snapshots = []
-    for snapshot_dir in snapshots_dir.iterdir():
-        dir = snapshot_dir.parts[-1]
-        if not snapshot_dir.is_dir():
-            continue
-        try:
-            dir_time_parsed = parse_snapshot_name(dir)
-        except ValueError:
-            dir_time_parsed = None
-        json_info_fn = snapshot_dir.parent.joinpath("{}.json".format(dir))
-        if json_info_fn.is_file():
-            with json_info_fn.open() as f:
-                snapshot_info = json.load(f)
-            snapshot_info["directory"] = snapshot_dir
-            snapshot_info["info_file"] = json_info_fn
-            if snapshot_info.get("sync_begin"):
-                snapshot_info["sync_begin"] = datetime.datetime.fromisoformat(snapshot_info["sync_begin"])
-            else:
-                snapshot_info["sync_begin"] = None
-            if snapshot_info.get("sync_finish"):
-                snapshot_info["sync_finish"] = datetime.datetime.fromisoformat(snapshot_info["sync_finish"])
-            else:
-                snapshot_info["sync_finish"] = dir_time_parsed
-            if not snapshot_info.get("name"):
-                snapshot_info["name"] = dir
-            if not snapshot_info.get("base"):
-                snapshot_info["base"] = None
-            if not snapshot_info["sync_finish"]:
-                continue
+    for snapshot_dir in sorted(snapshots_dir.iterdir()):
+        snapshot_info = get_snapshot_from_dir(snapshot_dir)
+        if snapshot_info is not None:
             snapshots.append(snapshot_info)
-        elif dir_time_parsed:
-            snapshots.append(
-                {
-                    "name": dir,
-                    "directory": snapshot_dir,
-                    "info_file": None,
-                    "sync_begin": None,
-                    "sync_finish": dir_time_parsed,
-                    "base": None,
-                }
-            )
     return snapshots
 
 
-def get_snapshots_to_delete(retention, snapshots):
-    now = datetime.datetime.now().astimezone()
-    to_keep = []
-    for ritem in retention.split(","):
-        ritem = ritem.strip()
-        r = re.findall(r"^earliest of (?:(\d+) )?(day|week|month)", ritem)
-        if len(r) > 0:
-            if r[0][0] == "":
-                earliest_num = 1
-            else:
-                earliest_num = int(r[0][0])
-            earliest_word = r[0][1]
-            if earliest_word == "fortnight":
-                earliest_word = "week"
-                earliest_num = earliest_num * 2
-            if earliest_word == "day":
-                cutoff_time = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=(earliest_num - 1))
-            elif earliest_word == "week":
-                cutoff_time = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(
-                    days=((now.weekday() + 1) % 7)
-                )
-                for i in range(earliest_num - 1):
-                    cutoff_time = (cutoff_time - datetime.timedelta(weeks=1)).replace(
-                        day=1, hour=0, minute=0, second=0, microsecond=0
-                    )
-            elif earliest_word == "month":
-                cutoff_time = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                for i in range(earliest_num - 1):
-                    cutoff_time = (cutoff_time - datetime.timedelta(days=1)).replace(
-                        day=1, hour=0, minute=0, second=0, microsecond=0
-                    )
-            else:
-                cutoff_time = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=(earliest_num - 1))
-            candidate_snapshot = None
-            for snapshot in snapshots:
-                if snapshot["sync_finish"] < cutoff_time:
-                    continue
-                if not candidate_snapshot:
-                    candidate_snapshot = snapshot
-                    continue
-                if snapshot["sync_finish"] >= candidate_snapshot["sync_finish"]:
-                    continue
-                candidate_snapshot = snapshot
-            if candidate_snapshot and candidate_snapshot not in to_keep:
-                to_keep.append(candidate_snapshot)
-        r = re.findall(r"^last (\d+) day", ritem)
-        if len(r) > 0:
-            last_days = int(r[0])
-            cutoff_time = now - datetime.timedelta(days=last_days)
-            for snapshot in snapshots:
-                if snapshot["sync_finish"] < cutoff_time:
-                    continue
-                if snapshot not in to_keep:
-                    to_keep.append(snapshot)
-        r = re.findall(r"^last (\d+) snapshot", ritem)
-        if len(r) > 0:
-            last_snapshots = int(r[0])
-            i = 0
-            for snapshot in sorted(snapshots, key=lambda x: x["sync_finish"], reverse=True):
-                i = i + 1
-                if snapshot not in to_keep:
-                    to_keep.append(snapshot)
-                if i == last_snapshots:
-                    break
+RETENTION_EARLIEST_RE = re.compile(r"^earliest of (?:(\d+) )?(day|week|month)")
+RETENTION_LAST_DAYS_RE = re.compile(r"^last (\d+) day")
+RETENTION_LAST_SNAPSHOTS_RE = re.compile(r"^last (\d+) snapshot")
+
+
+class RetentionPolicy:
+    """Compiled retention string
+
+    A retention string is a comma-separated list of rules:
+
+        earliest of [N] (day|week|month)
+        last N days
+        last N snapshots
+
+    Unrecognized rules are ignored.
+    """
+
+    def __init__(self, retention):
+        self.retention = retention
+        self.earliest = []
+        self.last_days = []
+        self.last_snapshots = []
+        for ritem in retention.split(","):
+            ritem = ritem.strip()
+            r = RETENTION_EARLIEST_RE.findall(ritem)
+            if len(r) > 0:
+                earliest_num = 1 if r[0][0] == "" else int(r[0][0])
+                self.earliest.append((earliest_num, r[0][1]))
+            r = RETENTION_LAST_DAYS_RE.findall(ritem)
+            if len(r) > 0:
+                self.last_days.append(int(r[0]))
+            r = RETENTION_LAST_SNAPSHOTS_RE.findall(ritem)
+            if len(r) > 0:
+                self.last_snapshots.append(int(r[0]))
+
+    def __repr__(self):
+        return "<RetentionPolicy {}>".format(repr(self.retention))
+
+    def earliest_cutoff(self, earliest_num, earliest_word, now):
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if earliest_word == "week":
+            cutoff_time = midnight - datetime.timedelta(days=((now.weekday() + 1) % 7))
+            for i in range(earliest_num - 1):
+                cutoff_time = (cutoff_time - datetime.timedelta(weeks=1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        elif earliest_word == "month":
+            cutoff_time = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            for i in range(earliest_num - 1):
+                cutoff_time = (cutoff_time - datetime.timedelta(days=1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        else:
+            cutoff_time = midnight - datetime.timedelta(days=(earliest_num - 1))
+        return cutoff_time
+
+    def evaluate(self, snapshots, now=None):
+        """Return (to_keep, to_delete) lists, each in input order
+
+        Snapshots are sorted once by sync_finish; every rule then resolves
+        to either a single position or a suffix of the sorted list.
+        """
+        if now is None:
+            now = datetime.datetime.now().astimezone()
+        order = sorted(range(len(snapshots)), key=lambda i: snapshots[i]["sync_finish"])
+        finishes = [snapshots[i]["sync_finish"] for i in order]
+        keep = [False] * len(snapshots)
+        keep_from = len(order)
+
+        for earliest_num, earliest_word in self.earliest:
+            pos = bisect.bisect_left(finishes, self.earliest_cutoff(earliest_num, earliest_word, now))
+            if pos < len(order):
+                keep[order[pos]] = True
+
+        for last_days in self.last_days:
+            keep_from = min(keep_from, bisect.bisect_left(finishes, now - datetime.timedelta(days=last_days)))
+
+        for last_snapshots in self.last_snapshots:
+            if last_snapshots <= 0:
+                # Historical behavior: "last 0 snapshots" keeps everything
+                keep_from = 0
+                continue
+            start = max(len(order) - last_snapshots, 0)
+            if start == 0:
+                keep_from = 0
+                continue
+            # Among snapshots tied on sync_finish at the boundary, the
+            # earliest listed ones are the newest.
+            group_begin = bisect.bisect_left(finishes, finishes[start])
+            group_end = bisect.bisect_right(finishes, finishes[start])
+            for pos in range(group_begin, group_begin + (group_end - start)):
+                keep[order[pos]] = True
+            keep_from = min(keep_from, group_end)
+
+        for pos in range(keep_from, len(order)):
+            keep[order[pos]] = True
+
+        to_keep = [snapshot for snapshot, k in zip(snapshots, keep) if k]
+        # If something went wrong and nothing was found to keep,
+        # don't delete everything.
+        if len(to_keep) == 0:
+            return list(snapshots), []
+        to_delete = [snapshot for snapshot, k in zip(snapshots, keep) if not k]
+        return to_keep, to_delete
 
-    # If something went wrong and nothing was found to keep,
-    # don't delete everything.
-    if len(to_keep) == 0:
-        return []
+    def get_snapshots_to_delete(self, snapshots, now=None):
+        return self.evaluate(snapshots, now=now)[1]
 
-    to_delete = []
-    for snapshot in snapshots:
-        if snapshot not in to_keep:
-            to_delete.append(snapshot)
-    return to_delete
+
+@functools.lru_cache(maxsize=64)
+def compile_retention(retention):
+    return RetentionPolicy(retention)
+
+
+def get_snapshots_to_delete(retention, snapshots):
+    return compile_retention(retention).get_snapshots_to_delete(snapshots)